@@ -0,0 +1,242 @@
+"""Measure QR decoding accuracy, latency and memory on a synthetic corpus.
+
+The corpus is generated with ``qrcode`` and ``pillow``: every sample renders a
+book code and then applies a random combination of output resolution,
+rotation, blur, JPEG quality and perspective skew. Each decoder configuration
+is run over the same corpus in a fresh worker process, so changes to
+:func:`utils.decode_qr_image` can be judged on speed, accuracy and memory
+together. Memory is the worker's peak resident set size, which includes the
+buffers OpenCV allocates outside the Python heap.
+
+Run from the project root::
+
+    python benchmarks/qr_decode.py --samples 200 --breakdown
+"""
+
+from __future__ import annotations
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import io
+import itertools
+import multiprocessing
+import random
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, NamedTuple, Optional
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+import cv2
+import numpy as np
+import qrcode
+from PIL import Image, ImageFilter
+
+from utils import decode_qr_image
+
+RESOLUTIONS = [160, 320, 640, 1280, 2560]
+ROTATIONS = [0, 10, 45, 90]
+BLURS = [0.0, 1.0, 2.0]
+JPEG_QUALITIES = [None, 90, 50, 20]
+SKEWS = [0.0, 0.1, 0.2]
+
+AXES = {
+    "resolution": RESOLUTIONS,
+    "rotation": ROTATIONS,
+    "blur": BLURS,
+    "jpeg": JPEG_QUALITIES,
+    "skew": SKEWS,
+}
+
+
+class Sample(NamedTuple):
+    payload: str
+    params: Dict[str, object]
+    data: bytes
+
+
+def _perspective_coeffs(src: List[tuple], dst: List[tuple]) -> List[float]:
+    """Return PIL perspective coefficients mapping ``dst`` points onto ``src``."""
+    matrix = []
+    for (x, y), (u, v) in zip(dst, src):
+        matrix.append([x, y, 1, 0, 0, 0, -u * x, -u * y])
+        matrix.append([0, 0, 0, x, y, 1, -v * x, -v * y])
+    a = np.array(matrix, dtype=float)
+    b = np.array(src, dtype=float).reshape(8)
+    return np.linalg.solve(a, b).tolist()
+
+
+def render_sample(payload: str, params: Dict[str, object]) -> bytes:
+    """Render ``payload`` as an image distorted according to ``params``."""
+    img = qrcode.make(payload, border=4).get_image().convert("L")
+    side = int(params["resolution"])
+    img = img.resize((side, side), Image.NEAREST)
+
+    skew = float(params["skew"])
+    if skew:
+        d = side * skew
+        corners = [(0, 0), (side, 0), (side, side), (0, side)]
+        skewed = [(d, d / 2), (side - d / 3, 0), (side, side), (0, side - d / 2)]
+        img = img.transform(
+            (side, side),
+            Image.PERSPECTIVE,
+            _perspective_coeffs(corners, skewed),
+            Image.BICUBIC,
+            fillcolor=255,
+        )
+
+    rotation = int(params["rotation"])
+    if rotation:
+        img = img.rotate(rotation, resample=Image.BICUBIC, expand=True, fillcolor=255)
+
+    blur = float(params["blur"])
+    if blur:
+        img = img.filter(ImageFilter.GaussianBlur(blur * side / 320))
+
+    buf = io.BytesIO()
+    quality = params["jpeg"]
+    if quality is None:
+        img.save(buf, format="PNG")
+    else:
+        img.convert("RGB").save(buf, format="JPEG", quality=int(quality))
+    return buf.getvalue()
+
+
+def build_corpus(samples: int, seed: int = 0) -> List[Sample]:
+    """Return ``samples`` images drawn from the full distortion grid."""
+    rng = random.Random(seed)
+    grid = list(itertools.product(*AXES.values()))
+    rng.shuffle(grid)
+    corpus = []
+    for i, values in enumerate(itertools.islice(itertools.cycle(grid), samples)):
+        params = dict(zip(AXES.keys(), values))
+        payload = f"HRB-{i:06d}"
+        corpus.append(Sample(payload, params, render_sample(payload, params)))
+    return corpus
+
+
+def _decode_aruco(data: bytes) -> Optional[str]:
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    decoded, _, _ = cv2.QRCodeDetectorAruco().detectAndDecode(img)
+    return decoded.strip() if decoded else None
+
+
+DECODERS: Dict[str, Callable[[bytes], Optional[str]]] = {
+    "color": decode_qr_image,
+    "grayscale": lambda data: decode_qr_image(data, grayscale=True),
+    "grayscale_max1024": lambda data: decode_qr_image(
+        data, grayscale=True, max_side=1024
+    ),
+    "grayscale_max640": lambda data: decode_qr_image(
+        data, grayscale=True, max_side=640
+    ),
+}
+if hasattr(cv2, "QRCodeDetectorAruco"):
+    DECODERS["aruco_grayscale"] = _decode_aruco
+
+
+def _max_rss_kib() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+def run_decoder(
+    decode: Callable[[bytes], Optional[str]], corpus: List[Sample]
+) -> Dict[str, object]:
+    """Decode every sample and return accuracy, latency and memory figures.
+
+    ``peak_rss_kib`` is the peak RSS of the calling process, so it is only
+    meaningful when the process runs a single decoder (see :func:`measure`).
+    """
+    latencies = []
+    results = []
+    for sample in corpus:
+        started = time.perf_counter()
+        try:
+            decoded = decode(sample.data)
+        except cv2.error:
+            decoded = None
+        latencies.append(time.perf_counter() - started)
+        results.append(decoded == sample.payload)
+    latencies.sort()
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return {
+        "success": sum(results) / len(results),
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "p95_ms": p95 * 1000,
+        "peak_rss_kib": _max_rss_kib(),
+        "results": results,
+    }
+
+
+def _run_named(name: str, corpus: List[Sample]) -> Dict[str, object]:
+    return run_decoder(DECODERS[name], corpus)
+
+
+def measure(name: str, corpus: List[Sample]) -> Dict[str, object]:
+    """Run decoder ``name`` over ``corpus`` in a fresh worker process."""
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(_run_named, name, corpus).result()
+
+
+def _breakdown(corpus: List[Sample], results: List[bool]) -> List[str]:
+    lines = []
+    for axis, values in AXES.items():
+        parts = []
+        for value in values:
+            hits = [ok for s, ok in zip(corpus, results) if s.params[axis] == value]
+            if hits:
+                parts.append(f"{value}: {sum(hits) / len(hits):.0%}")
+        lines.append(f"    {axis:<10} " + ", ".join(parts))
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--samples", type=int, default=120)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--decoder",
+        action="append",
+        choices=sorted(DECODERS),
+        help="Decoder configuration to run (default: all).",
+    )
+    parser.add_argument(
+        "--save-dir", type=Path, help="Write the generated corpus to this directory."
+    )
+    parser.add_argument(
+        "--breakdown",
+        action="store_true",
+        help="Show success rate per distortion value.",
+    )
+    args = parser.parse_args(argv)
+
+    corpus = build_corpus(args.samples, args.seed)
+    if args.save_dir:
+        args.save_dir.mkdir(parents=True, exist_ok=True)
+        for sample in corpus:
+            suffix = "png" if sample.params["jpeg"] is None else "jpg"
+            name = "_".join(f"{k}{v}" for k, v in sample.params.items())
+            (args.save_dir / f"{sample.payload}_{name}.{suffix}").write_bytes(sample.data)
+
+    print(f"{len(corpus)} samples, seed {args.seed}")
+    print(f"{'decoder':<20} {'success':>8} {'mean ms':>9} {'p95 ms':>9} {'peak RSS MiB':>13}")
+    for name in args.decoder or DECODERS:
+        stats = measure(name, corpus)
+        print(
+            f"{name:<20} {stats['success']:>8.1%} {stats['mean_ms']:>9.2f}"
+            f" {stats['p95_ms']:>9.2f} {stats['peak_rss_kib'] / 1024:>13.1f}"
+        )
+        if args.breakdown:
+            print("\n".join(_breakdown(corpus, stats["results"])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+"""Compare the default and production SQLite profiles of :mod:`db`.
+
+Every profile gets a fresh database with the same catalogue. The benchmark
+then measures single-threaded reads (user lookup, office listing page, user
+books), take/return writes, and a mixed run where several reader threads
+query while one thread keeps taking and returning books.
+
+Run from the project root::
+
+    python benchmarks/sqlite_profile.py --books 5000 --ops 2000
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date
+from pathlib import Path
+from typing import Dict, List, Optional
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+OFFICES = ["Main", "Alt", "North", "South"]
+PROFILES = ["default", "production"]
+
+
+def load_db(path: str, profile: str):
+    """Import :mod:`db` configured for ``profile`` on the SQLite file ``path``."""
+    os.environ["DB_ENGINE"] = "sqlite"
+    os.environ["DB_NAME"] = path
+    os.environ["SQLITE_PROFILE"] = profile
+    import db
+
+    return importlib.reload(db)
+
+
+def populate(db, books: int, users: int) -> None:
+    db.init_db()
+    db.import_users(
+        [
+            {
+                "telegram_id": i,
+                "first_name": f"First{i}",
+                "last_name": f"Last{i}",
+                "office": OFFICES[i % len(OFFICES)],
+                "role": "user",
+            }
+            for i in range(users)
+        ]
+    )
+    for start in range(0, books, 500):
+        db.import_books(
+            [
+                {"qr_code": f"B{i:06d}", "title": f"Book {i}", "office": OFFICES[i % len(OFFICES)]}
+                for i in range(start, min(books, start + 500))
+            ]
+        )
+
+
+def _timed(fn, ops: int) -> List[float]:
+    latencies = []
+    for i in range(ops):
+        started = time.perf_counter()
+        fn(i)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+def _summary(latencies: List[float]) -> str:
+    latencies = sorted(latencies)
+    p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+    return (
+        f"mean {statistics.mean(latencies) * 1000:7.3f} ms, "
+        f"p95 {p95 * 1000:7.3f} ms, {len(latencies) / sum(latencies):8.0f} ops/s"
+    )
+
+
+def run_profile(profile: str, books: int, users: int, ops: int, threads: int) -> Dict[str, str]:
+    with tempfile.TemporaryDirectory() as tmp:
+        db = load_db(str(Path(tmp) / "bench.db"), profile)
+        populate(db, books, users)
+        per_office = books // len(OFFICES)
+
+        def read(i: int) -> None:
+            office = OFFICES[i % len(OFFICES)]
+            db.get_user(i % users)
+            db.get_office_books_page(office, 20, (i * 20) % max(per_office, 1))
+            db.get_user_books(i % users)
+
+        def write(i: int) -> None:
+            qr = f"B{(i % books):06d}"
+            office = OFFICES[(i % books) % len(OFFICES)]
+            db.take_book(qr, i % users, office, date.today())
+            db.return_book(qr, i % users, office)
+
+        results = {
+            "reads": _summary(_timed(read, ops)),
+            "take+return": _summary(_timed(write, ops // 4)),
+        }
+
+        stop = threading.Event()
+        read_latencies: List[float] = []
+        lock = threading.Lock()
+
+        def reader(offset: int) -> None:
+            local = []
+            i = offset
+            while not stop.is_set():
+                started = time.perf_counter()
+                read(i)
+                local.append(time.perf_counter() - started)
+                i += threads
+            with lock:
+                read_latencies.extend(local)
+
+        workers = [threading.Thread(target=reader, args=(n,)) for n in range(threads)]
+        for worker in workers:
+            worker.start()
+        write_latencies = _timed(write, ops // 4)
+        stop.set()
+        for worker in workers:
+            worker.join()
+        results["mixed reads"] = _summary(read_latencies)
+        results["mixed writes"] = _summary(write_latencies)
+        db.close_connections()
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--books", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=4, help="Reader threads in the mixed run.")
+    parser.add_argument("--profile", action="append", choices=PROFILES)
+    args = parser.parse_args(argv)
+
+    for profile in args.profile or PROFILES:
+        print(profile)
+        results = run_profile(profile, args.books, args.users, args.ops, args.threads)
+        for name, line in results.items():
+            print(f"  {name:<13} {line}")
+
+
+if __name__ == "__main__":
+    main()
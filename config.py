@@ -2,10 +2,12 @@
 
 from __future__ import annotations
 
+import json
 import os
-from typing import List
+from contextvars import ContextVar
+from typing import Dict, FrozenSet, List, Mapping, Optional
 
-from dotenv import load_dotenv
+from dotenv import dotenv_values, load_dotenv
 
 # Ensure environment variables are loaded when the application is started from
 # any working directory. We look for a ``.env`` file located next to this module
@@ -21,6 +23,13 @@ if os.path.exists(dotenv_path):
 elif os.path.exists(example_path):
     load_dotenv(example_path)
 
+# The file watched for administrator changes while the bot runs.
+ENV_PATH = (
+    example_path
+    if not os.path.exists(dotenv_path) and os.path.exists(example_path)
+    else dotenv_path
+)
+
 
 def _parse_ids(value: str) -> List[str]:
     return [v.strip() for v in value.split(",") if v.strip()]
@@ -29,58 +38,268 @@ def _parse_ids(value: str) -> List[str]:
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_IDS = _parse_ids(os.getenv("ADMIN_IDS", ""))
 
+# Number of days a book may be kept before it is reported as overdue.
+LOAN_PERIOD_DAYS = int(os.getenv("LOAN_PERIOD_DAYS", "30"))
+
+# How often the overdue reminder job runs and how long to wait before the
+# same loan is reminded about again.
+REMINDER_INTERVAL_HOURS = float(os.getenv("REMINDER_INTERVAL_HOURS", "24"))
+REMINDER_REPEAT_DAYS = int(os.getenv("REMINDER_REPEAT_DAYS", "7"))
+
+# How often the per-office summary counters are recounted from the books
+# table. The counters are kept up to date on every write; the recount repairs
+# drift and refreshes the overdue numbers as loans age.
+STATS_RECONCILE_MINUTES = float(os.getenv("STATS_RECONCILE_MINUTES", "60"))
+
+# Local SQLite journal that queues takes and returns while the database is
+# unavailable, and how often the bot tries to replay it.
+OFFLINE_JOURNAL_PATH = os.getenv(
+    "OFFLINE_JOURNAL_PATH", os.path.join(base_dir, "data", "offline_journal.db")
+)
+OFFLINE_REPLAY_SECONDS = float(os.getenv("OFFLINE_REPLAY_SECONDS", "30"))
+
+# How often changed conversation states and ``user_data`` are written to the
+# database in one batch, so an interrupted dialog resumes after a restart.
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "30"))
+
+# Dialogs idle for longer than this are cancelled (0 disables the timeout).
+# ``user_data`` of users inactive for ``STATE_IDLE_HOURS`` is dropped by a
+# sweep that runs every ``STATE_SWEEP_MINUTES``.
+CONVERSATION_TIMEOUT_MINUTES = float(os.getenv("CONVERSATION_TIMEOUT_MINUTES", "15"))
+STATE_IDLE_HOURS = float(os.getenv("STATE_IDLE_HOURS", "24"))
+STATE_SWEEP_MINUTES = float(os.getenv("STATE_SWEEP_MINUTES", "60"))
+
+# Logged messages older than ``MESSAGE_RETENTION_DAYS`` (0 keeps them forever)
+# are removed every ``LOG_RETENTION_MINUTES``, ``LOG_PURGE_BATCH`` rows at a
+# time so that logging new messages is never held up for long.
+MESSAGE_RETENTION_DAYS = int(os.getenv("MESSAGE_RETENTION_DAYS", "90"))
+LOG_RETENTION_MINUTES = float(os.getenv("LOG_RETENTION_MINUTES", "60"))
+LOG_PURGE_BATCH = int(os.getenv("LOG_PURGE_BATCH", "1000"))
+
 # Offices available for registration. Keys are the office names that will be
 # presented to the user during the /start flow. Each office can optionally
 # define administrators specific to that office. Administrator IDs can be
 # provided via environment variables using the pattern
 # ``OFFICE_<OFFICE_NAME>_ADMINS`` where ``OFFICE_NAME`` is uppercase.
+# ``OFFICES_FILE``, if it exists, replaces the built-in list below with a JSON
+# object of the same shape (``name``, optional ``admins`` and ``aliases``).
+OFFICES_FILE = os.getenv("OFFICES_FILE", os.path.join(base_dir, "data", "offices.json"))
+
+# How often (in seconds) ``.env`` and ``OFFICES_FILE`` are checked for changes;
+# 0 disables hot reloading.
+CONFIG_RELOAD_SECONDS = float(os.getenv("CONFIG_RELOAD_SECONDS", "10"))
+
+# Multi-tenant runner: JSON list of the bots served by one process, and the
+# number of threads decoding QR photos for all of them.
+TENANTS_FILE = os.getenv("TENANTS_FILE", os.path.join(base_dir, "data", "tenants.json"))
+QR_DECODE_WORKERS = int(os.getenv("QR_DECODE_WORKERS", str(min(4, os.cpu_count() or 1))))
 
 
-def _office_admins(name: str) -> List[str]:
+def _office_admins(name: str, env: Mapping[str, str] = os.environ) -> List[str]:
     env_var = f"OFFICE_{name.upper()}_ADMINS"
-    return _parse_ids(os.getenv(env_var, ""))
+    return _parse_ids(env.get(env_var, ""))
 
 
-OFFICES = {
+_BUILTIN_OFFICES = {
     # Офис ГК «ОСНОВА» – Москва, ул. Малая Семёновская, д. 9, стр. 3, 2 этаж
     "NaSemenovskoy": {
         "name": "На Семёновской",
-        "admins": _office_admins("NaSemenovskoy"),
     },
     # ООО «БитРу», пл. Семёновская, 1а, 11 этаж БЦ «Соколиная Гора"
     # Используется короткое имя SokolGora
     "SokolGora": {
         "name": "Соколиная Гора",
-        "admins": _office_admins("SokolGora"),
     },
     # Офис ГК «ОСНОВА» – Москва, ул. Большая Семёновская, д. 32, 3 этаж
     "Bolshaya32": {
         "name": "Большая 32",
-        "admins": _office_admins("Bolshaya32"),
     },
     # Центральный офис ГК «ОСНОВА» – Москва, ул. Большая Семёновская, д. 32/7, 2 этаж
     "Central": {
         "name": "Центральный",
-        "admins": _office_admins("Central"),
     },
     # IT-Технопарк «ФизТехПарк» – Москва, ш. Долгопрудненское, д. 3
     "FizTechPark": {
         "name": "ФизТехПарк",
-        "admins": _office_admins("FizTechPark"),
     },
     # Курорт «ЕРИНО» – поселок Ерино, микрорайон Санаторий, д. 1, стр. 5
     "Erino": {
         "name": "Ерино",
-        "admins": _office_admins("Erino"),
     },
     # ООО «Открытые мастерские» – Москва, ул. Электрозаводская, д. 27, стр. 8
     "OpenWorkshops": {
         "name": "Открытые мастерские",
-        "admins": _office_admins("OpenWorkshops"),
     },
     # Проектный офис ГК «ОСНОВА» – Москва, ул. Электрозаводская, д. 27, стр. 2
     "ProjectOffice": {
         "name": "Проектный офис",
-        "admins": _office_admins("ProjectOffice"),
     },
 }
+
+
+def _load_offices(env: Mapping[str, str] = os.environ) -> dict:
+    if os.path.exists(OFFICES_FILE):
+        with open(OFFICES_FILE, "r", encoding="utf-8") as f:
+            offices = json.load(f)
+    else:
+        offices = _BUILTIN_OFFICES
+    return {
+        key: {
+            **info,
+            "admins": [str(a) for a in info.get("admins", [])] + _office_admins(key, env),
+        }
+        for key, info in offices.items()
+    }
+
+
+OFFICES = _load_offices()
+
+
+def normalize_office(text: str) -> str:
+    """Return a normalized string for office comparison."""
+    return text.strip().lower().replace("ё", "е")
+
+
+class ConfigIndex:
+    """Lookup tables compiled from ``ADMIN_IDS`` and ``OFFICES``."""
+
+    __slots__ = ("admin_ids", "offices", "global_admins", "office_admins", "any_admins", "aliases")
+
+    def __init__(self, admin_ids: List[str], offices: dict) -> None:
+        self.admin_ids = admin_ids
+        self.offices = offices
+        self.global_admins: FrozenSet[str] = frozenset(str(a) for a in admin_ids)
+        self.office_admins: Dict[str, FrozenSet[str]] = {
+            key: frozenset(str(a) for a in info.get("admins", [])) for key, info in offices.items()
+        }
+        self.any_admins: FrozenSet[str] = frozenset().union(*self.office_admins.values())
+        # Normalized key, display name or alias -> office key; the first
+        # office claiming a spelling wins.
+        self.aliases: Dict[str, str] = {}
+        for key, info in offices.items():
+            for alias in (key, info.get("name", ""), *info.get("aliases", [])):
+                alias = normalize_office(str(alias))
+                if alias:
+                    self.aliases.setdefault(alias, key)
+
+
+class Tenant:
+    """One library served by the multi-tenant runner (``multitenant.py``).
+
+    ``database`` is the Postgres schema or the SQLite file holding the
+    tenant's tables.
+    """
+
+    __slots__ = ("name", "token", "database", "index")
+
+    def __init__(
+        self, name: str, token: str, database: str, admin_ids: List[str], offices: dict
+    ) -> None:
+        self.name = name
+        self.token = token
+        self.database = database
+        self.index = ConfigIndex(admin_ids, offices)
+
+
+# The tenant whose update or job is being handled. Every task of a tenant's
+# application runs with it set; ``None`` in the single-bot ``main.py``.
+current_tenant: ContextVar[Optional[Tenant]] = ContextVar("current_tenant", default=None)
+
+
+def tenant_name() -> Optional[str]:
+    tenant = current_tenant.get()
+    return tenant.name if tenant is not None else None
+
+
+_index: Optional[ConfigIndex] = None
+
+
+def index() -> ConfigIndex:
+    """Return the lookup index of the current tenant or of ``ADMIN_IDS`` and ``OFFICES``.
+
+    The index is rebuilt when either setting is reassigned (by
+    :func:`reload` or a test), so the settings must be replaced, not mutated.
+    """
+    global _index
+    tenant = current_tenant.get()
+    if tenant is not None:
+        return tenant.index
+    current = _index
+    if current is None or current.admin_ids is not ADMIN_IDS or current.offices is not OFFICES:
+        current = _index = ConfigIndex(ADMIN_IDS, OFFICES)
+    return current
+
+
+_ADMIN_KEY_PREFIX, _ADMIN_KEY_SUFFIX = "OFFICE_", "_ADMINS"
+
+
+def _env_admin_values() -> Dict[str, str]:
+    """Return ``ADMIN_IDS`` and ``OFFICE_<NAME>_ADMINS`` set in ``ENV_PATH``."""
+    if not os.path.exists(ENV_PATH):
+        return {}
+    return {
+        key: value
+        for key, value in dotenv_values(ENV_PATH).items()
+        if value is not None
+        and (
+            key == "ADMIN_IDS"
+            or (key.startswith(_ADMIN_KEY_PREFIX) and key.endswith(_ADMIN_KEY_SUFFIX))
+        )
+    }
+
+
+# Administrator variables that came from the env file, so that reloading a
+# file without them unsets them instead of keeping the old value.
+_env_admin_keys = {
+    key for key, value in _env_admin_values().items() if os.environ.get(key) == value
+}
+
+
+def reload() -> None:
+    """Re-read administrators from ``ENV_PATH`` and offices from ``OFFICES_FILE``.
+
+    Only ``ADMIN_IDS`` and ``OFFICE_<NAME>_ADMINS`` are taken from the env
+    file; other settings still need a restart. Such a variable removed from
+    the file is unset. Both files are parsed and the new settings compiled
+    before the environment and the index are replaced, so a file that fails
+    to load changes nothing and lookups never see a partial update.
+    """
+    global ADMIN_IDS, OFFICES, _index, _env_admin_keys
+    values = _env_admin_values()
+    removed = _env_admin_keys - values.keys()
+    env = {key: value for key, value in os.environ.items() if key not in removed}
+    env.update(values)
+    admin_ids = _parse_ids(env.get("ADMIN_IDS", ""))
+    offices = _load_offices(env)
+    new_index = ConfigIndex(admin_ids, offices)
+
+    for key in removed:
+        os.environ.pop(key, None)
+    os.environ.update(values)
+    _env_admin_keys = set(values)
+    _index, ADMIN_IDS, OFFICES = new_index, admin_ids, offices
+
+
+def _source_mtimes() -> tuple:
+    return tuple(
+        os.path.getmtime(path) if os.path.exists(path) else None
+        for path in (ENV_PATH, OFFICES_FILE)
+    )
+
+
+_mtimes = _source_mtimes()
+
+
+def reload_if_changed() -> bool:
+    """Call :func:`reload` if ``ENV_PATH`` or ``OFFICES_FILE`` changed.
+
+    A file that fails to load is not retried until it changes again; the
+    previous settings stay in effect.
+    """
+    global _mtimes
+    mtimes = _source_mtimes()
+    if mtimes == _mtimes:
+        return False
+    _mtimes = mtimes
+    reload()
+    return True
@@ -1,11 +1,27 @@
+import abc
 import os
+import re
+from collections.abc import MutableMapping
 from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import date, datetime, timedelta, timezone
+import itertools
+import json
 import logging
+import queue
+import threading
+import time
+from typing import Dict, Iterator, Optional, Set, Tuple
 
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import sqlite3
 
+import config
+
 # Load environment variables so database configuration works out of the box.
 # We first look for a `.env` file in the project root and load it if present.
 # If it doesn't exist we fall back to `.env.example` which ships with sample
@@ -21,11 +37,18 @@ elif os.path.exists(example_path):
 
 # Required database connection settings. These environment variables must be
 # defined or a ``KeyError`` will be raised on import.
+# ``DB_ENGINE`` selects the storage backend: ``postgres`` and ``sqlite`` are
+# served by the SQL functions in this module, whose syntax differences live in
+# ``_dialect``; ``memory`` replaces those functions with the methods of
+# :class:`memstore.MemoryBackend` (see ``BACKEND_API`` at the end).
 DB_ENGINE = os.getenv("DB_ENGINE", "postgres")
 if DB_ENGINE == "sqlite":
     DB_NAME = os.getenv("DB_NAME", os.path.join(base_dir, "hrbook.db"))
     DB_USER = DB_PASSWORD = DB_HOST = None
     DB_PORT = None
+elif DB_ENGINE == "memory":
+    DB_NAME = DB_USER = DB_PASSWORD = DB_HOST = None
+    DB_PORT = None
 else:
     DB_NAME = os.environ["DB_NAME"]
     DB_USER = os.environ["DB_USER"]
@@ -33,53 +56,754 @@ else:
     DB_HOST = os.environ["DB_HOST"]
     DB_PORT = int(os.environ["DB_PORT"])
 
+# Fail fast when the primary is slow or down: connection and statement
+# timeouts, and a circuit breaker that stops connecting for
+# ``DB_BREAKER_RESET_SECONDS`` after ``DB_BREAKER_FAILURES`` failures in a row.
+DB_CONNECT_TIMEOUT = int(os.getenv("DB_CONNECT_TIMEOUT", "3"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "15000"))
+DB_BREAKER_FAILURES = int(os.getenv("DB_BREAKER_FAILURES", "3"))
+DB_BREAKER_RESET_SECONDS = float(os.getenv("DB_BREAKER_RESET_SECONDS", "30"))
+
+# Optional Postgres read replicas as comma separated DSNs. Read-only queries
+# are spread over replicas whose replication lag is within
+# ``DB_REPLICA_MAX_LAG`` seconds; everything else goes to the primary above.
+DB_REPLICAS = [v.strip() for v in os.getenv("DB_REPLICAS", "").split(",") if v.strip()]
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "5"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "10"))
+DB_REPLICA_POOL_SIZE = int(os.getenv("DB_REPLICA_POOL_SIZE", "4"))
+
+# SQLite tuning. The ``production`` profile enables WAL and keeps one writer
+# connection plus a pool of reader connections open; the default profile
+# opens a plain connection per call, which is enough for the tests.
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "default")
+SQLITE_READERS = int(os.getenv("SQLITE_READERS", "4"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "5"))
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "256"))
+
+# Size of the Postgres connection pool shared by all tenants of the
+# multi-tenant runner (see ``use_shared_pool``).
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+
+# In-memory engine: directory of the JSON snapshots and how often they are
+# written. ``0`` disables periodic snapshots; one is still written on shutdown.
+MEMORY_DATA_DIR = os.getenv("MEMORY_DATA_DIR", os.path.join(base_dir, "data"))
+MEMORY_SNAPSHOT_SECONDS = float(os.getenv("MEMORY_SNAPSHOT_SECONDS", "60"))
+
+
+# SQLite has no native date types. Dates and UTC timestamps are stored as ISO
+# strings (matching ``CURRENT_TIMESTAMP``) so they sort and compare correctly,
+# and are converted back based on the declared column type.
+def _adapt_timestamp(value: datetime) -> str:
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat(sep=" ")
+
+
+def _convert_timestamp(value: bytes) -> datetime:
+    return datetime.fromisoformat(value.decode()).replace(tzinfo=timezone.utc)
+
+
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, _adapt_timestamp)
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()))
+sqlite3.register_converter("TIMESTAMP", _convert_timestamp)
+
+
+class _Record(MutableMapping):
+    """Row of a fixed set of columns, stored in ``__slots__``.
+
+    Records behave like the dicts the getters used to return (``.get``,
+    ``[...]``, ``update``, iteration over column names) but take a fraction
+    of the memory, which matters for large listings. Columns cannot be added
+    or removed.
+    """
+
+    __slots__ = ()
+    _fields: Tuple[str, ...] = ()
+
+    def __init__(self, *values) -> None:
+        for name, value in zip(self._fields, values):
+            setattr(self, name, value)
+
+    def __getitem__(self, key: str):
+        if key not in self._fields:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        raise TypeError(f"{type(self).__name__} columns cannot be removed")
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._fields)
+
+    def __len__(self) -> int:
+        return len(self._fields)
+
+    def __repr__(self) -> str:
+        return repr(dict(self.items()))
+
+
+class User(_Record):
+    __slots__ = _fields = ("telegram_id", "first_name", "last_name", "office", "role")
+
+
+class Book(_Record):
+    __slots__ = _fields = ("qr_code", "title", "status", "taken_by", "taken_date", "office")
+
+
+class BookListing(Book):
+    """Book joined with the name of its borrower."""
+
+    __slots__ = ("first_name", "last_name")
+    _fields = Book._fields + __slots__
+
+
+class LoggedMessage(_Record):
+    __slots__ = _fields = ("user_id", "text", "created_at")
+
+
+class _RecordCursor(psycopg2.extensions.cursor):
+    """psycopg2 cursor returning rows as ``self.record`` objects."""
+
+    record = None
+
+    def fetchone(self):
+        row = super().fetchone()
+        return None if row is None else self.record(*row)
+
+    def fetchall(self):
+        return [self.record(*row) for row in super().fetchall()]
+
+
+class _Dialect:
+    """SQL syntax that differs between the SQL engines.
+
+    The SQL functions of this module build their statements from
+    ``_dialect``; features without a common form, such as full-text search
+    and message log partitions, still branch on ``DB_ENGINE``.
+    """
+
+    param = "%s"
+    # Appended to a ``SELECT`` that reads a row about to be updated.
+    lock = " FOR UPDATE"
+    id_column = "SERIAL PRIMARY KEY"
+    timestamp_type = "TIMESTAMPTZ"
+
+    def record_cursor(self, conn, record):
+        cur = conn.cursor(cursor_factory=_RecordCursor)
+        cur.record = record
+        return cur
+
+    def insert_many(self, cur, insert: str, rows: list, suffix: str = "") -> None:
+        """Run ``insert`` (``INSERT ... VALUES``) for every row in ``rows``."""
+        if rows:
+            # execute_values formats the statement again, so keep ``%`` literal.
+            statement = insert + " %s" + suffix.replace("%", "%%")
+            execute_values(cur, statement, rows, page_size=len(rows))
+
+    def in_list(self, cur, column: str, values) -> str:
+        """Return ``column IN (...)`` with ``values`` inlined as literals."""
+        return cur.mogrify(f"{column} IN %s", (tuple(values),)).decode()
+
+    def utc_date(self, column: str) -> str:
+        return f"CAST({column} AT TIME ZONE 'UTC' AS DATE)"
+
+    def days_between(self, start: str, end: str) -> str:
+        return f"EXTRACT(EPOCH FROM {end} - {start}) / 86400"
+
+
+class _SQLiteDialect(_Dialect):
+    param = "?"
+    lock = ""
+    id_column = "INTEGER PRIMARY KEY AUTOINCREMENT"
+    timestamp_type = "TIMESTAMP"
+
+    def record_cursor(self, conn, record):
+        cur = conn.cursor()
+        cur.row_factory = lambda _cur, row: record(*row)
+        return cur
+
+    def insert_many(self, cur, insert: str, rows: list, suffix: str = "") -> None:
+        if rows:
+            values = ", ".join("?" * len(rows[0]))
+            cur.executemany(f"{insert} ({values}){suffix}", rows)
+
+    def in_list(self, cur, column: str, values) -> str:
+        quoted = ", ".join("'" + str(value).replace("'", "''") + "'" for value in values)
+        return f"{column} IN ({quoted})"
+
+    def utc_date(self, column: str) -> str:
+        return f"date({column})"
+
+    def days_between(self, start: str, end: str) -> str:
+        return f"julianday({end}) - julianday({start})"
+
+
+_dialect = _SQLiteDialect() if DB_ENGINE == "sqlite" else _Dialect()
+
+
+def _record_cursor(conn, record):
+    """Return a cursor of ``conn`` whose rows are built as ``record`` objects."""
+    return _dialect.record_cursor(conn, record)
+
+
+# Set by ``init_db`` when the ``pg_trgm`` extension is available.
+_HAS_TRGM = False
+
+# Write counters per office, used to invalidate cached renderings of book
+# listings. ``None`` counts writes to users, whose names appear in listings.
+# The bot runs as a single process (see ``main.acquire_lock``), so an
+# in-process counter sees every write made by the bot.
+_versions: dict = {}
+
+
+def _scope() -> Optional[str]:
+    """Return the schema or SQLite file of the current tenant, if any."""
+    tenant = config.current_tenant.get()
+    return tenant.database if tenant is not None else None
+
+
+def _bump_version(*offices) -> None:
+    tx = _transaction.get()
+    if tx is not None:
+        # Readers must not cache data under a version before it is committed.
+        tx.bumped.update(offices)
+        return
+    scope = _scope()
+    for office in offices:
+        _versions[scope, office] = _versions.get((scope, office), 0) + 1
+
+
+def office_version(office) -> int:
+    """Return a number that changes whenever books of ``office`` or users change."""
+    # Both counters only grow, so their sum changes on every write.
+    scope = _scope()
+    return _versions.get((scope, office), 0) + _versions.get((scope, None), 0)
+
+
+class _Transaction:
+    """Connection of an open :func:`transaction`.
+
+    Database functions see it as a normal connection, but their ``commit``
+    calls are deferred until the whole transaction ends.
+    """
+
+    def __init__(self, conn) -> None:
+        self.conn = conn
+        self.bumped: Set[Optional[str]] = set()
+
+    def cursor(self, *args, **kwargs):
+        return self.conn.cursor(*args, **kwargs)
+
+    def commit(self) -> None:
+        """Does nothing; :func:`transaction` commits once at the end."""
+
+    def __getattr__(self, name: str):
+        return getattr(self.conn, name)
+
+
+_transaction: ContextVar[Optional[_Transaction]] = ContextVar(
+    "db_transaction", default=None
+)
+
+
+class DatabaseUnavailable(Exception):
+    """Raised when the database cannot be reached or the circuit is open."""
+
+
+class _CircuitBreaker:
+    """Stop calling a failing database for a while instead of hanging.
+
+    After ``failures`` consecutive failures the circuit opens and every call
+    fails immediately. ``reset_after`` seconds later a single trial call is
+    let through; its success closes the circuit again.
+    """
+
+    def __init__(self, failures: int, reset_after: float) -> None:
+        self.failures = failures
+        self.reset_after = reset_after
+        self._count = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._trial or time.monotonic() - self._opened_at < self.reset_after:
+                return False
+            self._trial = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logging.info("Database is reachable again, closing the circuit")
+            self._count = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._count += 1
+            if self._trial or self._count >= self.failures:
+                if self._opened_at is None:
+                    logging.error("Database unavailable, failing fast for %.0f s", self.reset_after)
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+
+_breaker = _CircuitBreaker(DB_BREAKER_FAILURES, DB_BREAKER_RESET_SECONDS)
+
+
+def database_available() -> bool:
+    """Return ``False`` while the circuit breaker fails database calls fast."""
+    return not _breaker.is_open
+
+
+class _SQLitePool:
+    """One long-lived writer connection and a pool of reader connections.
+
+    SQLite allows a single writer at a time, so writes are serialized on a
+    lock instead of failing with "database is locked". In WAL mode readers
+    are not blocked by the writer and use their own connections.
+    """
+
+    def __init__(self, path: str, readers: int) -> None:
+        self.path = path
+        self.size = readers
+        self._writer = None
+        self._write_lock = threading.RLock()
+        self._readers: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            timeout=SQLITE_BUSY_TIMEOUT,
+            cached_statements=SQLITE_STATEMENT_CACHE,
+            # Connections are shared by the threads of asyncio.to_thread.
+            check_same_thread=False,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE:d}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        if readonly:
+            conn.execute("PRAGMA query_only=ON")
+        logging.info("Opened %s SQLite connection", "reader" if readonly else "writer")
+        return conn
+
+    @contextmanager
+    def writer(self):
+        with self._write_lock:
+            if self._writer is None:
+                self._writer = self._open(readonly=False)
+            try:
+                yield self._writer
+            finally:
+                # Never leave half of a failed write for the next caller.
+                if self._writer.in_transaction:
+                    self._writer.rollback()
+
+    @contextmanager
+    def reader(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._lock:
+                grow = self._opened < self.size
+                if grow:
+                    self._opened += 1
+            if grow:
+                conn = self._open(readonly=True)
+            else:
+                try:
+                    conn = self._readers.get(timeout=SQLITE_BUSY_TIMEOUT)
+                except queue.Empty:
+                    raise sqlite3.OperationalError("no free SQLite reader connection")
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._readers.put(conn)
+
+    def close(self) -> None:
+        with self._write_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+        while True:
+            try:
+                self._readers.get_nowait().close()
+            except queue.Empty:
+                break
+        with self._lock:
+            self._opened = 0
+
+
+_sqlite_pool = (
+    _SQLitePool(DB_NAME, SQLITE_READERS)
+    if DB_ENGINE == "sqlite" and SQLITE_PROFILE == "production"
+    else None
+)
+
+
+# Seconds a replica is behind the primary; 0 when it has replayed everything
+# it received.
+_REPLICA_LAG_QUERY = """
+    SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+class _Replica:
+    """Connection pool of one read replica and its last measured lag."""
+
+    def __init__(self, dsn: str) -> None:
+        self.dsn = dsn
+        self.pool: Optional[ThreadedConnectionPool] = None
+        # ``None`` means the replica could not be reached.
+        self.lag: Optional[float] = None
+        self.checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        with self._lock:
+            if self.pool is None:
+                self.pool = ThreadedConnectionPool(0, DB_REPLICA_POOL_SIZE, self.dsn)
+        conn = self.pool.getconn()
+        conn.set_session(readonly=True)
+        return conn
+
+    def checkin(self, conn) -> None:
+        if not conn.closed:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+        self.pool.putconn(conn, close=bool(conn.closed))
+
+    def mark_down(self, exc: Exception) -> None:
+        logging.warning("Read replica unavailable, using the primary: %s", exc)
+        self.lag = None
+        self.checked_at = time.monotonic()
+
+    def check(self) -> None:
+        self.checked_at = time.monotonic()
+        try:
+            conn = self.checkout()
+        except psycopg2.Error as exc:
+            self.mark_down(exc)
+            return
+        try:
+            cur = conn.cursor()
+            cur.execute(_REPLICA_LAG_QUERY)
+            self.lag = float(cur.fetchone()[0])
+        except psycopg2.Error as exc:
+            self.mark_down(exc)
+        finally:
+            self.checkin(conn)
+        if self.lag is not None and self.lag > DB_REPLICA_MAX_LAG:
+            logging.warning("Read replica lags %.1f s behind, skipping it", self.lag)
+
+    def usable(self) -> bool:
+        if time.monotonic() - self.checked_at >= DB_REPLICA_CHECK_INTERVAL:
+            self.check()
+        return self.lag is not None and self.lag <= DB_REPLICA_MAX_LAG
+
+    def close(self) -> None:
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
+
+
+_replicas = [_Replica(dsn) for dsn in DB_REPLICAS] if DB_ENGINE == "postgres" else []
+_replica_turn = itertools.count()
+# Time of the last loan change of each user, for read-your-writes.
+_user_writes: Dict[int, float] = {}
+# Telegram id of the user whose update is being handled, see :func:`set_reader`.
+_reader: ContextVar[Optional[int]] = ContextVar("db_reader", default=None)
+
+
+def set_reader(user_id: Optional[int]) -> None:
+    """Attribute the reads of the current context to ``user_id``.
+
+    Worker threads started with :func:`asyncio.to_thread` and tasks created
+    afterwards inherit the reader.
+    """
+    _reader.set(user_id)
+
+
+def _note_write(user_id: int) -> None:
+    """Remember that ``user_id`` has just taken, returned or received a book."""
+    if not _replicas:
+        return
+    now = time.monotonic()
+    _user_writes[user_id] = now
+    if len(_user_writes) > 1000:
+        for uid, at in list(_user_writes.items()):
+            if now - at >= DB_REPLICA_MAX_LAG:
+                _user_writes.pop(uid, None)
+
+
+def _pick_replica() -> Optional[_Replica]:
+    """Return the next usable replica, or ``None`` to read from the primary.
+
+    For ``DB_REPLICA_MAX_LAG`` seconds after a user takes or returns a book
+    the reads made for that user go to the primary, so they see the change
+    even on a replica that is still catching up. Other users keep reading
+    from the replicas.
+    """
+    if not _replicas:
+        return None
+    user_id = _reader.get()
+    if (
+        user_id is not None
+        and time.monotonic() - _user_writes.get(user_id, float("-inf")) < DB_REPLICA_MAX_LAG
+    ):
+        return None
+    start = next(_replica_turn)
+    for i in range(len(_replicas)):
+        replica = _replicas[(start + i) % len(_replicas)]
+        if replica.usable():
+            return replica
+    return None
+
+
+def _pg_connect_args() -> dict:
+    return {
+        "dbname": DB_NAME,
+        "user": DB_USER,
+        "password": DB_PASSWORD,
+        "host": DB_HOST,
+        "port": DB_PORT,
+        "connect_timeout": DB_CONNECT_TIMEOUT,
+        "options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS:d}",
+    }
+
+
+def _connect():
+    if DB_ENGINE == "sqlite":
+        return sqlite3.connect(_scope() or DB_NAME, detect_types=sqlite3.PARSE_DECLTYPES)
+    return psycopg2.connect(**_pg_connect_args())
+
+
+def _use_schema(conn, pooled: bool = False) -> None:
+    """Point a Postgres connection at the tables of the current tenant.
+
+    Pooled connections may come from another tenant, so they are always
+    reset; a fresh connection only needs it for a tenant.
+    """
+    schema = _scope()
+    if DB_ENGINE != "postgres" or not (schema or pooled):
+        return
+    cur = conn.cursor()
+    if schema:
+        cur.execute("SET search_path TO %s, public", (schema,))
+    else:
+        cur.execute("SET search_path TO DEFAULT")
+
+
+class _PrimaryPool:
+    """Postgres primary connections shared by every tenant of the process."""
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.pool: Optional[ThreadedConnectionPool] = None
+        # ``getconn`` fails instead of waiting when the pool is exhausted.
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+
+    def checkout(self):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                if self.pool is None:
+                    self.pool = ThreadedConnectionPool(0, self.size, **_pg_connect_args())
+            return self.pool.getconn()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def checkin(self, conn) -> None:
+        try:
+            if not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    pass
+            self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self._slots.release()
+
+    def close(self) -> None:
+        with self._lock:
+            if self.pool is not None:
+                self.pool.closeall()
+                self.pool = None
+
+
+_primary_pool: Optional[_PrimaryPool] = None
+
+
+def use_shared_pool(size: int = DB_POOL_SIZE) -> None:
+    """Serve primary connections from one pool instead of one per call.
+
+    Used by the multi-tenant runner, where many mostly idle bots share the
+    database server. Only affects Postgres.
+    """
+    global _primary_pool
+    if DB_ENGINE == "postgres" and _primary_pool is None:
+        _primary_pool = _PrimaryPool(size)
+
 
 @contextmanager
-def get_conn():
-    """Return a database connection context manager."""
-    logging.info("Opening %s database connection", DB_ENGINE)
+def get_conn(readonly: bool = False):
+    """Return a database connection context manager.
+
+    Inside :func:`transaction` the connection of the transaction is reused.
+    ``readonly`` marks callers that only read, which may then be served by a
+    reader connection or a read replica. :exc:`DatabaseUnavailable` is raised
+    when the primary cannot be reached, immediately while the circuit
+    breaker is open.
+    """
+    tx = _transaction.get()
+    if tx is not None:
+        yield tx
+        return
+    if _sqlite_pool is not None:
+        with _sqlite_pool.reader() if readonly else _sqlite_pool.writer() as conn:
+            yield conn
+        return
+    replica = _pick_replica() if readonly else None
+    if replica is not None:
+        try:
+            conn = replica.checkout()
+        except psycopg2.Error as exc:
+            replica.mark_down(exc)
+        else:
+            try:
+                # Replica connections are shared by tenants only in the runner.
+                _use_schema(conn, pooled=_primary_pool is not None)
+                yield conn
+            except psycopg2.OperationalError as exc:
+                replica.mark_down(exc)
+                raise
+            finally:
+                replica.checkin(conn)
+            return
+    if not _breaker.allow():
+        raise DatabaseUnavailable("database circuit is open")
+    pool = _primary_pool
+    if pool is None:
+        logging.info("Opening %s database connection", DB_ENGINE)
     conn = None
     try:
-        if DB_ENGINE == "sqlite":
-            conn = sqlite3.connect(DB_NAME)
-        else:
-            conn = psycopg2.connect(
-                dbname=DB_NAME,
-                user=DB_USER,
-                password=DB_PASSWORD,
-                host=DB_HOST,
-                port=DB_PORT,
-            )
-        logging.info("Database connection established")
-        yield conn
+        try:
+            conn = pool.checkout() if pool is not None else _connect()
+            _use_schema(conn, pooled=pool is not None)
+        except (sqlite3.OperationalError, psycopg2.OperationalError) as exc:
+            _breaker.record_failure()
+            raise DatabaseUnavailable(str(exc)) from exc
+        _breaker.record_success()
+        if pool is None:
+            logging.info("Database connection established")
+        try:
+            yield conn
+        except psycopg2.OperationalError as exc:
+            # Lost connection or statement timeout on the server.
+            _breaker.record_failure()
+            raise DatabaseUnavailable(str(exc)) from exc
     except Exception as exc:
         logging.error("Database connection error: %s", exc)
         raise
     finally:
-        if conn:
+        if conn is not None and pool is not None:
+            pool.checkin(conn)
+        elif conn:
             conn.close()
             logging.info("Database connection closed")
 
 
+def close_connections() -> None:
+    """Close pooled connections: SQLite production profile, shared pool and replicas."""
+    if _sqlite_pool is not None:
+        _sqlite_pool.close()
+    if _primary_pool is not None:
+        _primary_pool.close()
+    for replica in _replicas:
+        replica.close()
+
+
+@contextmanager
+def transaction():
+    """Run the enclosed database calls on one connection with a single commit.
+
+    Usage::
+
+        with db.transaction():
+            user = db.get_user(user_id)
+            if user:
+                db.delete_user(user_id)
+
+    Everything is rolled back if the block raises. A nested ``transaction``
+    joins the outer one.
+    """
+    if _transaction.get() is not None:
+        yield
+        return
+    with get_conn() as conn:
+        tx = _Transaction(conn)
+        token = _transaction.set(tx)
+        try:
+            yield
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+        finally:
+            _transaction.reset(token)
+    _bump_version(*tx.bumped)
+
+
+# ``UPDATE ... RETURNING`` in take and return needs SQLite 3.35.
+SQLITE_MIN_VERSION = (3, 35, 0)
+
+
 def init_db() -> None:
-    """Create required tables if they do not exist."""
+    """Create required tables if they do not exist.
+
+    Raise ``RuntimeError`` if the SQLite library is older than
+    ``SQLITE_MIN_VERSION``.
+    """
+    if DB_ENGINE == "sqlite" and sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+        raise RuntimeError(
+            f"SQLite {sqlite3.sqlite_version} is too old, "
+            f"DB_ENGINE=sqlite needs {'.'.join(map(str, SQLITE_MIN_VERSION))} or newer"
+        )
     with get_conn() as conn:
         cur = conn.cursor()
-        id_column = (
-            "INTEGER PRIMARY KEY AUTOINCREMENT"
-            if DB_ENGINE == "sqlite"
-            else "SERIAL PRIMARY KEY"
-        )
-        cur.execute(
-            f"""
-            CREATE TABLE IF NOT EXISTS messages (
-                id {id_column},
-                user_id BIGINT,
-                text TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-            """
-        )
+        schema = _scope()
+        if DB_ENGINE == "postgres" and schema:
+            cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {}").format(sql.Identifier(schema)))
+        id_column = _dialect.id_column
+        timestamp_type = _dialect.timestamp_type
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS users (
@@ -98,226 +822,1853 @@ def init_db() -> None:
                 title TEXT,
                 status TEXT,
                 taken_by BIGINT,
-                taken_date TEXT,
+                taken_date DATE,
                 office TEXT
             )
             """
         )
-        conn.commit()
+        _migrate_temporal_columns(cur)
+        _create_message_log(cur)
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_books_office_taken_date
+            ON books (office, taken_date) WHERE status = 'taken'
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_books_taken_date
+            ON books (taken_date) WHERE status = 'taken'
+            """
+        )
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS overdue_reminders (
+                qr_code TEXT,
+                user_id BIGINT,
+                taken_date DATE,
+                sent_at {timestamp_type},
+                PRIMARY KEY (qr_code, user_id, taken_date)
+            )
+            """
+        )
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS loans (
+                id {id_column},
+                qr_code TEXT,
+                user_id BIGINT,
+                office TEXT,
+                event TEXT,
+                taken_at {timestamp_type},
+                created_at {timestamp_type} DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_loans_qr_taken_at ON loans (qr_code, taken_at)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_loans_user_taken_at ON loans (user_id, taken_at)"
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS idx_books_office ON books (office)")
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS office_stats (
+                office TEXT PRIMARY KEY,
+                total INTEGER DEFAULT 0,
+                available INTEGER DEFAULT 0,
+                taken INTEGER DEFAULT 0,
+                overdue INTEGER DEFAULT 0,
+                reconciled_at {timestamp_type},
+                overdue_cutoff DATE
+            )
+            """
+        )
+        _add_column(cur, "office_stats", "overdue_cutoff", "DATE")
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_state (
+                kind TEXT,
+                key TEXT,
+                value TEXT,
+                PRIMARY KEY (kind, key)
+            )
+            """
+        )
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS reservations (
+                id {id_column},
+                qr_code TEXT NOT NULL,
+                user_id BIGINT NOT NULL,
+                created_at {timestamp_type} DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (qr_code, user_id)
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_reservations_qr_created
+            ON reservations (qr_code, created_at)
+            """
+        )
+        _create_search_index(cur)
+        _reconcile_office_stats(cur)
+        conn.commit()
+
+
+def _create_search_index(cur) -> None:
+    """Create the title search index and keep it in sync with ``books``.
+
+    SQLite uses an FTS5 table over ``books`` maintained by triggers, so every
+    ``save_book`` updates it. Postgres uses a generated ``tsvector`` column
+    with Russian stemming plus a ``pg_trgm`` index for fuzzy matches; the
+    same extension indexes message text for substring searches of the log.
+    """
+    global _HAS_TRGM
+    if DB_ENGINE == "sqlite":
+        cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'books_fts'")
+        exists = cur.fetchone() is not None
+        cur.execute(
+            """
+            CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+                title, content='books', tokenize='unicode61 remove_diacritics 2'
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS books_fts_insert AFTER INSERT ON books BEGIN
+                INSERT INTO books_fts (rowid, title) VALUES (new.rowid, new.title);
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS books_fts_delete AFTER DELETE ON books BEGIN
+                INSERT INTO books_fts (books_fts, rowid, title)
+                VALUES ('delete', old.rowid, old.title);
+            END
+            """
+        )
+        cur.execute(
+            """
+            CREATE TRIGGER IF NOT EXISTS books_fts_update AFTER UPDATE OF title ON books BEGIN
+                INSERT INTO books_fts (books_fts, rowid, title)
+                VALUES ('delete', old.rowid, old.title);
+                INSERT INTO books_fts (rowid, title) VALUES (new.rowid, new.title);
+            END
+            """
+        )
+        if not exists:
+            cur.execute("INSERT INTO books_fts (books_fts) VALUES ('rebuild')")
+        return
+
+    cur.execute(
+        """
+        ALTER TABLE books ADD COLUMN IF NOT EXISTS title_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('russian', coalesce(title, ''))) STORED
+        """
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_books_title_tsv ON books USING GIN (title_tsv)"
+    )
+    # pg_trgm may not be installable with the bot's privileges; search then
+    # falls back to full-text matches only.
+    cur.execute("SAVEPOINT trgm")
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_books_title_trgm ON books USING GIN (title gin_trgm_ops)"
+        )
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS idx_messages_text_trgm ON messages USING GIN (text gin_trgm_ops)"
+        )
+        cur.execute("RELEASE SAVEPOINT trgm")
+        _HAS_TRGM = True
+    except psycopg2.Error as exc:
+        cur.execute("ROLLBACK TO SAVEPOINT trgm")
+        logging.warning("pg_trgm unavailable, fuzzy search disabled: %s", exc)
+        _HAS_TRGM = False
+
+
+def _add_column(cur, table: str, column: str, definition: str) -> None:
+    """Add ``column`` to a table created by an older version."""
+    if DB_ENGINE == "sqlite":
+        cur.execute(f"PRAGMA table_info({table})")
+        if column not in {row[1] for row in cur.fetchall()}:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    else:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {definition}")
+
+
+def _migrate_temporal_columns(cur) -> None:
+    """Convert ``books.taken_date`` and ``messages.created_at`` to typed columns.
+
+    Older databases stored ``taken_date`` as TEXT and ``created_at`` as a
+    timestamp without time zone.
+    """
+    if DB_ENGINE == "sqlite":
+        cur.execute("PRAGMA table_info(books)")
+        types = {row[1]: row[2].upper() for row in cur.fetchall()}
+        if types.get("taken_date") == "DATE":
+            return
+        # SQLite cannot change a column type in place, so rebuild the table.
+        cur.execute("ALTER TABLE books RENAME TO books_old")
+        cur.execute(
+            """
+            CREATE TABLE books (
+                qr_code TEXT PRIMARY KEY,
+                title TEXT,
+                status TEXT,
+                taken_by BIGINT,
+                taken_date DATE,
+                office TEXT
+            )
+            """
+        )
+        cur.execute(
+            """
+            INSERT INTO books (qr_code, title, status, taken_by, taken_date, office)
+            SELECT qr_code, title, status, taken_by, NULLIF(taken_date, ''), office
+            FROM books_old
+            """
+        )
+        cur.execute("DROP TABLE books_old")
+        return
+
+    cur.execute(
+        """
+        SELECT table_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema()
+            AND ((table_name = 'books' AND column_name = 'taken_date')
+                OR (table_name = 'messages' AND column_name = 'created_at'))
+        """
+    )
+    types = dict(cur.fetchall())
+    if types.get("books") == "text":
+        cur.execute(
+            """
+            ALTER TABLE books ALTER COLUMN taken_date TYPE DATE
+            USING NULLIF(taken_date, '')::date
+            """
+        )
+    if types.get("messages") == "timestamp without time zone":
+        cur.execute("ALTER TABLE messages ALTER COLUMN created_at TYPE TIMESTAMPTZ")
+
+
+# The message log is split by calendar month (UTC) so that old messages
+# go away by dropping a whole partition instead of deleting row by row.
+# Postgres partitions ``messages`` natively into ``messages_pYYYYMM`` tables
+# plus ``messages_default`` for rows outside them. SQLite writes to rolling
+# ``messages_YYYYMM`` tables and ``messages`` is a view over all of them.
+_MESSAGE_MONTH_RE = re.compile(r"^messages_p?(\d{4})(\d{2})$")
+
+# (scope, table) pairs of SQLite month tables known to exist.
+_message_tables: Set[Tuple[Optional[str], str]] = set()
+
+
+def _month_start(moment: datetime) -> datetime:
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def _next_month(month: datetime) -> datetime:
+    return _month_start(month + timedelta(days=32))
+
+
+def _message_month(table: str) -> Optional[datetime]:
+    """Return the month stored in the partition or month table ``table``."""
+    match = _MESSAGE_MONTH_RE.match(table)
+    if not match:
+        return None
+    return datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+
+
+def _message_retention_cutoff() -> Optional[datetime]:
+    if config.MESSAGE_RETENTION_DAYS <= 0:
+        return None
+    return datetime.now(timezone.utc) - timedelta(days=config.MESSAGE_RETENTION_DAYS)
+
+
+def _create_message_log(cur) -> None:
+    """Create the partitioned message log, converting a plain ``messages`` table.
+
+    Messages of an old table that are past ``MESSAGE_RETENTION_DAYS`` are not
+    carried over.
+    """
+    if DB_ENGINE == "sqlite":
+        cur.execute("SELECT type FROM sqlite_master WHERE name = 'messages'")
+        row = cur.fetchone()
+        if row and row[0] == "table":
+            # Kept readable through the view and emptied by the purge.
+            cur.execute("ALTER TABLE messages RENAME TO messages_legacy")
+            cur.execute("DROP INDEX IF EXISTS idx_messages_created_at")
+        _sqlite_message_table(cur, datetime.now(timezone.utc), refresh=True)
+        for table in _sqlite_message_tables(cur):
+            _index_message_table(cur, table)
+        return
+
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('messages')")
+    row = cur.fetchone()
+    legacy = row is not None and row[0] != "p"
+    if legacy:
+        cur.execute("ALTER TABLE messages RENAME TO messages_legacy")
+        cur.execute("DROP INDEX IF EXISTS idx_messages_created_at")
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages (
+            id BIGSERIAL,
+            user_id BIGINT,
+            text TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP
+        ) PARTITION BY RANGE (created_at)
+        """
+    )
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_created_at ON messages (created_at)")
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_created ON messages (user_id, created_at)"
+    )
+    cur.execute("CREATE TABLE IF NOT EXISTS messages_default PARTITION OF messages DEFAULT")
+    if not legacy:
+        _ensure_message_partitions(cur)
+        return
+    cutoff = _message_retention_cutoff() or datetime(1970, 1, 1, tzinfo=timezone.utc)
+    cur.execute(
+        """
+        SELECT DISTINCT date_trunc('month', COALESCE(created_at, now()) AT TIME ZONE 'UTC')
+        FROM messages_legacy WHERE COALESCE(created_at, now()) >= %s
+        """,
+        (cutoff,),
+    )
+    months = [month.replace(tzinfo=timezone.utc) for (month,) in cur.fetchall()]
+    _ensure_message_partitions(cur, months)
+    cur.execute(
+        """
+        INSERT INTO messages (user_id, text, created_at)
+        SELECT user_id, text, COALESCE(created_at, now()) FROM messages_legacy
+        WHERE COALESCE(created_at, now()) >= %s ORDER BY id
+        """,
+        (cutoff,),
+    )
+    cur.execute("DROP TABLE messages_legacy")
+
+
+def _ensure_message_partitions(cur, months=()) -> None:
+    """Create the Postgres partitions of this month, the next one and ``months``."""
+    current = _month_start(datetime.now(timezone.utc))
+    for month in sorted({current, _next_month(current), *months}):
+        name = f"messages_p{month:%Y%m}"
+        cur.execute("SAVEPOINT message_partition")
+        try:
+            cur.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF messages "
+                    "FOR VALUES FROM (%s) TO (%s)"
+                ).format(sql.Identifier(name)),
+                (month, _next_month(month)),
+            )
+        except psycopg2.Error as exc:
+            # Rows of that month already sit in ``messages_default``.
+            cur.execute("ROLLBACK TO SAVEPOINT message_partition")
+            logging.warning("Cannot create message partition %s: %s", name, exc)
+        else:
+            cur.execute("RELEASE SAVEPOINT message_partition")
+
+
+def ensure_message_partitions() -> None:
+    """Create the message partitions of the current and next month ahead of use."""
+    if DB_ENGINE != "postgres":
+        return
+    with get_conn() as conn:
+        _ensure_message_partitions(conn.cursor())
+        conn.commit()
+
+
+def _sqlite_message_tables(cur) -> list:
+    """Return the SQLite tables behind the ``messages`` view, oldest first."""
+    cur.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'messages\\_%' ESCAPE '\\'"
+    )
+    names = [name for (name,) in cur.fetchall()]
+    months = sorted(name for name in names if _message_month(name))
+    return (["messages_legacy"] if "messages_legacy" in names else []) + months
+
+
+def _refresh_message_view(cur) -> None:
+    tables = _sqlite_message_tables(cur)
+    cur.execute("DROP VIEW IF EXISTS messages")
+    cur.execute(
+        "CREATE VIEW IF NOT EXISTS messages AS "
+        + " UNION ALL ".join(
+            f"SELECT id, user_id, text, created_at FROM {table}" for table in tables
+        )
+    )
+
+
+def _index_message_table(cur, table: str) -> None:
+    """Create the search indexes of an SQLite month table or the legacy table.
+
+    Text is indexed by an FTS5 table with the trigram tokenizer, which
+    answers substring queries; without it (SQLite before 3.34) searches scan
+    the month tables selected by the time range.
+    """
+    cur.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_created_at ON {table} (created_at)")
+    cur.execute(
+        f"CREATE INDEX IF NOT EXISTS idx_{table}_user_created ON {table} (user_id, created_at)"
+    )
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (f"{table}_fts",))
+    if cur.fetchone() is not None:
+        return
+    try:
+        cur.execute(
+            f"""
+            CREATE VIRTUAL TABLE {table}_fts USING fts5(
+                text, content='{table}', content_rowid='id', tokenize='trigram'
+            )
+            """
+        )
+    except sqlite3.OperationalError as exc:
+        logging.warning("Message text index unavailable for %s: %s", table, exc)
+        return
+    cur.execute(
+        f"""
+        CREATE TRIGGER {table}_fts_insert AFTER INSERT ON {table} BEGIN
+            INSERT INTO {table}_fts (rowid, text) VALUES (new.id, new.text);
+        END
+        """
+    )
+    cur.execute(
+        f"""
+        CREATE TRIGGER {table}_fts_delete AFTER DELETE ON {table} BEGIN
+            INSERT INTO {table}_fts ({table}_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        END
+        """
+    )
+    cur.execute(f"INSERT INTO {table}_fts ({table}_fts) VALUES ('rebuild')")
+
+
+def _sqlite_message_table(cur, moment: datetime, refresh: bool = False) -> str:
+    """Return the SQLite month table for ``moment``, creating it if needed."""
+    table = f"messages_{moment:%Y%m}"
+    key = (_scope(), table)
+    if key in _message_tables and not refresh:
+        return table
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+    if cur.fetchone() is None or refresh:
+        cur.execute(
+            f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id BIGINT,
+                text TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+            """
+        )
+        _index_message_table(cur, table)
+        _refresh_message_view(cur)
+    _message_tables.add(key)
+    return table
+
+
+def save_message(user_id: int, text: str) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if DB_ENGINE == "sqlite":
+            table = _sqlite_message_table(cur, datetime.now(timezone.utc))
+            cur.execute(f"INSERT INTO {table} (user_id, text) VALUES (?, ?)", (user_id, text))
+        else:
+            cur.execute("INSERT INTO messages (user_id, text) VALUES (%s, %s)", (user_id, text))
+        conn.commit()
+
+
+def purge_messages(before: datetime, batch_size: int) -> bool:
+    """Remove one batch of the log messages created before ``before``.
+
+    A partition or month table lying entirely before ``before`` is dropped
+    at once; otherwise at most ``batch_size`` rows are deleted, so each call
+    holds its locks only briefly. Return ``False`` once nothing is left.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        if DB_ENGINE == "sqlite":
+            removed = _purge_sqlite_messages(cur, before, batch_size)
+        else:
+            removed = _purge_pg_messages(cur, before, batch_size)
+        conn.commit()
+    return removed
+
+
+def _purge_sqlite_messages(cur, before: datetime, batch_size: int) -> bool:
+    for table in _sqlite_message_tables(cur):
+        month = _message_month(table)
+        if month is not None and _next_month(month) <= before:
+            cur.execute(f"DROP TABLE IF EXISTS {table}_fts")
+            cur.execute(f"DROP TABLE {table}")
+            _message_tables.discard((_scope(), table))
+            _refresh_message_view(cur)
+            return True
+        cur.execute(
+            f"""
+            DELETE FROM {table} WHERE rowid IN (
+                SELECT rowid FROM {table} WHERE created_at < ? LIMIT ?
+            )
+            """,
+            (before, batch_size),
+        )
+        if cur.rowcount:
+            return True
+        if month is None:
+            cur.execute("SELECT 1 FROM messages_legacy LIMIT 1")
+            if cur.fetchone() is None:
+                cur.execute("DROP TABLE IF EXISTS messages_legacy_fts")
+                cur.execute("DROP TABLE messages_legacy")
+                _refresh_message_view(cur)
+                return True
+    return False
+
+
+def _purge_pg_messages(cur, before: datetime, batch_size: int) -> bool:
+    cur.execute(
+        """
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'messages'::regclass
+        """
+    )
+    for (table,) in sorted(cur.fetchall()):
+        month = _message_month(table)
+        if month is not None and _next_month(month) <= before:
+            # Takes a short exclusive lock on ``messages``, not a long delete.
+            cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(table)))
+            return True
+    cur.execute(
+        """
+        DELETE FROM messages WHERE created_at < %s AND id IN (
+            SELECT id FROM messages WHERE created_at < %s ORDER BY created_at LIMIT %s
+        )
+        """,
+        (before, before, batch_size),
+    )
+    return cur.rowcount > 0
+
+
+def _like_pattern(text: str) -> str:
+    """Return a LIKE pattern matching ``text`` anywhere, with ``\\`` as escape."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+def search_messages(
+    user_id: Optional[int] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    text: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0,
+):
+    """Return logged messages matching every given filter, newest first.
+
+    ``since`` is inclusive and ``until`` exclusive; ``text`` matches a
+    substring regardless of case. The time range selects the partitions to
+    read, ``user_id`` uses the ``(user_id, created_at)`` indexes and ``text``
+    the trigram indexes where available.
+    """
+    with get_conn(readonly=True) as conn:
+        if DB_ENGINE == "sqlite":
+            return _search_sqlite_messages(conn, user_id, since, until, text, limit, offset)
+        cur = _record_cursor(conn, LoggedMessage)
+        where, params = ["TRUE"], []
+        if user_id is not None:
+            where.append("user_id = %s")
+            params.append(user_id)
+        if since is not None:
+            where.append("created_at >= %s")
+            params.append(since)
+        if until is not None:
+            where.append("created_at < %s")
+            params.append(until)
+        if text:
+            where.append("text ILIKE %s")
+            params.append(_like_pattern(text))
+        cur.execute(
+            f"""
+            SELECT user_id, text, created_at FROM messages
+            WHERE {" AND ".join(where)}
+            ORDER BY created_at DESC LIMIT %s OFFSET %s
+            """,
+            (*params, limit, offset),
+        )
+        return cur.fetchall()
+
+
+def _search_sqlite_messages(conn, user_id, since, until, text, limit, offset):
+    cur = conn.cursor()
+    tables = _sqlite_message_tables(cur)
+    cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    names = {name for (name,) in cur.fetchall()}
+    selects, params = [], []
+    for table in tables:
+        month = _message_month(table)
+        if month is not None and (
+            (since is not None and _next_month(month) <= since)
+            or (until is not None and month >= until)
+        ):
+            continue
+        where = ["1"]
+        if user_id is not None:
+            where.append("user_id = ?")
+            params.append(user_id)
+        if since is not None:
+            where.append("created_at >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("created_at < ?")
+            params.append(until)
+        if text and len(text) >= 3 and f"{table}_fts" in names:
+            # Trigrams need at least three characters.
+            where.append(f"id IN (SELECT rowid FROM {table}_fts WHERE {table}_fts MATCH ?)")
+            params.append('"' + text.replace('"', '""') + '"')
+        elif text:
+            where.append("text LIKE ? ESCAPE '\\'")
+            params.append(_like_pattern(text))
+        selects.append(
+            f"SELECT user_id, text, created_at FROM {table} WHERE {' AND '.join(where)}"
+        )
+    if not selects:
+        return []
+    cur = _record_cursor(conn, LoggedMessage)
+    cur.execute(
+        " UNION ALL ".join(selects) + " ORDER BY created_at DESC LIMIT ? OFFSET ?",
+        (*params, limit, offset),
+    )
+    return cur.fetchall()
+
+
+def get_user(telegram_id: int):
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, User)
+        placeholder = _dialect.param
+        cur.execute(
+            f"SELECT telegram_id, first_name, last_name, office, role FROM users WHERE telegram_id = {placeholder}",
+            (telegram_id,),
+        )
+        row = cur.fetchone()
+    return row
+
+
+def get_user_by_name(first_name: str, last_name: str, office: str):
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, User)
+        placeholder = _dialect.param
+        cur.execute(
+            f"SELECT telegram_id, first_name, last_name, office, role FROM users WHERE first_name = {placeholder} AND last_name = {placeholder} AND office = {placeholder}",
+            (first_name, last_name, office),
+        )
+        row = cur.fetchone()
+    return row
+
+
+def save_user(user: dict) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        cur.execute(
+            f"""
+            INSERT INTO users (telegram_id, first_name, last_name, office, role)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                first_name=excluded.first_name,
+                last_name=excluded.last_name,
+                office=excluded.office,
+                role=excluded.role
+            """,
+            (
+                user.get("telegram_id"),
+                user.get("first_name"),
+                user.get("last_name"),
+                user.get("office"),
+                user.get("role"),
+            ),
+        )
+        conn.commit()
+    _bump_version(None)
+
+
+def update_user_office(telegram_id: int, office: str, role: str) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        cur.execute(
+            f"UPDATE users SET office = {placeholder}, role = {placeholder} WHERE telegram_id = {placeholder}",
+            (office, role, telegram_id),
+        )
+        conn.commit()
+    _bump_version(None)
+
+
+def delete_user(telegram_id: int) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        cur.execute(
+            f"DELETE FROM users WHERE telegram_id = {placeholder}",
+            (telegram_id,),
+        )
+        cur.execute(
+            f"DELETE FROM reservations WHERE user_id = {placeholder}",
+            (telegram_id,),
+        )
+        conn.commit()
+    _bump_version(None)
+
+
+def get_all_users():
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, User)
+        cur.execute(
+            "SELECT telegram_id, first_name, last_name, office, role FROM users"
+        )
+        rows = cur.fetchall()
+    return rows
+
+
+def get_book_by_qr(qr: str):
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, Book)
+        placeholder = _dialect.param
+        cur.execute(
+            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE qr_code = {placeholder}",
+            (qr,),
+        )
+        row = cur.fetchone()
+    return row
+
+
+def overdue_cutoff() -> date:
+    """Return the take date before which a loan counts as overdue."""
+    return datetime.now(timezone.utc).date() - timedelta(days=config.LOAN_PERIOD_DAYS)
+
+
+def _stats_key(status):
+    """Return ``(available, taken)`` contributions of one book."""
+    return (0, 1) if status == "taken" else (1, 0)
+
+
+def _bump_office_stats(
+    cur, office, total=0, available=0, taken=0, loan_date=None, loans=0
+) -> None:
+    """Apply counter deltas to ``office_stats`` in the current transaction.
+
+    ``loans`` (``1`` or ``-1``) adds or removes a loan taken on ``loan_date``.
+    It changes ``overdue`` only if the loan is older than the cutoff of the
+    last reconcile, so the counter keeps counting exactly the loans that
+    reconcile counted; loans that became overdue since wait for the next one.
+    """
+    if office is None or not (total or available or taken or loans):
+        return
+    placeholder = _dialect.param
+    # The first book of an office starts its counters with today's cutoff.
+    cutoff = overdue_cutoff()
+    overdue = loans if loan_date is not None and loan_date < cutoff else 0
+    cur.execute(
+        f"""
+        INSERT INTO office_stats (office, total, available, taken, overdue, overdue_cutoff)
+        VALUES ({", ".join([placeholder] * 6)})
+        ON CONFLICT(office) DO UPDATE SET
+            total=office_stats.total + excluded.total,
+            available=office_stats.available + excluded.available,
+            taken=office_stats.taken + excluded.taken,
+            overdue=office_stats.overdue + CASE
+                WHEN {placeholder} < office_stats.overdue_cutoff THEN {placeholder} ELSE 0 END
+        """,
+        (office, total, available, taken, overdue, cutoff, loan_date, loans),
+    )
+
+
+def _reconcile_office_stats(cur, offices=None) -> None:
+    """Recount ``office_stats`` from ``books`` for ``offices`` (all if ``None``).
+
+    The counters are maintained incrementally by every book write; this only
+    repairs drift and refreshes the time-dependent ``overdue`` counter, whose
+    cutoff is stored for :func:`_bump_office_stats`.
+    """
+    placeholder = _dialect.param
+    params = [overdue_cutoff()]
+    where = ""
+    if offices is not None:
+        offices = [o for o in offices if o is not None]
+        if not offices:
+            return
+        where = f" WHERE office IN ({', '.join([placeholder] * len(offices))})"
+        params.extend(offices)
+    cur.execute(
+        f"""
+        SELECT office, COUNT(*),
+            SUM(CASE WHEN status = 'taken' THEN 0 ELSE 1 END),
+            SUM(CASE WHEN status = 'taken' THEN 1 ELSE 0 END),
+            SUM(CASE WHEN status = 'taken' AND taken_date < {placeholder} THEN 1 ELSE 0 END)
+        FROM books{where}
+        GROUP BY office
+        """,
+        params,
+    )
+    rows = [r for r in cur.fetchall() if r[0] is not None]
+    cur.execute("DELETE FROM office_stats" + where, params[1:])
+    now = datetime.now(timezone.utc)
+    cur.executemany(
+        f"""
+        INSERT INTO office_stats
+            (office, total, available, taken, overdue, reconciled_at, overdue_cutoff)
+        VALUES ({", ".join([placeholder] * 7)})
+        """,
+        [tuple(r) + (now, params[0]) for r in rows],
+    )
+
+
+def save_book(book: dict) -> None:
+    with get_conn() as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        lock = _dialect.lock
+        cur.execute(
+            f"SELECT office, status, taken_date FROM books WHERE qr_code = {placeholder}"
+            + lock,
+            (book.get("qr_code"),),
+        )
+        old = cur.fetchone()
+        cur.execute(
+            f"""
+            INSERT INTO books (qr_code, title, status, taken_by, taken_date, office)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
+            ON CONFLICT(qr_code) DO UPDATE SET
+                title=excluded.title,
+                status=excluded.status,
+                taken_by=excluded.taken_by,
+                taken_date=excluded.taken_date,
+                office=excluded.office
+            """,
+            (
+                book.get("qr_code"),
+                book.get("title"),
+                book.get("status"),
+                book.get("taken_by"),
+                book.get("taken_date"),
+                book.get("office"),
+            ),
+        )
+        if old:
+            available, taken = _stats_key(old[1])
+            _bump_office_stats(cur, old[0], -1, -available, -taken, old[2], -taken)
+        available, taken = _stats_key(book.get("status"))
+        _bump_office_stats(
+            cur, book.get("office"), 1, available, taken, book.get("taken_date"), taken
+        )
+        conn.commit()
+    _bump_version(book.get("office"), *(old[:1] if old else ()))
+
+
+def _office_guard(cur, table: str, allowed_offices) -> str:
+    """Return the ``WHERE`` of an upsert updating only rows of ``allowed_offices``."""
+    if allowed_offices is None:
+        return ""
+    return " WHERE " + _dialect.in_list(cur, f"{table}.office", sorted(allowed_offices))
+
+
+# Most values bound in one ``IN (...)`` list. SQLite builds before 3.32 allow
+# only 999 parameters per statement, and import chunks can be larger.
+IN_LIST_CHUNK = 500
+
+
+def _select_in(cur, query: str, values) -> list:
+    """Return the rows of ``query`` (ending in ``IN``) for all ``values``.
+
+    The values are bound ``IN_LIST_CHUNK`` at a time.
+    """
+    values = list(values)
+    rows = []
+    for start in range(0, len(values), IN_LIST_CHUNK):
+        chunk = values[start:start + IN_LIST_CHUNK]
+        cur.execute(f"{query} ({', '.join([_dialect.param] * len(chunk))})", chunk)
+        rows.extend(cur.fetchall())
+    return rows
+
+
+def _foreign_rows(cur, table: str, key: str, keys, allowed_offices) -> set:
+    """Return the ``keys`` of existing rows whose office is not allowed."""
+    if allowed_offices is None or not keys:
+        return set()
+    rows = _select_in(cur, f"SELECT {key}, office FROM {table} WHERE {key} IN", keys)
+    return {k for k, office in rows if office not in allowed_offices}
+
+
+def import_books(books, allowed_offices=None) -> list:
+    """Insert or update many books in one transaction.
+
+    Existing books only get their title and office updated so imports never
+    touch loan state. With ``allowed_offices`` existing books of other
+    offices are left alone; their QR codes are returned.
+    """
+    books = list(books)
+    if not books:
+        return []
+    with get_conn() as conn:
+        cur = conn.cursor()
+        skipped = _foreign_rows(
+            cur, "books", "qr_code", [b["qr_code"] for b in books], allowed_offices
+        )
+        rows = list({
+            b["qr_code"]: (b["qr_code"], b["title"], "available", b["office"])
+            for b in books
+            if b["qr_code"] not in skipped
+        }.values())
+        if not rows:
+            return sorted(skipped)
+        existing = {
+            r[0]: r[1:]
+            for r in _select_in(
+                cur,
+                "SELECT qr_code, office, status, taken_date FROM books WHERE qr_code IN",
+                [r[0] for r in rows],
+            )
+        }
+        conflict = """
+            ON CONFLICT(qr_code) DO UPDATE SET
+                title=excluded.title,
+                office=excluded.office
+        """ + _office_guard(cur, "books", allowed_offices)
+        _dialect.insert_many(
+            cur, "INSERT INTO books (qr_code, title, status, office) VALUES", rows, conflict
+        )
+        # New books are available; moved books keep their loan state and
+        # change the counters of both offices.
+        added: Dict[str, int] = {}
+        offices = set()
+        for qr, _, _, office in rows:
+            old = existing.get(qr)
+            if old is None:
+                added[office] = added.get(office, 0) + 1
+            elif old[0] != office:
+                available, taken = _stats_key(old[1])
+                _bump_office_stats(cur, old[0], -1, -available, -taken, old[2], -taken)
+                _bump_office_stats(cur, office, 1, available, taken, old[2], taken)
+                offices.update((old[0], office))
+        for office, count in added.items():
+            _bump_office_stats(cur, office, count, count)
+        conn.commit()
+    # Existing books of unchanged offices may have new titles.
+    offices.update(r[3] for r in rows)
+    _bump_version(*offices)
+    return sorted(skipped)
+
+
+def import_users(users, allowed_offices=None) -> list:
+    """Insert or update many users in one transaction.
+
+    With ``allowed_offices`` existing users of other offices are left alone;
+    their Telegram IDs are returned.
+    """
+    users = list(users)
+    with get_conn() as conn:
+        cur = conn.cursor()
+        skipped = _foreign_rows(
+            cur, "users", "telegram_id", [u["telegram_id"] for u in users], allowed_offices
+        )
+        rows = [
+            (u["telegram_id"], u["first_name"], u["last_name"], u["office"], u["role"])
+            for u in users
+            if u["telegram_id"] not in skipped
+        ]
+        conflict = """
+            ON CONFLICT(telegram_id) DO UPDATE SET
+                first_name=excluded.first_name,
+                last_name=excluded.last_name,
+                office=excluded.office,
+                role=excluded.role
+        """ + _office_guard(cur, "users", allowed_offices)
+        _dialect.insert_many(
+            cur,
+            "INSERT INTO users (telegram_id, first_name, last_name, office, role) VALUES",
+            rows,
+            conflict,
+        )
+        conn.commit()
+    _bump_version(None)
+    return sorted(skipped)
+
+
+def iter_office_books(office: str, chunk_size: int = 1000):
+    """Yield book rows of ``office`` joined with borrower names.
+
+    Rows are ``(qr_code, title, status, taken_date, taken_by, first_name,
+    last_name)`` and are streamed ``chunk_size`` at a time: through a
+    server-side (named) cursor on Postgres and ``fetchmany`` on SQLite, so
+    memory use does not grow with the size of the office.
+    """
+    query = """
+        SELECT b.qr_code, b.title, b.status, b.taken_date, b.taken_by,
+            u.first_name, u.last_name
+        FROM books b LEFT JOIN users u ON u.telegram_id = b.taken_by
+        WHERE b.office = {placeholder}
+        ORDER BY b.title
+    """
+    with get_conn(readonly=True) as conn:
+        if DB_ENGINE == "sqlite":
+            cur = conn.cursor()
+            cur.execute(query.format(placeholder=_dialect.param), (office,))
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        else:
+            cur = conn.cursor(name="office_books_export")
+            cur.itersize = chunk_size
+            cur.execute(query.format(placeholder=_dialect.param), (office,))
+            yield from cur
+            cur.close()
+
+
+def get_user_books(user_id: int):
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, Book)
+        placeholder = _dialect.param
+        cur.execute(
+            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE taken_by = {placeholder} AND status = 'taken'",
+            (user_id,),
+        )
+        rows = cur.fetchall()
+    return rows
 
 
-def save_message(user_id: int, text: str) -> None:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+def get_books_by_office(office: str):
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, Book)
+        placeholder = _dialect.param
         cur.execute(
-            f"INSERT INTO messages (user_id, text) VALUES ({placeholder}, {placeholder})",
-            (user_id, text),
+            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE office = {placeholder}",
+            (office,),
         )
-        conn.commit()
-
+        rows = cur.fetchall()
+    return rows
 
-def delete_all_messages() -> None:
-    with get_conn() as conn:
-        cur = conn.cursor()
-        cur.execute("DELETE FROM messages")
-        conn.commit()
 
+def audit_office(office: str, codes) -> dict:
+    """Compare the QR ``codes`` scanned in ``office`` with its catalogue.
 
-def get_user(telegram_id: int):
-    with get_conn() as conn:
+    One query joins the scanned codes with ``books`` and adds the office
+    books that were not scanned. The result has ``found`` (count of office
+    books on the shelf), ``missing`` (available office books not scanned),
+    ``taken`` (scanned books recorded as taken), ``elsewhere`` (scanned books
+    of other offices), ``unexpected`` (scanned codes unknown to the library)
+    and ``on_loan`` (count of taken office books not scanned).
+    """
+    if DB_ENGINE == "sqlite":
+        scanned = "SELECT value AS qr_code FROM json_each(?)"
+        params = (json.dumps(sorted(codes)), office)
+    else:
+        scanned = "SELECT DISTINCT unnest(%s::text[]) AS qr_code"
+        params = (sorted(codes), office)
+    placeholder = _dialect.param
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
         cur.execute(
-            f"SELECT telegram_id, first_name, last_name, office, role FROM users WHERE telegram_id = {placeholder}",
-            (telegram_id,),
+            f"""
+            WITH scanned AS ({scanned})
+            SELECT s.qr_code, b.qr_code, b.title, b.status, b.taken_by, b.taken_date, b.office
+            FROM scanned s LEFT JOIN books b ON b.qr_code = s.qr_code
+            UNION ALL
+            SELECT NULL, b.qr_code, b.title, b.status, b.taken_by, b.taken_date, b.office
+            FROM books b
+            WHERE b.office = {placeholder} AND b.qr_code NOT IN (SELECT qr_code FROM scanned)
+            """,
+            params,
         )
-        row = cur.fetchone()
-    if not row:
-        return None
-    return {
-        "telegram_id": row[0],
-        "first_name": row[1],
-        "last_name": row[2],
-        "office": row[3],
-        "role": row[4],
+        rows = cur.fetchall()
+    return _audit_result(
+        office, [(row[0], Book(*row[1:]) if row[1] is not None else None) for row in rows]
+    )
+
+
+def _audit_result(office: str, matches) -> dict:
+    """Sort ``(scanned code or None, book or None)`` pairs into audit findings."""
+    result = {
+        "found": 0, "missing": [], "taken": [], "elsewhere": [], "unexpected": [], "on_loan": 0
     }
+    for code, book in matches:
+        if book is None:
+            result["unexpected"].append(code)
+        elif code is None:
+            if book["status"] == "taken":
+                result["on_loan"] += 1
+            else:
+                result["missing"].append(book)
+        elif book["office"] != office:
+            result["elsewhere"].append(book)
+        elif book["status"] == "taken":
+            result["taken"].append(book)
+        else:
+            result["found"] += 1
+    for key in ("missing", "taken", "elsewhere"):
+        result[key].sort(key=lambda b: (b["title"] or "", b["qr_code"]))
+    result["unexpected"].sort()
+    return result
 
 
-def get_user_by_name(first_name: str, last_name: str, office: str):
-    with get_conn() as conn:
-        cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+def get_office_books_page(office: str, limit: int, offset: int = 0):
+    """Return one page of ``office`` books ordered by title.
+
+    Each book also carries ``first_name`` and ``last_name`` of its borrower,
+    joined in the same query.
+    """
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, BookListing)
+        placeholder = _dialect.param
         cur.execute(
-            f"SELECT telegram_id, first_name, last_name, office, role FROM users WHERE first_name = {placeholder} AND last_name = {placeholder} AND office = {placeholder}",
-            (first_name, last_name, office),
+            f"""
+            SELECT b.qr_code, b.title, b.status, b.taken_by, b.taken_date, b.office,
+                u.first_name, u.last_name
+            FROM books b LEFT JOIN users u ON u.telegram_id = b.taken_by
+            WHERE b.office = {placeholder}
+            ORDER BY b.title, b.qr_code
+            LIMIT {placeholder} OFFSET {placeholder}
+            """,
+            (office, limit, offset),
         )
-        row = cur.fetchone()
-    if not row:
-        return None
-    return {
-        "telegram_id": row[0],
-        "first_name": row[1],
-        "last_name": row[2],
-        "office": row[3],
-        "role": row[4],
-    }
+        rows = cur.fetchall()
+    return rows
 
 
-def save_user(user: dict) -> None:
+def _log_loan_event(cur, qr: str, user_id: int, office: str, event: str, now: datetime) -> None:
+    """Append a take, return or reset event to ``loans``.
+
+    Return and reset events carry the ``taken_at`` of the take they close so
+    loan durations can be computed from single rows.
+    """
+    placeholder = _dialect.param
+    if event == "take":
+        cur.execute(
+            f"""
+            INSERT INTO loans (qr_code, user_id, office, event, taken_at, created_at)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, 'take', {placeholder}, {placeholder})
+            """,
+            (qr, user_id, office, now, now),
+        )
+        return
+    cur.execute(
+        f"""
+        INSERT INTO loans (qr_code, user_id, office, event, taken_at, created_at)
+        SELECT {placeholder}, {placeholder}, {placeholder}, {placeholder}, MAX(taken_at), {placeholder}
+        FROM loans
+        WHERE qr_code = {placeholder} AND user_id = {placeholder} AND event = 'take'
+        """,
+        (qr, user_id, office, event, now, qr, user_id),
+    )
+
+
+def take_book(qr: str, user_id: int, office: str, taken_date: date):
+    """Atomically mark an available book as taken by ``user_id``.
+
+    Return the book title, or ``None`` if the book is missing, belongs to
+    another office or is already taken. The take is recorded in ``loans``
+    and the user leaves the waitlist of the book in the same transaction.
+    """
     with get_conn() as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+        placeholder = _dialect.param
         cur.execute(
             f"""
-            INSERT INTO users (telegram_id, first_name, last_name, office, role)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-            ON CONFLICT(telegram_id) DO UPDATE SET
-                first_name=excluded.first_name,
-                last_name=excluded.last_name,
-                office=excluded.office,
-                role=excluded.role
+            UPDATE books SET status = 'taken', taken_by = {placeholder}, taken_date = {placeholder}
+            WHERE qr_code = {placeholder} AND office = {placeholder} AND status <> 'taken'
+            RETURNING title
             """,
-            (
-                user.get("telegram_id"),
-                user.get("first_name"),
-                user.get("last_name"),
-                user.get("office"),
-                user.get("role"),
-            ),
+            (user_id, taken_date, qr, office),
         )
+        rows = cur.fetchall()
+        if rows:
+            _log_loan_event(cur, qr, user_id, office, "take", datetime.now(timezone.utc))
+            _bump_office_stats(cur, office, available=-1, taken=1)
+            cur.execute(
+                f"DELETE FROM reservations WHERE qr_code = {placeholder} AND user_id = {placeholder}",
+                (qr, user_id),
+            )
         conn.commit()
+    if rows:
+        _bump_version(office)
+        _note_write(user_id)
+    return rows[0][0] if rows else None
 
 
-def update_user_office(telegram_id: int, office: str, role: str) -> None:
+def return_book(qr: str, user_id: int, office: str):
+    """Atomically return a book held by ``user_id``.
+
+    Return the book title, or ``None`` if the user does not hold the book.
+    """
     with get_conn() as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+        placeholder = _dialect.param
         cur.execute(
-            f"UPDATE users SET office = {placeholder}, role = {placeholder} WHERE telegram_id = {placeholder}",
-            (office, role, telegram_id),
+            f"SELECT taken_date FROM books WHERE qr_code = {placeholder}", (qr,)
+        )
+        row = cur.fetchone()
+        cur.execute(
+            f"""
+            UPDATE books SET status = 'available', taken_by = NULL, taken_date = NULL
+            WHERE qr_code = {placeholder} AND taken_by = {placeholder}
+                AND office = {placeholder} AND status = 'taken'
+            RETURNING title
+            """,
+            (qr, user_id, office),
         )
+        rows = cur.fetchall()
+        if rows:
+            _log_loan_event(cur, qr, user_id, office, "return", datetime.now(timezone.utc))
+            _bump_office_stats(cur, office, available=1, taken=-1, loan_date=row[0], loans=-1)
         conn.commit()
+    if rows:
+        _bump_version(office)
+        _note_write(user_id)
+    return rows[0][0] if rows else None
 
 
-def delete_user(telegram_id: int) -> None:
+def reserve_book(qr: str, user_id: int) -> int:
+    """Put ``user_id`` on the waitlist of a book and return their place in it.
+
+    Joining a waitlist twice keeps the original place.
+    """
     with get_conn() as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+        placeholder = _dialect.param
         cur.execute(
-            f"DELETE FROM users WHERE telegram_id = {placeholder}",
-            (telegram_id,),
+            f"""
+            INSERT INTO reservations (qr_code, user_id) VALUES ({placeholder}, {placeholder})
+            ON CONFLICT (qr_code, user_id) DO NOTHING
+            """,
+            (qr, user_id),
+        )
+        cur.execute(
+            f"""
+            SELECT COUNT(*) FROM reservations r JOIN reservations mine
+                ON mine.qr_code = r.qr_code
+            WHERE mine.qr_code = {placeholder} AND mine.user_id = {placeholder}
+                AND (r.created_at < mine.created_at
+                    OR (r.created_at = mine.created_at AND r.id <= mine.id))
+            """,
+            (qr, user_id),
         )
+        place = cur.fetchone()[0]
         conn.commit()
+    return place
 
 
-def get_all_users():
+def hand_over_book(
+    qr: str, office: str, taken_date: date, returned_by: Optional[int] = None
+) -> Optional[int]:
+    """Lend an available book to the first user on its waitlist.
+
+    ``returned_by`` is the user who has just given the book back; they leave
+    the waitlist instead of getting the book again. Return the id of the new
+    borrower, or ``None`` if nobody is waiting or the book is not available.
+    The take and the removal from the waitlist are committed together.
+    """
+    with transaction():
+        with get_conn() as conn:
+            cur = conn.cursor()
+            placeholder = _dialect.param
+            if returned_by is not None:
+                cur.execute(
+                    f"DELETE FROM reservations WHERE qr_code = {placeholder} AND user_id = {placeholder}",
+                    (qr, returned_by),
+                )
+            cur.execute(
+                f"""
+                SELECT user_id FROM reservations WHERE qr_code = {placeholder}
+                ORDER BY created_at, id LIMIT 1
+                """,
+                (qr,),
+            )
+            row = cur.fetchone()
+            if row is None or take_book(qr, row[0], office, taken_date) is None:
+                return None
+    return row[0]
+
+
+def reset_book(qr: str, office: str):
+    """Make a book of ``office`` available again regardless of its borrower.
+
+    Return the book title, or ``None`` if the office has no such book.
+    """
     with get_conn() as conn:
         cur = conn.cursor()
+        placeholder = _dialect.param
+        lock = _dialect.lock
         cur.execute(
-            "SELECT telegram_id, first_name, last_name, office, role FROM users"
+            "SELECT title, status, taken_by, taken_date FROM books "
+            f"WHERE qr_code = {placeholder} AND office = {placeholder}" + lock,
+            (qr, office),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        cur.execute(
+            f"""
+            UPDATE books SET status = 'available', taken_by = NULL, taken_date = NULL
+            WHERE qr_code = {placeholder}
+            """,
+            (qr,),
+        )
+        if row[1] == "taken":
+            _log_loan_event(cur, qr, row[2], office, "reset", datetime.now(timezone.utc))
+            _bump_office_stats(cur, office, available=1, taken=-1, loan_date=row[3], loans=-1)
+        conn.commit()
+    _bump_version(office)
+    return row[0]
+
+
+def get_overdue_books(office, older_than: date):
+    """Return books taken before ``older_than``, oldest loans first.
+
+    ``office`` limits the result to one office; ``None`` returns overdue books
+    of all offices.
+    """
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, Book)
+        placeholder = _dialect.param
+        query = (
+            "SELECT qr_code, title, status, taken_by, taken_date, office FROM books "
+            f"WHERE status = 'taken' AND taken_date < {placeholder}"
         )
+        params = [older_than]
+        if office is not None:
+            query += f" AND office = {placeholder}"
+            params.append(office)
+        cur.execute(query + " ORDER BY taken_date", params)
         rows = cur.fetchall()
-    return [
-        {
-            "telegram_id": r[0],
-            "first_name": r[1],
-            "last_name": r[2],
-            "office": r[3],
-            "role": r[4],
-        }
-        for r in rows
-    ]
+    return rows
 
 
-def get_book_by_qr(qr: str):
-    with get_conn() as conn:
+def _utc_midnight(day: date) -> datetime:
+    return datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+
+
+def count_loans_by_period(start: date, end: date, office=None):
+    """Return ``{day: number of takes}`` for loans started in ``[start, end)``."""
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
-        cur.execute(
-            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE qr_code = {placeholder}",
-            (qr,),
+        placeholder = _dialect.param
+        day = _dialect.utc_date("taken_at")
+        query = (
+            f"SELECT {day} AS day, COUNT(*) FROM loans "
+            f"WHERE event = 'take' AND taken_at >= {placeholder} "
+            f"AND taken_at < {placeholder}"
         )
-        row = cur.fetchone()
-    if not row:
-        return None
+        params = [_utc_midnight(start), _utc_midnight(end)]
+        if office is not None:
+            query += f" AND office = {placeholder}"
+            params.append(office)
+        cur.execute(query + " GROUP BY day ORDER BY day", params)
+        rows = cur.fetchall()
     return {
-        "qr_code": row[0],
-        "title": row[1],
-        "status": row[2],
-        "taken_by": row[3],
-        "taken_date": row[4],
-        "office": row[5],
+        (date.fromisoformat(r[0]) if isinstance(r[0], str) else r[0]): r[1]
+        for r in rows
     }
 
 
-def save_book(book: dict) -> None:
-    with get_conn() as conn:
+def get_most_borrowed_books(office=None, limit: int = 10):
+    """Return ``(qr_code, title, times taken)`` rows, most borrowed first."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        query = (
+            "SELECT l.qr_code, b.title, COUNT(*) AS takes "
+            "FROM loans l LEFT JOIN books b ON b.qr_code = l.qr_code "
+            "WHERE l.event = 'take'"
+        )
+        params = []
+        if office is not None:
+            query += f" AND l.office = {placeholder}"
+            params.append(office)
+        query += f" GROUP BY l.qr_code, b.title ORDER BY takes DESC, b.title LIMIT {placeholder}"
+        params.append(limit)
+        cur.execute(query, params)
+        return cur.fetchall()
+
+
+def get_average_loan_days(office=None):
+    """Return the average length in days of finished loans, or ``None``."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        duration = _dialect.days_between("taken_at", "created_at")
+        query = (
+            f"SELECT AVG({duration}) FROM loans "
+            "WHERE event <> 'take' AND taken_at IS NOT NULL"
+        )
+        params = []
+        if office is not None:
+            query += f" AND office = {placeholder}"
+            params.append(office)
+        cur.execute(query, params)
+        value = cur.fetchone()[0]
+    return float(value) if value is not None else None
+
+
+def get_user_loan_history(user_id: int, limit: int = 20):
+    """Return the user's loans, newest first.
+
+    Each item has ``qr_code``, ``title``, ``taken_at`` and ``returned_at``
+    (``None`` while the book is still held).
+    """
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+        placeholder = _dialect.param
         cur.execute(
             f"""
-            INSERT INTO books (qr_code, title, status, taken_by, taken_date, office)
-            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder}, {placeholder})
-            ON CONFLICT(qr_code) DO UPDATE SET
-                title=excluded.title,
-                status=excluded.status,
-                taken_by=excluded.taken_by,
-                taken_date=excluded.taken_date,
-                office=excluded.office
+            SELECT t.qr_code, b.title, t.taken_at, r.created_at
+            FROM loans t
+            LEFT JOIN loans r
+                ON r.qr_code = t.qr_code AND r.taken_at = t.taken_at AND r.event <> 'take'
+            LEFT JOIN books b ON b.qr_code = t.qr_code
+            WHERE t.user_id = {placeholder} AND t.event = 'take'
+            ORDER BY t.taken_at DESC
+            LIMIT {placeholder}
             """,
-            (
-                book.get("qr_code"),
-                book.get("title"),
-                book.get("status"),
-                book.get("taken_by"),
-                book.get("taken_date"),
-                book.get("office"),
-            ),
+            (user_id, limit),
         )
-        conn.commit()
+        rows = cur.fetchall()
+    return [
+        {"qr_code": r[0], "title": r[1], "taken_at": r[2], "returned_at": r[3]}
+        for r in rows
+    ]
 
 
-def get_user_books(user_id: int):
-    with get_conn() as conn:
+def get_pending_reminders(older_than: date, sent_before: datetime):
+    """Return overdue loans of all offices that need a reminder.
+
+    A loan (book, borrower and take date) is skipped if a reminder for it was
+    recorded at or after ``sent_before``. Rows are ordered by borrower so they
+    can be grouped into one digest per user.
+    """
+    with get_conn(readonly=True) as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
+        placeholder = _dialect.param
         cur.execute(
-            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE taken_by = {placeholder} AND status = 'taken'",
-            (user_id,),
+            f"""
+            SELECT b.qr_code, b.title, b.taken_by, b.taken_date, b.office
+            FROM books b
+            LEFT JOIN overdue_reminders r
+                ON r.qr_code = b.qr_code
+                AND r.user_id = b.taken_by
+                AND r.taken_date = b.taken_date
+            WHERE b.status = 'taken' AND b.taken_date < {placeholder}
+                AND (r.sent_at IS NULL OR r.sent_at < {placeholder})
+            ORDER BY b.taken_by, b.taken_date
+            """,
+            (older_than, sent_before),
         )
         rows = cur.fetchall()
     return [
         {
             "qr_code": r[0],
             "title": r[1],
-            "status": r[2],
-            "taken_by": r[3],
-            "taken_date": r[4],
-            "office": r[5],
+            "taken_by": r[2],
+            "taken_date": r[3],
+            "office": r[4],
         }
         for r in rows
     ]
 
 
-def get_books_by_office(office: str):
+def mark_reminders_sent(loans, sent_at: datetime) -> None:
+    """Record that reminders for ``loans`` were delivered at ``sent_at``."""
     with get_conn() as conn:
         cur = conn.cursor()
-        placeholder = "?" if DB_ENGINE == "sqlite" else "%s"
-        cur.execute(
-            f"SELECT qr_code, title, status, taken_by, taken_date, office FROM books WHERE office = {placeholder}",
-            (office,),
+        placeholder = _dialect.param
+        cur.executemany(
+            f"""
+            INSERT INTO overdue_reminders (qr_code, user_id, taken_date, sent_at)
+            VALUES ({placeholder}, {placeholder}, {placeholder}, {placeholder})
+            ON CONFLICT(qr_code, user_id, taken_date) DO UPDATE SET
+                sent_at=excluded.sent_at
+            """,
+            [
+                (loan["qr_code"], loan["taken_by"], loan["taken_date"], sent_at)
+                for loan in loans
+            ],
         )
+        conn.commit()
+
+
+def load_bot_state(kind: str):
+    """Return the ``key -> value`` strings stored in ``bot_state`` for ``kind``."""
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        cur.execute(f"SELECT key, value FROM bot_state WHERE kind = {placeholder}", (kind,))
+        return dict(cur.fetchall())
+
+
+def save_bot_state(entries) -> None:
+    """Write ``{(kind, key): value}`` to ``bot_state`` in one transaction.
+
+    A ``None`` value deletes the entry.
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        deleted = [key for key, value in entries.items() if value is None]
+        if deleted:
+            cur.executemany(
+                f"DELETE FROM bot_state WHERE kind = {placeholder} AND key = {placeholder}",
+                deleted,
+            )
+        saved = [(kind, key, value) for (kind, key), value in entries.items() if value is not None]
+        if saved:
+            cur.executemany(
+                f"""
+                INSERT INTO bot_state (kind, key, value)
+                VALUES ({placeholder}, {placeholder}, {placeholder})
+                ON CONFLICT(kind, key) DO UPDATE SET value=excluded.value
+                """,
+                saved,
+            )
+        conn.commit()
+
+
+def _fts_query(text: str, any_term: bool = False) -> str:
+    """Return an FTS5 prefix query for the words in ``text``."""
+    terms = [f'"{word}"*' for word in re.findall(r"\w+", text.lower())]
+    return (" OR " if any_term else " ").join(terms)
+
+
+def search_books(office: str, text: str, limit: int = 10, offset: int = 0):
+    """Return books of ``office`` matching ``text``, best matches first.
+
+    On SQLite every word is matched as a prefix and, if that finds nothing,
+    any of the words may match. On Postgres results combine Russian
+    full-text matches with trigram similarity when ``pg_trgm`` is available.
+    """
+    with get_conn(readonly=True) as conn:
+        cur = _record_cursor(conn, Book)
+        if DB_ENGINE == "sqlite":
+            rows = []
+            for any_term in (False, True):
+                query = _fts_query(text, any_term)
+                if not query:
+                    break
+                if offset and not any_term:
+                    # Later pages use the mode of the first one: every word
+                    # if that matches anything, otherwise any word.
+                    probe = conn.cursor()
+                    probe.execute(
+                        """
+                        SELECT 1 FROM books_fts JOIN books b ON b.rowid = books_fts.rowid
+                        WHERE books_fts MATCH ? AND b.office = ? LIMIT 1
+                        """,
+                        (query, office),
+                    )
+                    if probe.fetchone() is None:
+                        continue
+                cur.execute(
+                    """
+                    SELECT b.qr_code, b.title, b.status, b.taken_by, b.taken_date, b.office
+                    FROM books_fts JOIN books b ON b.rowid = books_fts.rowid
+                    WHERE books_fts MATCH ? AND b.office = ?
+                    ORDER BY bm25(books_fts), b.title
+                    LIMIT ? OFFSET ?
+                    """,
+                    (query, office, limit, offset),
+                )
+                rows = cur.fetchall()
+                if rows or offset:
+                    break
+        elif _HAS_TRGM:
+            cur.execute(
+                """
+                SELECT qr_code, title, status, taken_by, taken_date, office
+                FROM books, plainto_tsquery('russian', %s) query
+                WHERE office = %s AND (title_tsv @@ query OR title %% %s)
+                ORDER BY ts_rank(title_tsv, query) + similarity(title, %s) DESC, title
+                LIMIT %s OFFSET %s
+                """,
+                (text, office, text, text, limit, offset),
+            )
+            rows = cur.fetchall()
+        else:
+            cur.execute(
+                """
+                SELECT qr_code, title, status, taken_by, taken_date, office
+                FROM books, plainto_tsquery('russian', %s) query
+                WHERE office = %s AND title_tsv @@ query
+                ORDER BY ts_rank(title_tsv, query) DESC, title
+                LIMIT %s OFFSET %s
+                """,
+                (text, office, limit, offset),
+            )
+            rows = cur.fetchall()
+    return rows
+
+
+def reconcile_office_stats() -> None:
+    """Recount the summary counters of every office from ``books``."""
+    with get_conn() as conn:
+        cur = conn.cursor()
+        _reconcile_office_stats(cur)
+        conn.commit()
+
+
+def get_office_stats(office=None):
+    """Return summary counters for ``office``, or for every office if ``None``.
+
+    Each item has ``office``, ``total``, ``available``, ``taken`` and
+    ``overdue``. For a single office ``None`` is returned if it has no books.
+    """
+    with get_conn(readonly=True) as conn:
+        cur = conn.cursor()
+        placeholder = _dialect.param
+        query = "SELECT office, total, available, taken, overdue FROM office_stats"
+        if office is not None:
+            cur.execute(query + f" WHERE office = {placeholder}", (office,))
+        else:
+            cur.execute(query + " ORDER BY office")
         rows = cur.fetchall()
-    return [
+    stats = [
         {
-            "qr_code": r[0],
-            "title": r[1],
-            "status": r[2],
-            "taken_by": r[3],
-            "taken_date": r[4],
-            "office": r[5],
+            "office": r[0],
+            "total": r[1],
+            "available": r[2],
+            "taken": r[3],
+            "overdue": r[4],
         }
         for r in rows
     ]
+    if office is not None:
+        return stats[0] if stats else None
+    return stats
+
+
+# Public functions every storage backend provides. The SQL implementations
+# above serve ``postgres`` and ``sqlite``; another engine implements
+# :class:`StorageBackend`. The module-level names dispatch to ``_backend``, so
+# ``from db import take_book`` keeps working whichever engine is installed.
+BACKEND_API = (
+    "init_db",
+    "close_connections",
+    "transaction",
+    "save_message",
+    "ensure_message_partitions",
+    "purge_messages",
+    "search_messages",
+    "get_user",
+    "get_user_by_name",
+    "save_user",
+    "update_user_office",
+    "delete_user",
+    "get_all_users",
+    "import_users",
+    "get_book_by_qr",
+    "save_book",
+    "import_books",
+    "iter_office_books",
+    "get_user_books",
+    "get_books_by_office",
+    "get_office_books_page",
+    "audit_office",
+    "search_books",
+    "take_book",
+    "return_book",
+    "reserve_book",
+    "hand_over_book",
+    "reset_book",
+    "get_overdue_books",
+    "count_loans_by_period",
+    "get_most_borrowed_books",
+    "get_average_loan_days",
+    "get_user_loan_history",
+    "get_pending_reminders",
+    "mark_reminders_sent",
+    "load_bot_state",
+    "save_bot_state",
+    "reconcile_office_stats",
+    "get_office_stats",
+)
+
+
+class StorageBackend(abc.ABC):
+    """Interface of a storage engine: one method per name in ``BACKEND_API``.
+
+    The methods take the arguments and return the records of the SQL
+    functions of the same names in this module.
+    """
+
+    @abc.abstractmethod
+    def init_db(self) -> None: ...
+
+    @abc.abstractmethod
+    def close_connections(self) -> None: ...
+
+    @abc.abstractmethod
+    def transaction(self): ...
+
+    @abc.abstractmethod
+    def save_message(self, user_id: int, text: str) -> None: ...
+
+    @abc.abstractmethod
+    def ensure_message_partitions(self) -> None: ...
+
+    @abc.abstractmethod
+    def purge_messages(self, before: datetime, batch_size: int) -> bool: ...
+
+    @abc.abstractmethod
+    def search_messages(
+        self,
+        user_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        text: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ): ...
+
+    @abc.abstractmethod
+    def get_user(self, telegram_id: int): ...
+
+    @abc.abstractmethod
+    def get_user_by_name(self, first_name: str, last_name: str, office: str): ...
+
+    @abc.abstractmethod
+    def save_user(self, user: dict) -> None: ...
+
+    @abc.abstractmethod
+    def update_user_office(self, telegram_id: int, office: str, role: str) -> None: ...
+
+    @abc.abstractmethod
+    def delete_user(self, telegram_id: int) -> None: ...
+
+    @abc.abstractmethod
+    def get_all_users(self): ...
+
+    @abc.abstractmethod
+    def import_users(self, users, allowed_offices=None) -> list: ...
+
+    @abc.abstractmethod
+    def get_book_by_qr(self, qr: str): ...
+
+    @abc.abstractmethod
+    def save_book(self, book: dict) -> None: ...
+
+    @abc.abstractmethod
+    def import_books(self, books, allowed_offices=None) -> list: ...
+
+    @abc.abstractmethod
+    def iter_office_books(self, office: str, chunk_size: int = 1000): ...
+
+    @abc.abstractmethod
+    def get_user_books(self, user_id: int): ...
+
+    @abc.abstractmethod
+    def get_books_by_office(self, office: str): ...
+
+    @abc.abstractmethod
+    def get_office_books_page(self, office: str, limit: int, offset: int = 0): ...
+
+    @abc.abstractmethod
+    def audit_office(self, office: str, codes) -> dict: ...
+
+    @abc.abstractmethod
+    def search_books(self, office: str, text: str, limit: int = 10, offset: int = 0): ...
+
+    @abc.abstractmethod
+    def take_book(self, qr: str, user_id: int, office: str, taken_date: date): ...
+
+    @abc.abstractmethod
+    def return_book(self, qr: str, user_id: int, office: str): ...
+
+    @abc.abstractmethod
+    def reserve_book(self, qr: str, user_id: int) -> int: ...
+
+    @abc.abstractmethod
+    def hand_over_book(
+        self, qr: str, office: str, taken_date: date, returned_by: Optional[int] = None
+    ) -> Optional[int]: ...
+
+    @abc.abstractmethod
+    def reset_book(self, qr: str, office: str): ...
+
+    @abc.abstractmethod
+    def get_overdue_books(self, office, older_than: date): ...
+
+    @abc.abstractmethod
+    def count_loans_by_period(self, start: date, end: date, office=None): ...
+
+    @abc.abstractmethod
+    def get_most_borrowed_books(self, office=None, limit: int = 10): ...
+
+    @abc.abstractmethod
+    def get_average_loan_days(self, office=None): ...
+
+    @abc.abstractmethod
+    def get_user_loan_history(self, user_id: int, limit: int = 20): ...
+
+    @abc.abstractmethod
+    def get_pending_reminders(self, older_than: date, sent_before: datetime): ...
+
+    @abc.abstractmethod
+    def mark_reminders_sent(self, loans, sent_at: datetime) -> None: ...
+
+    @abc.abstractmethod
+    def load_bot_state(self, kind: str): ...
+
+    @abc.abstractmethod
+    def save_bot_state(self, entries) -> None: ...
+
+    @abc.abstractmethod
+    def reconcile_office_stats(self) -> None: ...
+
+    @abc.abstractmethod
+    def get_office_stats(self, office=None): ...
+
+
+assert StorageBackend.__abstractmethods__ == frozenset(BACKEND_API)
+
+# The SQL engine: the functions above as methods of a ``StorageBackend``.
+SQLBackend = type(
+    "SQLBackend",
+    (StorageBackend,),
+    {name: staticmethod(globals()[name]) for name in BACKEND_API},
+)
+
+
+def _dispatcher(name: str):
+    impl = globals()[name]
+
+    def dispatch(*args, **kwargs):
+        return getattr(_backend, name)(*args, **kwargs)
+
+    dispatch.__name__ = dispatch.__qualname__ = name
+    dispatch.__doc__ = impl.__doc__
+    return dispatch
+
+
+for _name in BACKEND_API:
+    globals()[_name] = _dispatcher(_name)
+del _name
+
+_backend: StorageBackend = SQLBackend()
+
+
+def _install_backend(backend: StorageBackend) -> None:
+    """Route the functions in ``BACKEND_API`` to ``backend``."""
+    global _backend
+    # Checked by name rather than ``isinstance``: reloading this module (as
+    # the tests do) creates a new ``StorageBackend`` class.
+    missing = [name for name in BACKEND_API if not callable(getattr(backend, name, None))]
+    if missing:
+        raise TypeError(f"{type(backend).__name__} does not implement {', '.join(missing)}")
+    _backend = backend
+
+
+if DB_ENGINE == "memory":
+    from memstore import MemoryBackend
 
+    _install_backend(MemoryBackend(MEMORY_DATA_DIR, MEMORY_SNAPSHOT_SECONDS))
@@ -0,0 +1,82 @@
+"""Export of the office book list to CSV or XLSX files.
+
+Rows are streamed from :func:`db.iter_office_books` and written to the file as
+they arrive, so exporting a large office keeps memory use flat.
+
+Command line usage::
+
+    python exporter.py SokolGora books.xlsx
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence
+
+import db
+
+HEADER = ["QR-код", "Название", "Статус", "Дата выдачи", "ID читателя", "Читатель"]
+
+
+def _rows(office: str) -> Iterable[List[object]]:
+    for row in db.iter_office_books(office):
+        qr, title, status, taken_date, taken_by, first_name, last_name = row
+        reader = f'{first_name or ""} {last_name or ""}'.strip()
+        yield [
+            qr,
+            title,
+            "взята" if status == "taken" else "свободна",
+            taken_date,
+            taken_by,
+            reader,
+        ]
+
+
+def write_csv(rows: Iterable[Sequence[object]], path: str) -> int:
+    count = 0
+    # utf-8-sig lets Excel detect the encoding of Cyrillic text.
+    with open(path, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for row in rows:
+            writer.writerow(["" if v is None else v for v in row])
+            count += 1
+    return count
+
+
+def write_xlsx(rows: Iterable[Sequence[object]], path: str) -> int:
+    # openpyxl is only needed for XLSX exports.
+    from openpyxl import Workbook
+
+    # Write-only workbooks flush rows to disk instead of keeping the sheet.
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Книги")
+    sheet.append(HEADER)
+    count = 0
+    for row in rows:
+        sheet.append(list(row))
+        count += 1
+    workbook.save(path)
+    return count
+
+
+def export_office_books(office: str, path: str, fmt: str = "csv") -> int:
+    """Write the books of ``office`` to ``path`` and return the row count."""
+    writer = write_xlsx if fmt == "xlsx" else write_csv
+    return writer(_rows(office), path)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Export office books.")
+    parser.add_argument("office")
+    parser.add_argument("path", help="Output file; .xlsx selects the XLSX format")
+    args = parser.parse_args(argv)
+    fmt = "xlsx" if Path(args.path).suffix.lower() == ".xlsx" else "csv"
+    count = export_office_books(args.office, args.path, fmt)
+    print(f"{count} books written to {args.path}")
+
+
+if __name__ == "__main__":
+    main()
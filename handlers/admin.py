@@ -1,27 +1,57 @@
 from __future__ import annotations
 
-from telegram import Update
-from telegram.ext import ConversationHandler, MessageHandler, ContextTypes, filters
+import asyncio
+import csv
+import os
+import tempfile
+import time
+from pathlib import Path
 
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import (
+    CallbackQueryHandler,
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    ContextTypes,
+    filters,
+)
+
+import config
+import db
+from exporter import export_office_books
+from importer import import_file
+from outbound import coalesce_replies, reply, reply_menu
+from render_cache import listings
 from utils import (
     is_admin,
+    is_global_admin,
     save_book,
     get_book_by_qr,
     log_action,
-    get_books_by_office,
+    overdue_cutoff,
+    get_overdue_books,
     get_user,
     extract_qr_from_update,
     get_all_users,
     delete_user,
+    reset_book,
+    today,
 )
+from .books import pass_to_waitlist
 from .start import (
     ADMIN_KEYBOARD,
     CANCEL_KEYBOARD,
     CANCEL_RE,
+    CONVERSATION_TIMEOUT,
+    TIMEOUT_HANDLERS,
     cancel_action,
 )
 
-ADD_QR, ADD_TITLE, RESET_QR, REMOVE_USER = range(4)
+ADD_QR, ADD_TITLE, RESET_QR, REMOVE_USER, IMPORT_FILE = range(5)
+
+# Minimum number of seconds between import progress updates.
+IMPORT_PROGRESS_INTERVAL = 2
 
 
 async def add_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -36,31 +66,32 @@ async def add_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return ADD_QR
 
 
+@coalesce_replies
 async def add_book_get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     qr = await extract_qr_from_update(update, context.bot)
     if not qr:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Не удалось распознать QR-код. Отправьте текстовый код.",
             reply_markup=CANCEL_KEYBOARD,
         )
         return ADD_QR
     if get_book_by_qr(qr):
-        await update.message.reply_text("⚠️ Книга с таким QR уже существует.")
-        await update.message.reply_text("Главное меню", reply_markup=ADMIN_KEYBOARD)
+        await reply(update, "⚠️ Книга с таким QR уже существует.")
+        await reply_menu(update, ADMIN_KEYBOARD)
         return ConversationHandler.END
     context.user_data["qr"] = qr
-    await update.message.reply_text(
-        "Введите название книги:", reply_markup=CANCEL_KEYBOARD
-    )
+    await reply(update, "Введите название книги:", reply_markup=CANCEL_KEYBOARD)
     return ADD_TITLE
 
 
+@coalesce_replies
 async def add_book_get_title(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     title = update.message.text.strip()
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
     book = {
-        "qr_code": context.user_data.get("qr"),
+        "qr_code": context.user_data.pop("qr", None),
         "title": title,
         "status": "available",
         "taken_by": None,
@@ -68,26 +99,108 @@ async def add_book_get_title(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "office": office,
     }
     save_book(book)
-    await update.message.reply_text("✅ Книга добавлена.")
+    await reply(update, "✅ Книга добавлена.")
     log_action("add_book", book)
-    await update.message.reply_text("Главное меню", reply_markup=ADMIN_KEYBOARD)
+    await reply_menu(update, ADMIN_KEYBOARD)
     return ConversationHandler.END
 
 
-async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = get_user(update.effective_user.id)
-    office = user.get("office") if user else None
-    if not is_admin(update.effective_user.id, office):
-        return
-    books = get_books_by_office(office)
+REPORT_CALLBACK = "report:"
+REPORT_PAGE_SIZE = 20
+
+
+def render_report_page(office: str, page: int):
+    """Return the text and pager buttons for one page of the library report.
+
+    The first page starts with the office counters and the last one ends
+    with the overdue books.
+    """
+    books = db.get_office_books_page(
+        office, REPORT_PAGE_SIZE + 1, page * REPORT_PAGE_SIZE
+    )
     lines = []
-    for b in books:
+    stats = db.get_office_stats(office) if page == 0 else None
+    if stats:
+        lines.append(
+            f'Всего {stats["total"]}, свободно {stats["available"]}, '
+            f'взято {stats["taken"]}, просрочено {stats["overdue"]}'
+        )
+        lines.append("")
+    for b in books[:REPORT_PAGE_SIZE]:
         if b.get("status") == "taken":
             status = f'взята {b.get("taken_date")}, {b.get("taken_by")}'
         else:
             status = "свободна"
         lines.append(f'{b.get("title")}: {status}')
-    await update.message.reply_text("\n".join(lines) if lines else "Нет книг")
+    has_next = len(books) > REPORT_PAGE_SIZE
+    overdue = get_overdue_books(office) if not has_next else None
+    if overdue:
+        lines.append("")
+        lines.append(f"⏰ Просрочены (больше {config.LOAN_PERIOD_DAYS} дн.):")
+        lines.extend(
+            f'{b.get("title")}: с {b.get("taken_date")}, {b.get("taken_by")}'
+            for b in overdue
+        )
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("◀️", callback_data=f"{REPORT_CALLBACK}{page - 1}")
+        )
+    if has_next:
+        buttons.append(
+            InlineKeyboardButton("▶️", callback_data=f"{REPORT_CALLBACK}{page + 1}")
+        )
+    text = "\n".join(lines) if books else "Нет книг"
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def cached_report_page(office: str, page: int):
+    """Return :func:`render_report_page`, reusing the rendering until books change."""
+    # Overdue lines also change as days pass without any write.
+    version = (db.office_version(office), overdue_cutoff())
+    return listings.get_or_render(
+        office, "report", page, version, lambda: render_report_page(office, page)
+    )
+
+
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    if not is_admin(update.effective_user.id, office):
+        return
+    text, markup = cached_report_page(office, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def report_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show another page of the library report from the inline pager."""
+    query = update.callback_query
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    await query.answer()
+    if not is_admin(update.effective_user.id, office):
+        return
+    page = int(query.data[len(REPORT_CALLBACK):])
+    text, markup = cached_report_page(office, page)
+    await query.edit_message_text(text, reply_markup=markup)
+
+
+async def loan_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the most borrowed books and the average loan length (admin only)."""
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    if not is_admin(update.effective_user.id, office):
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    popular = db.get_most_borrowed_books(office, limit=10)
+    average = db.get_average_loan_days(office)
+    lines = ["📈 Самые популярные книги:"]
+    lines.extend(f"{title or qr}: {takes}" for qr, title, takes in popular)
+    if not popular:
+        lines.append("пока нет выдач")
+    if average is not None:
+        lines.append(f"Средний срок чтения: {average:.1f} дн.")
+    await update.message.reply_text("\n".join(lines))
 
 
 async def reset_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -102,23 +215,23 @@ async def reset_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     return RESET_QR
 
 
+@coalesce_replies
 async def reset_book_get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
     qr = update.message.text.strip()
     book = get_book_by_qr(qr)
     if not book:
-        await update.message.reply_text("⚠️ Книга не найдена.")
+        await reply(update, "⚠️ Книга не найдена.")
     elif book.get("office") != office:
-        await update.message.reply_text("⚠️ Эта книга находится в другом офисе.")
+        await reply(update, "⚠️ Эта книга находится в другом офисе.")
     else:
-        book["status"] = "available"
-        book["taken_by"] = None
-        book["taken_date"] = None
-        save_book(book)
-        await update.message.reply_text("✅ Статус книги сброшен.")
+        title = reset_book(qr, office)
+        if title:
+            pass_to_waitlist(context, update, qr, office, title, book.get("taken_by"))
+        await reply(update, "✅ Статус книги сброшен.")
         log_action("reset_book", {"qr_code": qr})
-    await update.message.reply_text("Главное меню", reply_markup=ADMIN_KEYBOARD)
+    await reply_menu(update, ADMIN_KEYBOARD)
     return ConversationHandler.END
 
 
@@ -156,12 +269,11 @@ async def remove_user_process(update: Update, context: ContextTypes.DEFAULT_TYPE
         )
         return REMOVE_USER
     target_id = int(user_id_text)
-    if not get_user(target_id):
+    if not delete_user(target_id):
         await update.message.reply_text(
             "Пользователь не найден.", reply_markup=ADMIN_KEYBOARD
         )
         return ConversationHandler.END
-    delete_user(target_id)
     log_action("delete_user", {"user_id": target_id})
     await update.message.reply_text(
         "✅ Пользователь удалён.", reply_markup=ADMIN_KEYBOARD
@@ -169,6 +281,88 @@ async def remove_user_process(update: Update, context: ContextTypes.DEFAULT_TYPE
     return ConversationHandler.END
 
 
+async def import_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    if not is_admin(update.effective_user.id, office):
+        await update.message.reply_text("Недостаточно прав.")
+        return ConversationHandler.END
+    await update.message.reply_text(
+        "Отправьте CSV или JSONL файл с книгами (qr_code, title, office) "
+        "или сотрудниками (telegram_id, first_name, last_name, office).",
+        reply_markup=CANCEL_KEYBOARD,
+    )
+    return IMPORT_FILE
+
+
+async def import_get_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    document = update.message.document
+    if not document:
+        await update.message.reply_text(
+            "Отправьте файл документом.", reply_markup=CANCEL_KEYBOARD
+        )
+        return IMPORT_FILE
+
+    status = await update.message.reply_text("⏳ Импорт...")
+    loop = asyncio.get_running_loop()
+    last_update = time.monotonic()
+
+    def progress(result) -> None:
+        # Called from the import thread after every chunk.
+        nonlocal last_update
+        if time.monotonic() - last_update >= IMPORT_PROGRESS_INTERVAL:
+            last_update = time.monotonic()
+            asyncio.run_coroutine_threadsafe(
+                status.edit_text(f"⏳ {result.summary()}"), loop
+            )
+
+    allowed = None if is_global_admin(update.effective_user.id) else {office}
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "upload" + Path(document.file_name or "").suffix)
+        file = await document.get_file()
+        await file.download_to_drive(path)
+        try:
+            result = await asyncio.to_thread(
+                import_file,
+                path,
+                default_office=office,
+                allowed_offices=allowed,
+                progress=progress,
+            )
+        except (UnicodeDecodeError, csv.Error, ValueError) as exc:
+            await update.message.reply_text(
+                f"⚠️ Не удалось прочитать файл: {exc}", reply_markup=ADMIN_KEYBOARD
+            )
+            return ConversationHandler.END
+
+    lines = [f"✅ Импорт завершён: {result.summary()}."]
+    lines.extend(f"строка {n}: {error}" for n, error in result.errors[:10])
+    if len(result.errors) > 10:
+        lines.append(f"... и ещё {len(result.errors) - 10}")
+    await update.message.reply_text("\n".join(lines), reply_markup=ADMIN_KEYBOARD)
+    return ConversationHandler.END
+
+
+async def export_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the office book list as a CSV file, or XLSX with ``/export xlsx``."""
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    if not is_admin(update.effective_user.id, office):
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    fmt = "xlsx" if context.args and context.args[0].lower() == "xlsx" else "csv"
+    filename = f"books_{office}_{today().isoformat()}.{fmt}"
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, filename)
+        count = await asyncio.to_thread(export_office_books, office, path, fmt)
+        with open(path, "rb") as f:
+            await update.message.reply_document(
+                f, filename=filename, caption=f"Книг: {count}"
+            )
+
+
 def get_handlers() -> list:
     return [
         ConversationHandler(
@@ -182,30 +376,60 @@ def get_handlers() -> list:
                     MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, add_book_get_title),
                 ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
             },
             fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="add_book",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
         ),
         MessageHandler(filters.Regex("^📊 Отчёт по библиотеке$"), report),
+        CallbackQueryHandler(report_page, pattern=rf"^{REPORT_CALLBACK}\d+$"),
+        MessageHandler(filters.Regex("^📄 Экспорт$"), export_books),
+        CommandHandler("stats", loan_stats),
+        CommandHandler("export", export_books),
         ConversationHandler(
             entry_points=[MessageHandler(filters.Regex("^🔁 Сброс книги$"), reset_book_start)],
             states={
                 RESET_QR: [
                     MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, reset_book_get_qr),
-                ]
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
             },
             fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="reset_book",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
         ),
         MessageHandler(filters.Regex("^👤 Список пользователей$"), list_users),
+        ConversationHandler(
+            entry_points=[MessageHandler(filters.Regex("^📥 Импорт$"), import_start)],
+            states={
+                IMPORT_FILE: [
+                    MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
+                    MessageHandler(~filters.COMMAND, import_get_file),
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
+            },
+            fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="import",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
+        ),
         ConversationHandler(
             entry_points=[MessageHandler(filters.Regex("^🗑 Удалить пользователя$"), remove_user_start)],
             states={
                 REMOVE_USER: [
                     MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                     MessageHandler(filters.TEXT & ~filters.COMMAND, remove_user_process),
-                ]
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
             },
             fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="remove_user",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
         ),
     ]
 
@@ -0,0 +1,222 @@
+"""Stocktaking: compare the books on an office's shelves with its catalogue.
+
+An administrator starts ``/audit`` and sends QR codes one after another, as
+photos, image documents or text (several codes per message, one per line).
+Codes and photos are deduplicated within the session and photos are
+downloaded and decoded in the background, several at a time, so scanning
+never waits for the previous photo. ``✅ Завершить`` waits for the last
+photos and compares all codes with the office catalogue in one query.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import Optional, Set
+
+from telegram import ReplyKeyboardMarkup, Update
+from telegram.ext import (
+    CommandHandler,
+    ContextTypes,
+    ConversationHandler,
+    MessageHandler,
+    TypeHandler,
+    filters,
+)
+
+import db
+from utils import decode_qr_attachment, get_user, is_admin, qr_attachment
+from .start import (
+    ADMIN_KEYBOARD,
+    CANCEL_RE,
+    CANCEL_TEXT,
+    CONVERSATION_TIMEOUT,
+    cancel_action,
+    timeout_action,
+)
+
+AUDIT_SCAN = 0
+
+FINISH_TEXT = "✅ Завершить"
+AUDIT_KEYBOARD = ReplyKeyboardMarkup([[FINISH_TEXT], [CANCEL_TEXT]], resize_keyboard=True)
+
+# ``bot_data`` key of the ``{user_id: AuditSession}`` sessions in progress.
+AUDITS = "audits"
+
+# Photos of one session downloaded at the same time; decoding is further
+# limited by the shared QR decode threads.
+AUDIT_DOWNLOADS = 8
+
+# Books listed per section of the final report.
+AUDIT_REPORT_LIMIT = 15
+
+
+class AuditSession:
+    """Codes scanned during one stocktake and the photos still being decoded."""
+
+    __slots__ = ("office", "codes", "photos", "pending", "failed", "downloads")
+
+    def __init__(self, office: str) -> None:
+        self.office = office
+        self.codes: Set[str] = set()
+        # ``file_unique_id`` of every photo received, to skip resent ones.
+        self.photos: Set[str] = set()
+        self.pending: Set[asyncio.Task] = set()
+        self.failed = 0
+        self.downloads = asyncio.Semaphore(AUDIT_DOWNLOADS)
+
+    def add_codes(self, text: str) -> None:
+        self.codes.update(line.strip() for line in text.splitlines() if line.strip())
+
+    async def decode(self, attachment) -> None:
+        async with self.downloads:
+            try:
+                code = await decode_qr_attachment(attachment)
+            except Exception as exc:
+                logging.warning("Audit photo download failed: %s", exc)
+                code = None
+        if code:
+            self.codes.add(code)
+        else:
+            self.failed += 1
+
+    async def wait(self) -> None:
+        """Wait until every photo received so far is decoded."""
+        while self.pending:
+            await asyncio.gather(*self.pending)
+
+
+def _session(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> Optional[AuditSession]:
+    return context.bot_data.get(AUDITS, {}).get(user_id)
+
+
+def _drop_session(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
+    session = context.bot_data.get(AUDITS, {}).pop(user_id, None)
+    if session is not None:
+        for task in session.pending:
+            task.cancel()
+
+
+async def audit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    if not office or not is_admin(update.effective_user.id, office):
+        await update.message.reply_text("Недостаточно прав.")
+        return ConversationHandler.END
+    _drop_session(context, update.effective_user.id)
+    context.bot_data.setdefault(AUDITS, {})[update.effective_user.id] = AuditSession(office)
+    await update.message.reply_text(
+        "📋 Инвентаризация. Отправляйте QR-коды книг фото или текстом, "
+        "можно по несколько строк в сообщении. Повторы не учитываются. "
+        f"Когда закончите, нажмите «{FINISH_TEXT}».",
+        reply_markup=AUDIT_KEYBOARD,
+    )
+    return AUDIT_SCAN
+
+
+async def _session_lost(update: Update) -> int:
+    await update.message.reply_text(
+        "Сессия инвентаризации прервана, начните заново: /audit",
+        reply_markup=ADMIN_KEYBOARD,
+    )
+    return ConversationHandler.END
+
+
+async def audit_scan(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Add the codes of one message; photos are decoded in the background."""
+    session = _session(context, update.effective_user.id)
+    if session is None:
+        # The bot restarted during the session.
+        return await _session_lost(update)
+    message = update.message
+    text = message.text or message.caption
+    if text:
+        session.add_codes(text)
+        return AUDIT_SCAN
+    attachment = qr_attachment(message)
+    if attachment is None or attachment.file_unique_id in session.photos:
+        return AUDIT_SCAN
+    session.photos.add(attachment.file_unique_id)
+    task = context.application.create_task(session.decode(attachment), update=update)
+    session.pending.add(task)
+    task.add_done_callback(session.pending.discard)
+    return AUDIT_SCAN
+
+
+def _book_lines(books, describe) -> list:
+    lines = [f"  {b['title'] or b['qr_code']} ({describe(b)})" for b in books[:AUDIT_REPORT_LIMIT]]
+    if len(books) > AUDIT_REPORT_LIMIT:
+        lines.append(f"  ... и ещё {len(books) - AUDIT_REPORT_LIMIT}")
+    return lines
+
+
+def render_audit(result: dict, scanned: int, failed: int) -> str:
+    """Return the stocktake report for a :func:`db.audit_office` result."""
+    lines = [
+        f"📋 Итоги инвентаризации: отсканировано кодов {scanned}.",
+        f"✅ На месте: {result['found']}, выдано читателям: {result['on_loan']}.",
+    ]
+    if failed:
+        lines.append(f"⚠️ Не распознано фото: {failed}.")
+    sections = [
+        ("❌ Не найдены на полках", result["missing"], lambda b: b["qr_code"]),
+        ("📕 На полке, но числятся выданными", result["taken"], lambda b: b["qr_code"]),
+        ("🏢 Из других офисов", result["elsewhere"], lambda b: b["office"]),
+    ]
+    for title, books, describe in sections:
+        if books:
+            lines.append(f"{title}: {len(books)}")
+            lines.extend(_book_lines(books, describe))
+    unexpected = result["unexpected"]
+    if unexpected:
+        lines.append(f"❓ Нет в каталоге: {len(unexpected)}")
+        lines.extend(f"  {code}" for code in unexpected[:AUDIT_REPORT_LIMIT])
+        if len(unexpected) > AUDIT_REPORT_LIMIT:
+            lines.append(f"  ... и ещё {len(unexpected) - AUDIT_REPORT_LIMIT}")
+    return "\n".join(lines)
+
+
+async def audit_finish(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    session = _session(context, update.effective_user.id)
+    if session is None:
+        return await _session_lost(update)
+    if session.pending:
+        await update.message.reply_text(f"⏳ Распознаю фото: {len(session.pending)}...")
+    await session.wait()
+    context.bot_data[AUDITS].pop(update.effective_user.id, None)
+    result = await asyncio.to_thread(db.audit_office, session.office, session.codes)
+    await update.message.reply_text(
+        render_audit(result, len(session.codes), session.failed), reply_markup=ADMIN_KEYBOARD
+    )
+    return ConversationHandler.END
+
+
+async def audit_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    _drop_session(context, update.effective_user.id)
+    return await cancel_action(update, context)
+
+
+async def audit_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    _drop_session(context, update.effective_user.id)
+    await timeout_action(update, context)
+
+
+def get_handlers() -> list:
+    return [
+        ConversationHandler(
+            entry_points=[CommandHandler("audit", audit_start)],
+            states={
+                AUDIT_SCAN: [
+                    MessageHandler(filters.Regex(CANCEL_RE), audit_cancel),
+                    MessageHandler(filters.Regex(f"^{FINISH_TEXT}$"), audit_finish),
+                    CommandHandler("done", audit_finish),
+                    MessageHandler(~filters.COMMAND, audit_scan),
+                ],
+                ConversationHandler.TIMEOUT: [TypeHandler(Update, audit_timeout)],
+            },
+            fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), audit_cancel)],
+            name="audit",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
+        )
+    ]
@@ -1,34 +1,60 @@
 from __future__ import annotations
 
-from datetime import datetime
+from typing import Optional
 
-from telegram import Update
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
+    CallbackQueryHandler,
+    CommandHandler,
     ConversationHandler,
     MessageHandler,
     ContextTypes,
     filters,
 )
 
+import db
+from outbound import coalesce_replies, reply, reply_menu
+from render_cache import listings
 from utils import (
     get_book_by_qr,
-    save_book,
+    take_book,
+    return_book,
+    reserve_book,
+    hand_over_book,
     get_user_books,
+    get_user_loan_history,
     log_action,
     is_admin,
     get_user,
-    get_books_by_office,
+    search_books,
     extract_qr_from_update,
 )
+from .recovery import notify_reserver, replay_pending
 from .start import (
     USER_KEYBOARD,
     ADMIN_KEYBOARD,
     CANCEL_KEYBOARD,
     CANCEL_RE,
+    CONVERSATION_TIMEOUT,
+    TIMEOUT_HANDLERS,
     cancel_action,
 )
 
-TAKE_QR, RETURN_QR = range(2)
+TAKE_QR, RETURN_QR, SEARCH_QUERY = range(3)
+
+RESERVE_CALLBACK = "reserve:"
+# Telegram limits callback data to 64 bytes.
+CALLBACK_DATA_LIMIT = 64
+
+
+def reserve_markup(qr: str):
+    """Return the "join the waitlist" button for a taken book, if it fits."""
+    data = f"{RESERVE_CALLBACK}{qr}"
+    if len(data.encode("utf-8")) > CALLBACK_DATA_LIMIT:
+        return None
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton("🔔 Встать в очередь", callback_data=data)]]
+    )
 
 
 async def take_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -38,36 +64,44 @@ async def take_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     return TAKE_QR
 
 
+@coalesce_replies
 async def take_book_get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
     qr = await extract_qr_from_update(update, context.bot)
     if not qr:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Не удалось распознать QR-код. Отправьте текстовый код.",
             reply_markup=CANCEL_KEYBOARD,
         )
         return TAKE_QR
+    await replay_pending(context.bot)
     book = get_book_by_qr(qr)
     if not book:
-        await update.message.reply_text("⚠️ Книга с таким QR не найдена.")
+        await reply(update, "⚠️ Книга с таким QR не найдена.")
     elif book.get("office") != office:
-        await update.message.reply_text("⚠️ Эта книга находится в другом офисе.")
-    elif book.get("status") == "taken":
-        await update.message.reply_text("⚠️ Эта книга уже взята другим пользователем.")
+        await reply(update, "⚠️ Эта книга находится в другом офисе.")
+    elif book.get("status") == "taken" or not take_book(qr, update.effective_user.id, office):
+        if book.get("taken_by") == update.effective_user.id:
+            await reply(update, "⚠️ Эта книга уже у вас.")
+        else:
+            await reply(
+                update,
+                "⚠️ Эта книга уже взята другим пользователем. "
+                "Встаньте в очередь, и она перейдёт к вам после возврата.",
+                reply_markup=reserve_markup(qr),
+            )
     else:
-        book["status"] = "taken"
-        book["taken_by"] = update.effective_user.id
-        book["taken_date"] = datetime.now().strftime("%Y-%m-%d")
-        save_book(book)
-        await update.message.reply_text(
+        await reply(
+            update,
             f'✅ Книга "{book.get("title")}" успешно закреплена за вами.'
         )
         log_action(
             "take_book", {"user_id": update.effective_user.id, "qr_code": qr}
         )
     keyboard = ADMIN_KEYBOARD if is_admin(update.effective_user.id, office) else USER_KEYBOARD
-    await update.message.reply_text("Главное меню", reply_markup=keyboard)
+    await reply_menu(update, keyboard)
     return ConversationHandler.END
 
 
@@ -78,67 +112,260 @@ async def return_book_start(update: Update, context: ContextTypes.DEFAULT_TYPE)
     return RETURN_QR
 
 
+@coalesce_replies
 async def return_book_get_qr(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
     qr = await extract_qr_from_update(update, context.bot)
     if not qr:
-        await update.message.reply_text(
+        await reply(
+            update,
             "Не удалось распознать QR-код. Отправьте текстовый код.",
             reply_markup=CANCEL_KEYBOARD,
         )
         return RETURN_QR
-    book = get_book_by_qr(qr)
-    if not book or book.get("taken_by") != update.effective_user.id or book.get("office") != office:
-        await update.message.reply_text("⚠️ Эта книга не закреплена за вами.")
+    await replay_pending(context.bot)
+    title = return_book(qr, update.effective_user.id, office)
+    if not title:
+        await reply(update, "⚠️ Эта книга не закреплена за вами.")
     else:
-        book["status"] = "available"
-        book["taken_by"] = None
-        book["taken_date"] = None
-        save_book(book)
-        await update.message.reply_text(
-            f'✅ Книга "{book.get("title")}" возвращена.'
-        )
+        pass_to_waitlist(context, update, qr, office, title, update.effective_user.id)
+        await reply(update, f'✅ Книга "{title}" возвращена.')
         log_action(
             "return_book", {"user_id": update.effective_user.id, "qr_code": qr}
         )
     keyboard = ADMIN_KEYBOARD if is_admin(update.effective_user.id, office) else USER_KEYBOARD
-    await update.message.reply_text("Главное меню", reply_markup=keyboard)
+    await reply_menu(update, keyboard)
     return ConversationHandler.END
 
 
-async def my_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    books = get_user_books(update.effective_user.id)
+def pass_to_waitlist(
+    context: ContextTypes.DEFAULT_TYPE,
+    update: Update,
+    qr: str,
+    office: str,
+    title: str,
+    returned_by: Optional[int],
+) -> None:
+    """Lend a just returned or reset book to the next user on its waitlist.
+
+    ``returned_by`` is the previous borrower, who does not get the book back.
+    The notice is sent by a background task, so the reply to the returning
+    user does not wait for it.
+    """
+    user_id = hand_over_book(qr, office, returned_by)
+    if user_id is None:
+        return
+    log_action("hand_over_book", {"user_id": user_id, "qr_code": qr})
+    context.application.create_task(notify_reserver(context.bot, user_id, title), update=update)
+
+
+async def reserve_book_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Put the user on the waitlist of a taken book from the inline button."""
+    query = update.callback_query
+    qr = query.data[len(RESERVE_CALLBACK):]
+    user = get_user(update.effective_user.id)
+    book = get_book_by_qr(qr)
+    if not user or not book or book.get("office") != user.get("office"):
+        await query.answer("⚠️ Эта книга находится в другом офисе.", show_alert=True)
+    elif book.get("status") != "taken":
+        await query.answer("Книга уже свободна, возьмите её.", show_alert=True)
+    elif book.get("taken_by") == update.effective_user.id:
+        await query.answer("⚠️ Эта книга уже у вас.", show_alert=True)
+    else:
+        place = reserve_book(qr, update.effective_user.id)
+        log_action("reserve_book", {"user_id": update.effective_user.id, "qr_code": qr})
+        await query.answer(
+            f"🔔 Вы в очереди на книгу, место: {place}. "
+            "Когда её вернут, она будет закреплена за вами.",
+            show_alert=True,
+        )
+
+
+RETURN_CALLBACK = "return:"
+
+
+def render_my_books(books: list):
+    """Return the text and inline "Вернуть" buttons for the user's books."""
     if not books:
-        await update.message.reply_text("У вас нет взятых книг.")
+        return "У вас нет взятых книг.", None
+    lines = []
+    buttons = []
+    for b in books:
+        lines.append(f'{b.get("title")}, взята {b.get("taken_date")}')
+        data = f'{RETURN_CALLBACK}{b.get("qr_code")}'
+        if len(data.encode("utf-8")) <= CALLBACK_DATA_LIMIT:
+            label = f'Вернуть «{b.get("title")}»'
+            if len(label) > 40:
+                label = label[:38] + "…»"
+            buttons.append([InlineKeyboardButton(label, callback_data=data)])
+    return "\n".join(lines), InlineKeyboardMarkup(buttons) if buttons else None
+
+
+async def my_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    text, markup = render_my_books(get_user_books(update.effective_user.id))
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def loan_history(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the books the user has borrowed recently."""
+    history = get_user_loan_history(update.effective_user.id)
+    if not history:
+        await update.message.reply_text("Вы ещё не брали книги.")
         return
-    lines = [
-        f'{b.get("title")}, взята {b.get("taken_date")}'
-        for b in books
-    ]
+    lines = []
+    for h in history:
+        taken = h["taken_at"].date()
+        if h["returned_at"]:
+            lines.append(f'{h["title"]}: {taken} — {h["returned_at"].date()}')
+        else:
+            lines.append(f'{h["title"]}: с {taken}, на руках')
     await update.message.reply_text("\n".join(lines))
 
 
-async def list_all_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+async def return_book_button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Return a book from the inline button attached to the "Мои книги" list."""
+    query = update.callback_query
+    qr = query.data[len(RETURN_CALLBACK):]
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
-    books = get_books_by_office(office)
+    await replay_pending(context.bot)
+    title = return_book(qr, update.effective_user.id, office)
+    if not title:
+        await query.answer("⚠️ Эта книга не закреплена за вами.", show_alert=True)
+        return
+    pass_to_waitlist(context, update, qr, office, title, update.effective_user.id)
+    log_action("return_book", {"user_id": update.effective_user.id, "qr_code": qr})
+    await query.answer(f'✅ Книга "{title}" возвращена.')
+    text, markup = render_my_books(get_user_books(update.effective_user.id))
+    await query.edit_message_text(text, reply_markup=markup)
+
+
+SEARCH_CALLBACK = "search:"
+SEARCH_PAGE_SIZE = 10
+
+
+def render_search_page(office: str, text: str, page: int):
+    """Return the text and pager buttons for one page of search results."""
+    # Fetch one extra row to know whether a next page exists.
+    books = search_books(
+        office, text, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE
+    )
     if not books:
-        await update.message.reply_text("Нет книг")
+        return f"По запросу «{text}» ничего не найдено.", None
+    lines = [f"🔎 «{text}», стр. {page + 1}:"]
+    for b in books[:SEARCH_PAGE_SIZE]:
+        status = "взята" if b.get("status") == "taken" else "свободна"
+        lines.append(f'{b.get("title")}: {status}')
+    buttons = []
+    if page:
+        buttons.append(
+            InlineKeyboardButton("◀️", callback_data=f"{SEARCH_CALLBACK}{page - 1}")
+        )
+    if len(books) > SEARCH_PAGE_SIZE:
+        buttons.append(
+            InlineKeyboardButton("▶️", callback_data=f"{SEARCH_CALLBACK}{page + 1}")
+        )
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def search_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    await update.message.reply_text(
+        "Введите название или часть названия книги:", reply_markup=CANCEL_KEYBOARD
+    )
+    return SEARCH_QUERY
+
+
+@coalesce_replies
+async def search_get_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    text = update.message.text.strip()
+    context.user_data["search_query"] = text
+    results, markup = render_search_page(office, text, 0)
+    await reply(update, results, reply_markup=markup)
+    keyboard = ADMIN_KEYBOARD if is_admin(update.effective_user.id, office) else USER_KEYBOARD
+    await reply_menu(update, keyboard)
+    return ConversationHandler.END
+
+
+async def search_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show another page of the last search from the inline pager."""
+    query = update.callback_query
+    text = context.user_data.get("search_query")
+    if not text:
+        await query.answer("Поиск устарел, повторите запрос.", show_alert=True)
         return
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    page = int(query.data[len(SEARCH_CALLBACK):])
+    results, markup = render_search_page(office, text, page)
+    await query.answer()
+    await query.edit_message_text(results, reply_markup=markup)
+
+
+BOOKS_CALLBACK = "books:"
+BOOKS_PAGE_SIZE = 20
+
+
+def render_books_page(office: str, page: int):
+    """Return the text and pager buttons for one page of the office book list."""
+    # Fetch one extra row to know whether a next page exists.
+    books = db.get_office_books_page(
+        office, BOOKS_PAGE_SIZE + 1, page * BOOKS_PAGE_SIZE
+    )
+    if not books:
+        return "Нет книг", None
     lines = []
-    for b in books:
+    for b in books[:BOOKS_PAGE_SIZE]:
         if b.get("status") == "taken":
-            user = get_user(b.get("taken_by"))
-            if user:
-                account = f'{user.get("first_name", "")} {user.get("last_name", "")}'
+            if b.get("first_name") or b.get("last_name"):
+                account = f'{b.get("first_name") or ""} {b.get("last_name") or ""}'
             else:
                 account = str(b.get("taken_by"))
             status = f'взята {b.get("taken_date")}, {account.strip()}'
         else:
             status = "свободна"
         lines.append(f'{b.get("title")}: {status}')
-    await update.message.reply_text("\n".join(lines))
+    buttons = []
+    if page > 0:
+        buttons.append(
+            InlineKeyboardButton("◀️", callback_data=f"{BOOKS_CALLBACK}{page - 1}")
+        )
+    if len(books) > BOOKS_PAGE_SIZE:
+        buttons.append(
+            InlineKeyboardButton("▶️", callback_data=f"{BOOKS_CALLBACK}{page + 1}")
+        )
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+def cached_books_page(office: str, page: int):
+    """Return :func:`render_books_page`, reusing the rendering until books change."""
+    return listings.get_or_render(
+        office,
+        "books",
+        page,
+        db.office_version(office),
+        lambda: render_books_page(office, page),
+    )
+
+
+async def list_all_books(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    text, markup = cached_books_page(office, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def books_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show another page of the office book list from the inline pager."""
+    query = update.callback_query
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    page = int(query.data[len(BOOKS_CALLBACK):])
+    text, markup = cached_books_page(office, page)
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=markup)
 
 
 def get_handlers() -> list:
@@ -149,9 +376,13 @@ def get_handlers() -> list:
                 TAKE_QR: [
                     MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                     MessageHandler(~filters.COMMAND, take_book_get_qr),
-                ]
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
             },
             fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="take_book",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
         ),
         ConversationHandler(
             entry_points=[MessageHandler(filters.Regex("^📤 Вернуть книгу$"), return_book_start)],
@@ -159,11 +390,34 @@ def get_handlers() -> list:
                 RETURN_QR: [
                     MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                     MessageHandler(~filters.COMMAND, return_book_get_qr),
-                ]
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
+            },
+            fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="return_book",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
+        ),
+        ConversationHandler(
+            entry_points=[MessageHandler(filters.Regex("^🔎 Поиск$"), search_start)],
+            states={
+                SEARCH_QUERY: [
+                    MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
+                    MessageHandler(filters.TEXT & ~filters.COMMAND, search_get_query),
+                ],
+                ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
             },
             fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+            name="search",
+            persistent=True,
+            conversation_timeout=CONVERSATION_TIMEOUT,
         ),
+        CallbackQueryHandler(search_page, pattern=rf"^{SEARCH_CALLBACK}\d+$"),
+        CallbackQueryHandler(books_page, pattern=rf"^{BOOKS_CALLBACK}\d+$"),
         MessageHandler(filters.Regex("^📚 Мои книги$"), my_books),
+        CommandHandler("history", loan_history),
+        CallbackQueryHandler(return_book_button, pattern=f"^{RETURN_CALLBACK}"),
+        CallbackQueryHandler(reserve_book_button, pattern=f"^{RESERVE_CALLBACK}"),
         MessageHandler(filters.Regex("^📖 Все книги$"), list_all_books),
     ]
 
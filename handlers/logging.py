@@ -1,10 +1,22 @@
 from __future__ import annotations
 
-from telegram import Update
-from telegram.ext import CommandHandler, MessageHandler, ContextTypes, filters
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
 
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import (
+    CallbackQueryHandler,
+    CommandHandler,
+    ContextTypes,
+    JobQueue,
+    MessageHandler,
+    filters,
+)
+
+import config
 import db
-from utils import is_admin, get_user
+from utils import is_admin, is_global_admin, get_user
 from .start import ADMIN_KEYBOARD
 
 
@@ -14,10 +26,29 @@ async def log_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     if message:
         text = message.text or message.caption or ""
         try:
-            db.save_message(update.effective_user.id, text)
+            await asyncio.to_thread(db.save_message, update.effective_user.id, text)
         except Exception as exc:
             # Avoid crashing handlers if DB is unavailable
-            context.application.logger.error("Failed to log message: %s", exc)
+            logging.error("Failed to log message: %s", exc)
+
+
+async def purge_log(before: datetime) -> None:
+    """Remove the messages logged before ``before`` in small steps.
+
+    Every step is a short transaction in a worker thread, so new messages are
+    logged in between.
+    """
+    while await asyncio.to_thread(db.purge_messages, before, config.LOG_PURGE_BATCH):
+        await asyncio.sleep(0)
+
+
+async def _clear(update: Update) -> None:
+    try:
+        await purge_log(datetime.now(timezone.utc))
+    except db.DatabaseUnavailable:
+        await update.message.reply_text("База данных недоступна, логи удалены не полностью.")
+        return
+    await update.message.reply_text("Логи удалены.", reply_markup=ADMIN_KEYBOARD)
 
 
 async def clear_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -27,12 +58,125 @@ async def clear_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     if not is_admin(update.effective_user.id, office):
         await update.message.reply_text("Недостаточно прав.")
         return
-    db.delete_all_messages()
-    await update.message.reply_text("Логи удалены.", reply_markup=ADMIN_KEYBOARD)
+    # A large log takes a while; keep handling other updates meanwhile.
+    context.application.create_task(_clear(update), update=update)
+
+
+async def enforce_retention(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job removing messages older than ``MESSAGE_RETENTION_DAYS``."""
+    await asyncio.to_thread(db.ensure_message_partitions)
+    if config.MESSAGE_RETENTION_DAYS > 0:
+        await purge_log(
+            datetime.now(timezone.utc) - timedelta(days=config.MESSAGE_RETENTION_DAYS)
+        )
+
+
+LOGS_CALLBACK = "logs:"
+LOGS_PAGE_SIZE = 10
+LOGS_USAGE = (
+    "Формат: /logs [user:ID] [from:ГГГГ-ММ-ДД] [to:ГГГГ-ММ-ДД] [текст]\n"
+    "Время можно указать как ГГГГ-ММ-ДДTЧЧ:ММ (UTC)."
+)
+
+
+def _parse_moment(value: str, end: bool = False) -> datetime:
+    moment = datetime.fromisoformat(value)
+    if end and len(value) == 10:
+        # ``to:`` with a bare date includes that whole day.
+        moment += timedelta(days=1)
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def parse_log_query(query: str) -> dict:
+    """Return :func:`db.search_messages` filters for a ``/logs`` query.
+
+    Raise ``ValueError`` if a ``user:``, ``from:`` or ``to:`` value is invalid.
+    """
+    criteria, words = {}, []
+    for word in query.split():
+        key, _, value = word.partition(":")
+        if key == "user" and value:
+            criteria["user_id"] = int(value)
+        elif key == "from" and value:
+            criteria["since"] = _parse_moment(value)
+        elif key == "to" and value:
+            criteria["until"] = _parse_moment(value, end=True)
+        else:
+            words.append(word)
+    if words:
+        criteria["text"] = " ".join(words)
+    return criteria
+
+
+def render_logs_page(query: str, page: int):
+    """Return the text and pager buttons for one page of ``/logs`` results."""
+    # Fetch one extra row to know whether a next page exists.
+    messages = db.search_messages(
+        **parse_log_query(query), limit=LOGS_PAGE_SIZE + 1, offset=page * LOGS_PAGE_SIZE
+    )
+    if not messages:
+        return "Сообщения не найдены.", None
+    lines = [f"📜 Журнал, стр. {page + 1}:"]
+    for m in messages[:LOGS_PAGE_SIZE]:
+        text = m["text"] or ""
+        if len(text) > 200:
+            text = text[:200] + "…"
+        lines.append(f'{m["created_at"]:%Y-%m-%d %H:%M} {m["user_id"]}: {text}')
+    buttons = []
+    if page:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{LOGS_CALLBACK}{page - 1}"))
+    if len(messages) > LOGS_PAGE_SIZE:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{LOGS_CALLBACK}{page + 1}"))
+    return "\n".join(lines), InlineKeyboardMarkup([buttons]) if buttons else None
+
+
+async def search_logs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Search the message log by user, time range and text (global admins)."""
+    if not is_global_admin(update.effective_user.id):
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    query = " ".join(context.args)
+    try:
+        parse_log_query(query)
+    except ValueError:
+        await update.message.reply_text(LOGS_USAGE)
+        return
+    context.user_data["log_query"] = query
+    text, markup = await asyncio.to_thread(render_logs_page, query, 0)
+    await update.message.reply_text(text, reply_markup=markup)
+
+
+async def logs_page(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show another page of the last ``/logs`` query from the inline pager."""
+    query = update.callback_query
+    log_query = context.user_data.get("log_query")
+    if log_query is None or not is_global_admin(update.effective_user.id):
+        await query.answer("Поиск устарел, повторите запрос.", show_alert=True)
+        return
+    page = int(query.data[len(LOGS_CALLBACK):])
+    text, markup = await asyncio.to_thread(render_logs_page, log_query, page)
+    await query.answer()
+    await query.edit_message_text(text, reply_markup=markup)
 
 
 def get_handlers() -> list:
     return [
         CommandHandler("clear_logs", clear_logs),
-        MessageHandler(filters.ALL, log_message, block=False),
+        CommandHandler("logs", search_logs),
+        CallbackQueryHandler(logs_page, pattern=rf"^{LOGS_CALLBACK}\d+$"),
     ]
+
+
+def get_log_handler() -> MessageHandler:
+    """Handler storing every message; register it in a group of its own."""
+    return MessageHandler(filters.ALL, log_message, block=False)
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the message log retention job."""
+    job_queue.run_repeating(
+        enforce_retention,
+        interval=timedelta(minutes=config.LOG_RETENTION_MINUTES),
+        first=timedelta(minutes=1),
+        name="log_retention",
+    )
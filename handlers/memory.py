@@ -0,0 +1,183 @@
+from __future__ import annotations
+
+import logging
+import sys
+import time
+from collections.abc import Mapping
+from datetime import timedelta
+
+from telegram import Update
+from telegram.ext import (
+    Application,
+    CommandHandler,
+    ContextTypes,
+    ConversationHandler,
+    JobQueue,
+    TypeHandler,
+)
+
+import config
+import offline
+from render_cache import listings
+from utils import is_global_admin
+from .start import CONVERSATION_TIMEOUT, FLOW_KEYS
+
+# ``bot_data`` key of the ``{"user": {id: seen}, "chat": {id: seen}}``
+# monotonic timestamps of the last update from every user and chat.
+LAST_SEEN = "last_seen"
+
+
+def approx_size(obj, seen=None) -> int:
+    """Return the approximate memory taken by ``obj`` and everything it holds."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, Mapping):
+        size += sum(approx_size(k, seen) + approx_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += approx_size(vars(obj), seen)
+    return size
+
+
+def _format_size(size: int) -> str:
+    return f"{size / 1024:.1f} КБ"
+
+
+def _conversations(application: Application) -> dict:
+    """Return the live conversation keys of every named dialog."""
+    return {
+        handler.name: handler._conversations  # no public accessor in PTB 20
+        for handlers in application.handlers.values()
+        for handler in handlers
+        if isinstance(handler, ConversationHandler) and handler.name
+    }
+
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remember when the user and chat of ``update`` were last active."""
+    seen = context.bot_data.setdefault(LAST_SEEN, {"user": {}, "chat": {}})
+    now = time.monotonic()
+    if update.effective_user:
+        seen["user"][update.effective_user.id] = now
+    if update.effective_chat:
+        seen["chat"][update.effective_chat.id] = now
+
+
+def sweep(application: Application, idle_seconds: float) -> int:
+    """Drop ``user_data`` and ``chat_data`` not used for ``idle_seconds``.
+
+    Entries without a recorded activity, such as those restored from
+    persistence, start their idle clock at the first sweep. Return the number
+    of dropped entries.
+    """
+    seen = application.bot_data.setdefault(LAST_SEEN, {"user": {}, "chat": {}})
+    now = time.monotonic()
+    dropped = 0
+    for kind, store, drop in (
+        ("user", application.user_data, application.drop_user_data),
+        ("chat", application.chat_data, application.drop_chat_data),
+    ):
+        last = seen[kind]
+        for key in list(store):
+            if key not in last:
+                last[key] = now
+            elif now - last[key] > idle_seconds:
+                drop(key)
+                dropped += 1
+        for key in [k for k, t in last.items() if now - t > idle_seconds]:
+            del last[key]
+    return dropped
+
+
+async def sweep_state(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Periodic job dropping the data of inactive users and chats."""
+    # Never drop the data of a dialog that can still be in progress.
+    idle = max(config.STATE_IDLE_HOURS * 3600, config.CONVERSATION_TIMEOUT_MINUTES * 60)
+    dropped = sweep(context.application, idle)
+    if dropped:
+        logging.info("Dropped %d idle user and chat data entries", dropped)
+
+
+def expire_restored_dialogs(application: Application) -> int:
+    """End the dialogs restored from persistence that saw no update since.
+
+    PTB does not re-arm ``conversation_timeout`` for restored states. Every
+    update of a dialog with a timeout starts a timeout job, so a dialog
+    without one is still the restored state. Return the number of ended
+    dialogs.
+    """
+    ended = 0
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if not isinstance(handler, ConversationHandler) or not handler.conversation_timeout:
+                continue
+            for key in [k for k in handler._conversations if k not in handler.timeout_jobs]:
+                del handler._conversations[key]
+                # Keys end with the user id for per-user dialogs.
+                if handler.per_user and key[-1] in application.user_data:
+                    for flow_key in FLOW_KEYS:
+                        application.user_data[key[-1]].pop(flow_key, None)
+                ended += 1
+    return ended
+
+
+async def expire_restored(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """One-off job ending restored dialogs idle for ``CONVERSATION_TIMEOUT``."""
+    ended = expire_restored_dialogs(context.application)
+    if ended:
+        logging.info("Ended %d dialogs restored after a restart and left idle", ended)
+
+
+async def memory_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show live dialogs and the approximate size of in-process stores."""
+    if not is_global_admin(update.effective_user.id):
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    app = context.application
+    conversations = _conversations(app)
+    lines = [f"🧠 Активные диалоги: {sum(len(c) for c in conversations.values())}"]
+    lines.extend(f"  {name}: {len(c)}" for name, c in conversations.items() if c)
+    stores = [
+        ("user_data", app.user_data),
+        ("chat_data", app.chat_data),
+        ("bot_data", app.bot_data),
+        ("Диалоги", conversations),
+        ("Кэш списков", listings),
+        ("Офлайн-кэш пользователей", offline.cache.users),
+        ("Офлайн-кэш книг", offline.cache.books),
+    ]
+    lines.append("Память (примерно):")
+    lines.extend(
+        f"  {name}: {len(store)} зап., {_format_size(approx_size(store))}"
+        for name, store in stores
+    )
+    await update.message.reply_text("\n".join(lines))
+
+
+def get_activity_handler() -> TypeHandler:
+    """Handler recording activity; register it in a group before the others."""
+    return TypeHandler(Update, track_activity)
+
+
+def get_handlers() -> list:
+    return [CommandHandler("memory", memory_report)]
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the sweep of inactive user and chat data."""
+    job_queue.run_repeating(
+        sweep_state,
+        interval=timedelta(minutes=config.STATE_SWEEP_MINUTES),
+        first=timedelta(minutes=config.STATE_SWEEP_MINUTES),
+        name="state_sweep",
+    )
+    if CONVERSATION_TIMEOUT:
+        # Restored dialogs get no timeout of their own; end the idle ones
+        # once the timeout has passed since the start.
+        job_queue.run_once(
+            expire_restored, when=CONVERSATION_TIMEOUT, name="restored_dialog_expiry"
+        )
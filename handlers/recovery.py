@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram import Bot, Update
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import ContextTypes, JobQueue
+
+import config
+import db
+import offline
+
+UNAVAILABLE_TEXT = "⚠️ База данных временно недоступна, попробуйте позже."
+
+
+CONFLICT_TEXTS = {
+    "take": (
+        "⚠️ Пока база данных была недоступна, вы взяли книгу {qr}, но сохранить "
+        "это не удалось: книга уже числится за другим сотрудником. "
+        "Обратитесь к администратору офиса."
+    ),
+    "return": (
+        "⚠️ Пока база данных была недоступна, вы вернули книгу {qr}, но сохранить "
+        "возврат не удалось. Обратитесь к администратору офиса."
+    ),
+}
+
+
+async def notify_reserver(bot: Bot, user_id: int, title: str) -> None:
+    """Tell a user that the book they waited for is now lent to them."""
+    kwargs = {}
+    if bot.rate_limiter:
+        kwargs["rate_limit_args"] = {"background": True}
+    try:
+        await bot.send_message(
+            user_id,
+            f'📗 Книга "{title}", которую вы ждали, возвращена и закреплена за вами.',
+            **kwargs,
+        )
+    except Forbidden:
+        logging.info("Waitlist notice to %s not delivered: bot blocked", user_id)
+    except TelegramError as exc:
+        logging.warning("Waitlist notice to %s failed: %s", user_id, exc)
+
+
+async def replay_pending(bot: Bot) -> None:
+    """Apply the offline journal in a worker thread, if anything is queued.
+
+    Called before a new take or return so the queued operations keep their
+    order, without blocking the event loop. Users who get a book from its
+    waitlist through a replayed return are notified.
+    """
+    if not offline.journal.pending():
+        return
+    handed_over = []
+    await asyncio.to_thread(offline.replay, handed_over)
+    for user_id, title in handed_over:
+        await notify_reserver(bot, user_id, title)
+
+
+async def notify_conflicts(bot: Bot) -> None:
+    """Tell users whose offline takes or returns the database rejected."""
+    kwargs = {}
+    if bot.rate_limiter:
+        kwargs["rate_limit_args"] = {"background": True}
+    for conflict_id, op, qr, user_id, _office in await asyncio.to_thread(
+        offline.journal.unnotified_conflicts
+    ):
+        try:
+            await bot.send_message(user_id, CONFLICT_TEXTS[op].format(qr=qr), **kwargs)
+        except Forbidden:
+            logging.info("Conflict notice to %s not delivered: bot blocked", user_id)
+        except TelegramError as exc:
+            logging.warning("Conflict notice to %s failed: %s", user_id, exc)
+            continue
+        await asyncio.to_thread(offline.journal.mark_notified, conflict_id)
+
+
+async def replay_offline_journal(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Apply takes and returns queued while the database was unavailable."""
+    await replay_pending(context.bot)
+    await notify_conflicts(context.bot)
+
+
+async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Answer right away when the database is down, log everything else."""
+    if not isinstance(context.error, db.DatabaseUnavailable):
+        logging.error("Exception while handling an update", exc_info=context.error)
+        return
+    logging.warning("Update not handled, database unavailable: %s", context.error)
+    if not isinstance(update, Update):
+        return
+    if update.callback_query:
+        await update.callback_query.answer(UNAVAILABLE_TEXT, show_alert=True)
+    elif update.effective_message:
+        await update.effective_message.reply_text(UNAVAILABLE_TEXT)
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the offline journal replay job."""
+    job_queue.run_repeating(
+        replay_offline_journal,
+        interval=timedelta(seconds=config.OFFLINE_REPLAY_SECONDS),
+        first=timedelta(seconds=config.OFFLINE_REPLAY_SECONDS),
+        name="offline_journal_replay",
+    )
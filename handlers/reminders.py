@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from itertools import groupby
+
+from telegram.error import Forbidden, TelegramError
+from telegram.ext import ContextTypes, JobQueue
+
+import config
+import db
+from utils import overdue_cutoff
+
+# Borrowers handled per batch. Delivered reminders are recorded after every
+# batch, so a restart resends at most one batch.
+BATCH_SIZE = 50
+
+
+def render_digest(loans: list) -> str:
+    lines = ["⏰ Пора вернуть книги:"]
+    lines.extend(f'• {b.get("title")} (взята {b.get("taken_date")})' for b in loans)
+    return "\n".join(lines)
+
+
+async def _send_digest(context: ContextTypes.DEFAULT_TYPE, user_id: int, loans: list) -> bool:
+    """Send one digest and return True if it should be recorded as delivered."""
+    kwargs = {}
+    if context.bot.rate_limiter:
+        kwargs["rate_limit_args"] = {"background": True}
+    try:
+        await context.bot.send_message(user_id, render_digest(loans), **kwargs)
+    except Forbidden:
+        # The user blocked the bot; retrying will not help.
+        logging.info("Reminder to %s not delivered: bot blocked", user_id)
+    except TelegramError as exc:
+        logging.warning("Reminder to %s failed: %s", user_id, exc)
+        return False
+    return True
+
+
+async def send_overdue_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send one digest per borrower listing their overdue books."""
+    now = datetime.now(timezone.utc)
+    resend_before = now - timedelta(days=config.REMINDER_REPEAT_DAYS)
+    loans = await asyncio.to_thread(
+        db.get_pending_reminders, overdue_cutoff(), resend_before
+    )
+    by_user = [
+        (user_id, list(group))
+        for user_id, group in groupby(loans, key=lambda b: b["taken_by"])
+    ]
+    sent = 0
+    for start in range(0, len(by_user), BATCH_SIZE):
+        batch = by_user[start:start + BATCH_SIZE]
+        results = await asyncio.gather(
+            *(_send_digest(context, user_id, group) for user_id, group in batch)
+        )
+        delivered = [
+            loan for ok, (_, group) in zip(results, batch) if ok for loan in group
+        ]
+        if delivered:
+            await asyncio.to_thread(db.mark_reminders_sent, delivered, now)
+        sent += sum(results)
+    if by_user:
+        logging.info("Sent %d of %d overdue reminders", sent, len(by_user))
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the overdue reminder job."""
+    job_queue.run_repeating(
+        send_overdue_reminders,
+        interval=timedelta(hours=config.REMINDER_INTERVAL_HOURS),
+        first=timedelta(minutes=1),
+        name="overdue_reminders",
+    )
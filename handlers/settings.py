@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import logging
+from datetime import timedelta
+
+from telegram.ext import ContextTypes, JobQueue
+
+import config
+
+
+async def reload_config(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Apply administrator and office changes made while the bot runs."""
+    try:
+        if config.reload_if_changed():
+            logging.info("Configuration reloaded")
+    except (OSError, ValueError) as exc:
+        logging.error("Configuration reload failed, keeping previous settings: %s", exc)
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the configuration reload check."""
+    if config.CONFIG_RELOAD_SECONDS <= 0:
+        return
+    job_queue.run_repeating(
+        reload_config,
+        interval=timedelta(seconds=config.CONFIG_RELOAD_SECONDS),
+        first=timedelta(seconds=config.CONFIG_RELOAD_SECONDS),
+        name="config_reload",
+    )
@@ -1,9 +1,17 @@
 from __future__ import annotations
 
 from telegram import ReplyKeyboardMarkup, Update
-from telegram.ext import CommandHandler, ConversationHandler, MessageHandler, ContextTypes, filters
+from telegram.ext import (
+    CommandHandler,
+    ConversationHandler,
+    MessageHandler,
+    ContextTypes,
+    TypeHandler,
+    filters,
+)
 
 import config
+import db
 from utils import (
     get_user,
     register_user,
@@ -26,7 +34,7 @@ CANCEL_KEYBOARD = ReplyKeyboardMarkup(
 
 def get_office_keyboard() -> ReplyKeyboardMarkup:
     """Return a keyboard with available office names."""
-    offices = getattr(config, "OFFICES", {})
+    offices = config.index().offices
     keyboard = [[info.get("name", key)] for key, info in offices.items()]
     keyboard.append([CANCEL_TEXT])
     return ReplyKeyboardMarkup(
@@ -41,24 +49,38 @@ USER_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["🔍 Взять книгу", "📤 Вернуть книгу"],
         ["📚 Мои книги", "🏢 Сменить офис"],
-        ["📖 Все книги"],
+        ["📖 Все книги", "🔎 Поиск"],
     ],
     resize_keyboard=True,
 )
 ADMIN_KEYBOARD = ReplyKeyboardMarkup(
     [
         ["🔍 Взять книгу", "📤 Вернуть книгу"],
-        ["📚 Мои книги", "📖 Все книги"],
+        ["📚 Мои книги", "📖 Все книги", "🔎 Поиск"],
         ["➕ Добавить книгу", "📊 Отчёт по библиотеке"],
         ["🔁 Сброс книги", "👤 Список пользователей"],
         ["🗑 Удалить пользователя", "🏢 Сменить офис"],
+        ["📥 Импорт", "📄 Экспорт"],
     ],
     resize_keyboard=True,
 )
 
 
+# ``user_data`` keys that only live while a dialog is in progress.
+FLOW_KEYS = ("last_name", "first_name", "qr")
+
+# Idle time after which a dialog is cancelled; ``None`` disables the timeout.
+CONVERSATION_TIMEOUT = config.CONVERSATION_TIMEOUT_MINUTES * 60 or None
+
+
+def clear_flow_data(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for key in FLOW_KEYS:
+        context.user_data.pop(key, None)
+
+
 async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle action cancellation and show the main menu."""
+    clear_flow_data(context)
     user = get_user(update.effective_user.id)
     office = user.get("office") if user else None
     keyboard = ADMIN_KEYBOARD if is_admin(update.effective_user.id, office) else USER_KEYBOARD
@@ -66,6 +88,23 @@ async def cancel_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     return ConversationHandler.END
 
 
+async def timeout_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Drop the data of a dialog left idle for ``CONVERSATION_TIMEOUT``."""
+    clear_flow_data(context)
+    user = get_user(update.effective_user.id)
+    office = user.get("office") if user else None
+    keyboard = ADMIN_KEYBOARD if is_admin(update.effective_user.id, office) else USER_KEYBOARD
+    await context.bot.send_message(
+        update.effective_chat.id,
+        "⌛ Время ожидания истекло, действие отменено.",
+        reply_markup=keyboard,
+    )
+
+
+# Added to the states of every dialog together with ``CONVERSATION_TIMEOUT``.
+TIMEOUT_HANDLERS = [TypeHandler(Update, timeout_action)]
+
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id = update.effective_user.id
     user = get_user(user_id)
@@ -119,6 +158,7 @@ async def get_office(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         context.user_data.get("last_name", ""),
         office,
     )
+    clear_flow_data(context)
     keyboard = ADMIN_KEYBOARD if is_admin(user_id, office) else USER_KEYBOARD
     await update.message.reply_text(
         "✅ Регистрация успешна.", reply_markup=keyboard
@@ -172,8 +212,12 @@ def get_handler() -> ConversationHandler:
                 MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, get_office),
             ],
+            ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
         },
         fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+        name="registration",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
 
@@ -184,12 +228,26 @@ def get_change_office_handler() -> ConversationHandler:
             NEW_OFFICE: [
                 MessageHandler(filters.Regex(CANCEL_RE), cancel_action),
                 MessageHandler(filters.TEXT & ~filters.COMMAND, set_new_office),
-            ]
+            ],
+            ConversationHandler.TIMEOUT: TIMEOUT_HANDLERS,
         },
         fallbacks=[MessageHandler(filters.Regex(CANCEL_RE), cancel_action)],
+        name="change_office",
+        persistent=True,
+        conversation_timeout=CONVERSATION_TIMEOUT,
     )
 
 
+async def note_reader(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Attribute the database reads made for ``update`` to its user."""
+    db.set_reader(update.effective_user.id if update.effective_user else None)
+
+
+def get_reader_handler() -> TypeHandler:
+    """Handler used for read-your-writes; register it in a group before the others."""
+    return TypeHandler(Update, note_reader)
+
+
 async def main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send the main menu keyboard based on user role."""
     user = get_user(update.effective_user.id)
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import asyncio
+import logging
+from datetime import timedelta
+
+from telegram import Update
+from telegram.ext import CommandHandler, ContextTypes, JobQueue
+
+import config
+import db
+from utils import is_global_admin
+
+
+def render_office_stats(stats: dict) -> str:
+    name = config.index().offices.get(stats["office"], {}).get("name", stats["office"])
+    return (
+        f'{name}: всего {stats["total"]}, свободно {stats["available"]}, '
+        f'взято {stats["taken"]}, просрочено {stats["overdue"]}'
+    )
+
+
+async def dashboard(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Show the summary counters of every office (global admins only)."""
+    if not is_global_admin(update.effective_user.id):
+        await update.message.reply_text("Недостаточно прав.")
+        return
+    stats = await asyncio.to_thread(db.get_office_stats)
+    if not stats:
+        await update.message.reply_text("Нет книг")
+        return
+    lines = ["📊 Сводка по офисам:"]
+    lines.extend(render_office_stats(s) for s in stats)
+    totals = {
+        key: sum(s[key] for s in stats)
+        for key in ("total", "available", "taken", "overdue")
+    }
+    lines.append(render_office_stats({"office": "Итого", **totals}))
+    await update.message.reply_text("\n".join(lines))
+
+
+async def reconcile_office_stats(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Recount the office counters; also refreshes the overdue numbers."""
+    try:
+        await asyncio.to_thread(db.reconcile_office_stats)
+    except Exception as exc:
+        logging.warning("Office stats reconciliation failed: %s", exc)
+
+
+def get_handlers() -> list:
+    return [CommandHandler("dashboard", dashboard)]
+
+
+def schedule(job_queue: JobQueue) -> None:
+    """Register the office stats reconciliation job."""
+    job_queue.run_repeating(
+        reconcile_office_stats,
+        interval=timedelta(minutes=config.STATS_RECONCILE_MINUTES),
+        first=timedelta(minutes=config.STATS_RECONCILE_MINUTES),
+        name="office_stats_reconcile",
+    )
@@ -0,0 +1,226 @@
+"""Bulk import of books and employees from CSV or JSON Lines files.
+
+Files are parsed as a stream, validated in chunks and every chunk is written
+with a single batched upsert, so large catalogues never have to fit in memory.
+Books need ``qr_code``, ``title`` and optionally ``office``; employees need
+``telegram_id``, ``first_name``, ``last_name`` and optionally ``office``.
+
+Command line usage::
+
+    python importer.py books.csv --office SokolGora
+    python importer.py employees.jsonl
+"""
+
+from __future__ import annotations
+
+import argparse
+import csv
+import io
+import json
+import logging
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import db
+from utils import is_admin, log_action, resolve_office_name
+
+CHUNK_SIZE = 500
+BOOKS = "books"
+USERS = "users"
+
+
+class ImportResult:
+    """Counters and validation errors collected during an import."""
+
+    def __init__(self, kind: Optional[str] = None) -> None:
+        self.kind = kind
+        self.processed = 0
+        self.imported = 0
+        self.errors: List[Tuple[int, str]] = []
+
+    def summary(self) -> str:
+        return (
+            f"{self.processed} строк, импортировано {self.imported}, "
+            f"ошибок {len(self.errors)}"
+        )
+
+
+def detect_format(filename: str) -> str:
+    suffix = Path(filename).suffix.lower()
+    if suffix in (".jsonl", ".ndjson"):
+        return "jsonl"
+    if suffix == ".json":
+        return "json"
+    return "csv"
+
+
+def iter_records(stream: io.TextIOBase, fmt: str) -> Iterator[Tuple[int, Any]]:
+    """Yield ``(line number, record)`` pairs from a text stream."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            yield reader.line_num, record
+    elif fmt == "jsonl":
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except json.JSONDecodeError as exc:
+                # Reported by import_records like any other invalid row.
+                yield line_no, ValueError(f"некорректный JSON: {exc.msg}")
+    else:
+        # Plain JSON arrays such as data/books.json have to be read whole.
+        yield from enumerate(json.load(stream), 1)
+
+
+def _text(record: Dict[str, Any], key: str) -> str:
+    return str(record.get(key) or "").strip()
+
+
+def _office(record: Dict[str, Any], default_office: Optional[str], allowed: Optional[Set[str]]) -> str:
+    name = _text(record, "office")
+    office = resolve_office_name(name) if name else default_office
+    if not office:
+        raise ValueError(f"неизвестный офис {name!r}" if name else "не указан офис")
+    if allowed is not None and office not in allowed:
+        raise ValueError(f"нет прав на офис {office}")
+    return office
+
+
+def validate_book(record: Dict[str, Any], default_office: Optional[str], allowed: Optional[Set[str]]) -> Dict[str, Any]:
+    qr = _text(record, "qr_code")
+    title = _text(record, "title")
+    if not qr:
+        raise ValueError("не указан qr_code")
+    if not title:
+        raise ValueError("не указано название")
+    return {"qr_code": qr, "title": title, "office": _office(record, default_office, allowed)}
+
+
+def validate_user(record: Dict[str, Any], default_office: Optional[str], allowed: Optional[Set[str]]) -> Dict[str, Any]:
+    telegram_id = _text(record, "telegram_id")
+    if not telegram_id.isdigit():
+        raise ValueError(f"некорректный telegram_id {telegram_id!r}")
+    first_name = _text(record, "first_name")
+    last_name = _text(record, "last_name")
+    if not first_name or not last_name:
+        raise ValueError("не указаны имя и фамилия")
+    office = _office(record, default_office, allowed)
+    return {
+        "telegram_id": int(telegram_id),
+        "first_name": first_name,
+        "last_name": last_name,
+        "office": office,
+        "role": "admin" if is_admin(int(telegram_id), office) else "user",
+    }
+
+
+def _detect_kind(record: Dict[str, Any]) -> str:
+    if "qr_code" in record:
+        return BOOKS
+    if "telegram_id" in record:
+        return USERS
+    raise ValueError("не удалось определить тип файла: нужна колонка qr_code или telegram_id")
+
+
+def import_records(
+    records: Iterable[Tuple[int, Any]],
+    kind: Optional[str] = None,
+    default_office: Optional[str] = None,
+    allowed_offices: Optional[Set[str]] = None,
+    chunk_size: int = CHUNK_SIZE,
+    progress: Optional[Callable[[ImportResult], None]] = None,
+) -> ImportResult:
+    """Validate ``records`` and write them in batches of ``chunk_size``.
+
+    ``kind`` is detected from the first record when omitted. Rows for offices
+    outside ``allowed_offices``, and rows that would move a book or employee
+    of such an office, are rejected; ``None`` allows every office.
+    ``progress`` is called with the running result after every chunk.
+    """
+    result = ImportResult(kind)
+    chunk: Dict[Any, Dict[str, Any]] = {}
+    # Line number of the row kept in ``chunk`` for every key.
+    lines: Dict[Any, int] = {}
+
+    def flush() -> None:
+        if not chunk:
+            return
+        rows = list(chunk.values())
+        if result.kind == BOOKS:
+            skipped = db.import_books(rows, allowed_offices)
+            error = "книга относится к другому офису"
+        else:
+            skipped = db.import_users(rows, allowed_offices)
+            error = "сотрудник относится к другому офису"
+        result.errors.extend((lines[key], error) for key in skipped)
+        result.errors.sort()
+        result.imported += len(rows) - len(skipped)
+        chunk.clear()
+        lines.clear()
+        if progress:
+            progress(result)
+
+    for line_no, record in records:
+        result.processed += 1
+        try:
+            if isinstance(record, ValueError):
+                raise record
+            if not isinstance(record, dict):
+                raise ValueError("ожидался объект")
+            if result.kind is None:
+                result.kind = _detect_kind(record)
+            if result.kind == BOOKS:
+                row = validate_book(record, default_office, allowed_offices)
+                key = row["qr_code"]
+            else:
+                row = validate_user(record, default_office, allowed_offices)
+                key = row["telegram_id"]
+        except ValueError as exc:
+            result.errors.append((line_no, str(exc)))
+            continue
+        # The last occurrence of a duplicated key wins, as it would row by row.
+        chunk[key] = row
+        lines[key] = line_no
+        if len(chunk) >= chunk_size:
+            flush()
+    flush()
+    log_action("import", {"kind": result.kind, "imported": result.imported})
+    return result
+
+
+def import_file(path: str, **kwargs: Any) -> ImportResult:
+    """Import a CSV, JSON Lines or JSON file; see :func:`import_records`."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        return import_records(iter_records(f, detect_format(path)), **kwargs)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="Import books or employees.")
+    parser.add_argument("path", help="CSV, JSONL or JSON file")
+    parser.add_argument("--kind", choices=[BOOKS, USERS], help="Detected when omitted.")
+    parser.add_argument("--office", help="Office for rows without one.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    db.init_db()
+    default_office = resolve_office_name(args.office) if args.office else None
+    if args.office and not default_office:
+        parser.error(f"unknown office {args.office!r}")
+
+    result = import_file(
+        args.path,
+        kind=args.kind,
+        default_office=default_office,
+        chunk_size=args.chunk_size,
+        progress=lambda r: print(f"... {r.summary()}", flush=True),
+    )
+    print(f"{result.kind}: {result.summary()}")
+    for line_no, error in result.errors[:50]:
+        print(f"  строка {line_no}: {error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,28 +8,36 @@ import atexit
 from telegram.ext import Application
 
 import config
+from outbound import SendQueue
+from persistence import DBPersistence
 from handlers.start import (
     get_handler as start_handler,
     get_menu_handler,
     get_change_office_handler,
+    get_reader_handler,
 )
 from handlers.books import get_handlers as books_handlers
 from handlers.admin import get_handlers as admin_handlers
-from handlers.logging import get_handlers as logging_handlers
+from handlers.logging import (
+    get_handlers as logging_handlers,
+    get_log_handler,
+    schedule as schedule_log_retention,
+)
+from handlers import audit, memory, recovery, reminders, settings, stats
 import db
 
 LOCK_FILE = "/tmp/hrbook_bot.lock"
 
 
-def acquire_lock() -> None:
+def acquire_lock(path: str = LOCK_FILE) -> None:
     """Create a lock file to ensure a single running instance."""
     try:
-        fd = os.open(LOCK_FILE, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
         with os.fdopen(fd, "w") as f:
             f.write(str(os.getpid()))
     except FileExistsError:
         try:
-            with open(LOCK_FILE, "r", encoding="utf-8") as f:
+            with open(path, "r", encoding="utf-8") as f:
                 pid = f.read().strip()
         except OSError:
             pid = "unknown"
@@ -37,14 +45,67 @@ def acquire_lock() -> None:
         sys.exit(1)
 
 
-def release_lock() -> None:
+def release_lock(path: str = LOCK_FILE) -> None:
     """Remove the lock file on shutdown."""
     try:
-        os.remove(LOCK_FILE)
+        os.remove(path)
     except OSError:
         pass
 
 
+def build_application(token: str, reload_config: bool = True) -> Application:
+    """Return an application with every handler and job of the bot.
+
+    ``reload_config`` schedules the hot reload of ``.env`` and the offices
+    file; tenants of the multi-tenant runner have fixed settings.
+    """
+    application = (
+        Application.builder()
+        .token(token)
+        .rate_limiter(SendQueue())
+        .persistence(DBPersistence())
+        .build()
+    )
+
+    application.add_handler(start_handler())
+    application.add_handler(get_menu_handler())
+    application.add_handler(get_change_office_handler())
+    for handler in books_handlers():
+        application.add_handler(handler)
+    for handler in admin_handlers():
+        application.add_handler(handler)
+    for handler in audit.get_handlers():
+        application.add_handler(handler)
+    for handler in stats.get_handlers():
+        application.add_handler(handler)
+    for handler in memory.get_handlers():
+        application.add_handler(handler)
+    application.add_handler(get_reader_handler(), group=-2)
+    application.add_handler(memory.get_activity_handler(), group=-1)
+    for handler in logging_handlers():
+        application.add_handler(handler, group=100)
+    # Only the first matching handler of a group runs, so the logger must not
+    # share a group with the /logs and /clear_logs commands.
+    application.add_handler(get_log_handler(), group=101)
+    application.add_error_handler(recovery.on_error)
+
+    if application.job_queue:
+        reminders.schedule(application.job_queue)
+        stats.schedule(application.job_queue)
+        recovery.schedule(application.job_queue)
+        memory.schedule(application.job_queue)
+        schedule_log_retention(application.job_queue)
+        if reload_config:
+            settings.schedule(application.job_queue)
+    else:
+        logging.warning(
+            "JobQueue unavailable, reminders, stats reconciliation, "
+            "offline journal replay, dialog timeouts, state sweeping, "
+            "message log retention and configuration reloading are disabled"
+        )
+    return application
+
+
 def main() -> None:
     logging.basicConfig(
         level=logging.INFO,
@@ -52,25 +113,19 @@ def main() -> None:
     )
     acquire_lock()
     atexit.register(release_lock)
-    application = Application.builder().token(config.BOT_TOKEN).build()
 
     try:
         db.init_db()
     except Exception as exc:
         logging.error("Database unavailable: %s", exc)
 
-    application.add_handler(start_handler())
-    application.add_handler(get_menu_handler())
-    application.add_handler(get_change_office_handler())
-    for handler in books_handlers():
-        application.add_handler(handler)
-    for handler in admin_handlers():
-        application.add_handler(handler)
-    for handler in logging_handlers():
-        application.add_handler(handler, group=100)
+    application = build_application(config.BOT_TOKEN)
 
     logging.info("Bot started")
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        db.close_connections()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,744 @@
+"""In-memory storage backend with JSON snapshots.
+
+Selected with ``DB_ENGINE=memory``. All data lives in dicts indexed the way
+the bot queries it (users by ID and by name, books by QR code, office and
+borrower), so lookups take microseconds. A background thread writes the data
+to ``users.json``, ``books.json``, ``loans.json``, ``reminders.json``,
+``messages.json`` and ``state.json`` in ``MEMORY_DATA_DIR`` every ``MEMORY_SNAPSHOT_SECONDS``
+when something changed, and :meth:`MemoryBackend.close_connections` writes a
+final snapshot. Changes made after the last snapshot are lost if the process
+crashes, so the engine is meant for small deployments and tests.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import db
+
+
+def _copy(record):
+    return type(record)(*(record[f] for f in record._fields))
+
+
+def _date(value: Optional[str]) -> Optional[date]:
+    return date.fromisoformat(value) if value else None
+
+
+def _datetime(value: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(value) if value else None
+
+
+def _iso(value) -> Optional[str]:
+    return value.isoformat() if value is not None else None
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", (text or "").lower())
+
+
+class MemoryBackend(db.StorageBackend):
+    """:class:`db.StorageBackend` on indexed dicts."""
+
+    def __init__(self, data_dir: str, snapshot_interval: float) -> None:
+        self.data_dir = data_dir
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.RLock()
+        # Undo records of the open transaction, ``None`` outside one.
+        self._undo: Optional[List[Tuple[str, Any, Any]]] = None
+        self._dirty = False
+        self._loaded = False
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.users: Dict[int, Any] = {}
+        self.users_by_name: Dict[Tuple[str, str, str], int] = {}
+        self.books: Dict[str, Any] = {}
+        # Dicts used as insertion-ordered sets of QR codes.
+        self.books_by_office: Dict[str, Dict[str, None]] = defaultdict(dict)
+        self.books_by_holder: Dict[int, Dict[str, None]] = defaultdict(dict)
+        self.loans: List[Dict[str, Any]] = []
+        self.loans_by_user: Dict[int, List[Dict[str, Any]]] = defaultdict(list)
+        self.reminders: Dict[Tuple[str, int, date], datetime] = {}
+        self.messages: List[Dict[str, Any]] = []
+        self.state: Dict[Tuple[str, str], str] = {}
+        # QR code -> ``(user_id, created_at)`` waitlist, oldest first.
+        self.reservations: Dict[str, List[Tuple[int, datetime]]] = {}
+
+    # Primitive writes. Every change goes through them so indexes stay in
+    # sync and an open transaction can be rolled back.
+
+    def _record(self, kind: str, key: Any, old: Any) -> None:
+        self._dirty = True
+        if self._undo is not None:
+            self._undo.append((kind, key, old))
+
+    def _put_user(self, user, record: bool = True) -> None:
+        old = self.users.get(user["telegram_id"])
+        if record:
+            self._record("user", user["telegram_id"], old)
+        if old is not None:
+            self.users_by_name.pop((old["first_name"], old["last_name"], old["office"]), None)
+        self.users[user["telegram_id"]] = user
+        self.users_by_name[(user["first_name"], user["last_name"], user["office"])] = user[
+            "telegram_id"
+        ]
+
+    def _drop_user(self, telegram_id: int, record: bool = True) -> None:
+        old = self.users.pop(telegram_id, None)
+        if old is None:
+            return
+        if record:
+            self._record("user", telegram_id, old)
+        key = (old["first_name"], old["last_name"], old["office"])
+        if self.users_by_name.get(key) == telegram_id:
+            del self.users_by_name[key]
+
+    def _put_book(self, book, record: bool = True) -> None:
+        old = self.books.get(book["qr_code"])
+        if record:
+            self._record("book", book["qr_code"], old)
+        if old is not None:
+            self.books_by_office[old["office"]].pop(old["qr_code"], None)
+            if old["taken_by"] is not None:
+                self.books_by_holder[old["taken_by"]].pop(old["qr_code"], None)
+        self.books[book["qr_code"]] = book
+        self.books_by_office[book["office"]][book["qr_code"]] = None
+        if book["status"] == "taken" and book["taken_by"] is not None:
+            self.books_by_holder[book["taken_by"]][book["qr_code"]] = None
+
+    def _add_loan(self, loan: Dict[str, Any], record: bool = True) -> None:
+        if record:
+            self._record("loan", None, None)
+        self.loans.append(loan)
+        self.loans_by_user[loan["user_id"]].append(loan)
+
+    def _rollback(self, undo: List[Tuple[str, Any, Any]]) -> None:
+        for kind, key, old in reversed(undo):
+            if kind == "user":
+                if old is None:
+                    self._drop_user(key, record=False)
+                else:
+                    self._put_user(old, record=False)
+            elif kind == "book":
+                if old is None:
+                    book = self.books.pop(key)
+                    self.books_by_office[book["office"]].pop(key, None)
+                    if book["taken_by"] is not None:
+                        self.books_by_holder[book["taken_by"]].pop(key, None)
+                else:
+                    self._put_book(old, record=False)
+            elif kind == "loan":
+                loan = self.loans.pop()
+                self.loans_by_user[loan["user_id"]].pop()
+            elif kind == "reminder":
+                if old is None:
+                    self.reminders.pop(key, None)
+                else:
+                    self.reminders[key] = old
+            elif kind == "reservations":
+                if old is None:
+                    self.reservations.pop(key, None)
+                else:
+                    self.reservations[key] = old
+            elif kind == "message":
+                self.messages.pop()
+            elif kind == "purge":
+                self.messages[:0] = old
+            elif kind == "state":
+                if old is None:
+                    self.state.pop(key, None)
+                else:
+                    self.state[key] = old
+
+    # Lifecycle
+
+    def init_db(self) -> None:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+                self._loaded = True
+        if self._thread is None and self.snapshot_interval > 0:
+            self._stop.clear()
+            self._thread = threading.Thread(
+                target=self._snapshot_loop, name="memstore-snapshot", daemon=True
+            )
+            self._thread.start()
+
+    def close_connections(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._dirty:
+            self.snapshot()
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._undo is not None:
+                yield
+                return
+            self._undo = []
+            try:
+                yield
+            except BaseException:
+                self._rollback(self._undo)
+                raise
+            finally:
+                self._undo = None
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.data_dir, f"{name}.json")
+
+    def _read(self, name: str) -> list:
+        path = self._path(name)
+        if not os.path.exists(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _load(self) -> None:
+        for u in self._read("users"):
+            self._put_user(
+                db.User(u["telegram_id"], u["first_name"], u["last_name"], u["office"], u["role"]),
+                record=False,
+            )
+        for b in self._read("books"):
+            self._put_book(
+                db.Book(
+                    b["qr_code"],
+                    b["title"],
+                    b.get("status") or "available",
+                    b.get("taken_by"),
+                    _date(b.get("taken_date")),
+                    b.get("office"),
+                ),
+                record=False,
+            )
+        for loan in self._read("loans"):
+            loan["taken_at"] = _datetime(loan.get("taken_at"))
+            loan["created_at"] = _datetime(loan.get("created_at"))
+            self._add_loan(loan, record=False)
+        for r in self._read("reminders"):
+            key = (r["qr_code"], r["user_id"], _date(r["taken_date"]))
+            self.reminders[key] = _datetime(r["sent_at"])
+        for m in self._read("messages"):
+            m["created_at"] = _datetime(m.get("created_at"))
+            self.messages.append(m)
+        for r in self._read("reservations"):
+            self.reservations.setdefault(r["qr_code"], []).append(
+                (r["user_id"], _datetime(r["created_at"]))
+            )
+        for entry in self._read("state"):
+            self.state[(entry["kind"], entry["key"])] = entry["value"]
+        self._dirty = False
+
+    def snapshot(self) -> None:
+        """Write all data to the JSON files, replacing them atomically."""
+        with self._lock:
+            payload = {
+                "users": [dict(u) for u in self.users.values()],
+                "books": [
+                    dict(b, taken_date=_iso(b["taken_date"])) for b in self.books.values()
+                ],
+                "loans": [
+                    dict(loan, taken_at=_iso(loan["taken_at"]), created_at=_iso(loan["created_at"]))
+                    for loan in self.loans
+                ],
+                "reminders": [
+                    {
+                        "qr_code": qr,
+                        "user_id": user_id,
+                        "taken_date": _iso(taken_date),
+                        "sent_at": _iso(sent_at),
+                    }
+                    for (qr, user_id, taken_date), sent_at in self.reminders.items()
+                ],
+                "messages": [dict(m, created_at=_iso(m["created_at"])) for m in self.messages],
+                "reservations": [
+                    {"qr_code": qr, "user_id": user_id, "created_at": _iso(created_at)}
+                    for qr, waitlist in self.reservations.items()
+                    for user_id, created_at in waitlist
+                ],
+                "state": [
+                    {"kind": kind, "key": key, "value": value}
+                    for (kind, key), value in self.state.items()
+                ],
+            }
+            self._dirty = False
+        os.makedirs(self.data_dir, exist_ok=True)
+        for name, rows in payload.items():
+            tmp = self._path(name) + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(rows, f, ensure_ascii=False)
+            os.replace(tmp, self._path(name))
+
+    def _snapshot_loop(self) -> None:
+        while not self._stop.wait(self.snapshot_interval):
+            if not self._dirty:
+                continue
+            try:
+                self.snapshot()
+            except OSError as exc:
+                logging.error("Memory store snapshot failed: %s", exc)
+
+    # Messages
+
+    def save_message(self, user_id: int, text: str) -> None:
+        with self._lock:
+            self._record("message", None, None)
+            self.messages.append(
+                {"user_id": user_id, "text": text, "created_at": datetime.now(timezone.utc)}
+            )
+
+    def ensure_message_partitions(self) -> None:
+        pass
+
+    def purge_messages(self, before: datetime, batch_size: int) -> bool:
+        # Messages are kept in the order they were saved.
+        with self._lock:
+            count = 0
+            while (
+                count < min(batch_size, len(self.messages))
+                and self.messages[count]["created_at"] < before
+            ):
+                count += 1
+            if not count:
+                return False
+            self._record("purge", None, self.messages[:count])
+            del self.messages[:count]
+            return True
+
+    def search_messages(
+        self,
+        user_id: Optional[int] = None,
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        text: Optional[str] = None,
+        limit: int = 20,
+        offset: int = 0,
+    ) -> List[Dict[str, Any]]:
+        needle = text.casefold() if text else None
+        found = []
+        with self._lock:
+            for m in reversed(self.messages):
+                if until is not None and m["created_at"] >= until:
+                    continue
+                if since is not None and m["created_at"] < since:
+                    break
+                if user_id is not None and m["user_id"] != user_id:
+                    continue
+                if needle and needle not in (m["text"] or "").casefold():
+                    continue
+                found.append(dict(m))
+                if len(found) == offset + limit:
+                    break
+        return found[offset:]
+
+    # Users
+
+    def get_user(self, telegram_id: int):
+        user = self.users.get(telegram_id)
+        return _copy(user) if user is not None else None
+
+    def get_user_by_name(self, first_name: str, last_name: str, office: str):
+        telegram_id = self.users_by_name.get((first_name, last_name, office))
+        return self.get_user(telegram_id) if telegram_id is not None else None
+
+    def save_user(self, user: dict) -> None:
+        with self._lock:
+            self._put_user(db.User(*(user.get(f) for f in db.User._fields)))
+        db._bump_version(None)
+
+    def update_user_office(self, telegram_id: int, office: str, role: str) -> None:
+        with self._lock:
+            user = self.users.get(telegram_id)
+            if user is None:
+                return
+            updated = _copy(user)
+            updated.update({"office": office, "role": role})
+            self._put_user(updated)
+        db._bump_version(None)
+
+    def _set_waitlist(self, qr: str, waitlist: List[Tuple[int, datetime]]) -> None:
+        self._record("reservations", qr, self.reservations.get(qr))
+        if waitlist:
+            self.reservations[qr] = waitlist
+        else:
+            self.reservations.pop(qr, None)
+
+    def delete_user(self, telegram_id: int) -> None:
+        with self._lock:
+            self._drop_user(telegram_id)
+            for qr, waitlist in list(self.reservations.items()):
+                if any(user_id == telegram_id for user_id, _ in waitlist):
+                    self._set_waitlist(qr, [r for r in waitlist if r[0] != telegram_id])
+        db._bump_version(None)
+
+    def get_all_users(self):
+        with self._lock:
+            return [_copy(u) for u in self.users.values()]
+
+    def import_users(self, users, allowed_offices=None) -> list:
+        skipped = []
+        with self._lock:
+            for user in users:
+                old = self.users.get(user["telegram_id"])
+                if old is not None and allowed_offices is not None and old["office"] not in allowed_offices:
+                    skipped.append(user["telegram_id"])
+                    continue
+                self._put_user(db.User(*(user[f] for f in db.User._fields)))
+        db._bump_version(None)
+        return sorted(skipped)
+
+    # Books
+
+    def get_book_by_qr(self, qr: str):
+        book = self.books.get(qr)
+        return _copy(book) if book is not None else None
+
+    def save_book(self, book: dict) -> None:
+        with self._lock:
+            old = self.books.get(book.get("qr_code"))
+            self._put_book(db.Book(*(book.get(f) for f in db.Book._fields)))
+        db._bump_version(book.get("office"), *([old["office"]] if old else []))
+
+    def import_books(self, books, allowed_offices=None) -> list:
+        offices = set()
+        skipped = []
+        with self._lock:
+            for b in books:
+                old = self.books.get(b["qr_code"])
+                if old is None:
+                    new = db.Book(b["qr_code"], b["title"], "available", None, None, b["office"])
+                elif allowed_offices is not None and old["office"] not in allowed_offices:
+                    skipped.append(b["qr_code"])
+                    continue
+                else:
+                    offices.add(old["office"])
+                    new = _copy(old)
+                    new.update({"title": b["title"], "office": b["office"]})
+                offices.add(b["office"])
+                self._put_book(new)
+        db._bump_version(*offices)
+        return sorted(skipped)
+
+    def _office_books(self, office: str) -> List[Any]:
+        return [self.books[qr] for qr in self.books_by_office.get(office, ())]
+
+    def _sorted_office_books(self, office: str) -> List[Any]:
+        return sorted(self._office_books(office), key=lambda b: (b["title"] or "", b["qr_code"]))
+
+    def iter_office_books(self, office: str, chunk_size: int = 1000) -> Iterator[tuple]:
+        with self._lock:
+            rows = []
+            for b in self._sorted_office_books(office):
+                user = self.users.get(b["taken_by"]) if b["taken_by"] is not None else None
+                rows.append(
+                    (
+                        b["qr_code"],
+                        b["title"],
+                        b["status"],
+                        b["taken_date"],
+                        b["taken_by"],
+                        user["first_name"] if user else None,
+                        user["last_name"] if user else None,
+                    )
+                )
+        yield from rows
+
+    def get_user_books(self, user_id: int):
+        with self._lock:
+            return [_copy(self.books[qr]) for qr in self.books_by_holder.get(user_id, ())]
+
+    def get_books_by_office(self, office: str):
+        with self._lock:
+            return [_copy(b) for b in self._office_books(office)]
+
+    def get_office_books_page(self, office: str, limit: int, offset: int = 0):
+        with self._lock:
+            page = self._sorted_office_books(office)[offset:offset + limit]
+            result = []
+            for b in page:
+                user = self.users.get(b["taken_by"]) if b["taken_by"] is not None else None
+                result.append(
+                    db.BookListing(
+                        *(b[f] for f in db.Book._fields),
+                        user["first_name"] if user else None,
+                        user["last_name"] if user else None,
+                    )
+                )
+            return result
+
+    def audit_office(self, office: str, codes) -> dict:
+        codes = set(codes)
+        with self._lock:
+            matches = [
+                (code, _copy(self.books[code]) if code in self.books else None) for code in codes
+            ]
+            matches.extend(
+                (None, _copy(b)) for b in self._office_books(office) if b["qr_code"] not in codes
+            )
+        return db._audit_result(office, matches)
+
+    def search_books(self, office: str, text: str, limit: int = 10, offset: int = 0):
+        """Match every word of ``text`` as a title word prefix, then any word."""
+        terms = _words(text)
+        if not terms:
+            return []
+        with self._lock:
+            books = self._office_books(office)
+            for any_term in (False, True):
+                scored = []
+                for b in books:
+                    words = _words(b["title"])
+                    hits = sum(1 for t in terms if any(w.startswith(t) for w in words))
+                    if hits == len(terms) or (any_term and hits):
+                        scored.append((-hits, b["title"] or "", b["qr_code"], b))
+                if scored:
+                    break
+            scored.sort(key=lambda s: s[:3])
+            return [_copy(s[3]) for s in scored[offset:offset + limit]]
+
+    # Loans
+
+    def _log_loan_event(self, qr: str, user_id: int, office: str, event: str, now: datetime) -> None:
+        taken_at = now
+        if event != "take":
+            takes = [
+                loan["taken_at"]
+                for loan in self.loans_by_user.get(user_id, ())
+                if loan["qr_code"] == qr and loan["event"] == "take"
+            ]
+            taken_at = max(takes) if takes else None
+        self._add_loan(
+            {
+                "qr_code": qr,
+                "user_id": user_id,
+                "office": office,
+                "event": event,
+                "taken_at": taken_at,
+                "created_at": now,
+            }
+        )
+
+    def take_book(self, qr: str, user_id: int, office: str, taken_date: date):
+        with self._lock:
+            book = self.books.get(qr)
+            if book is None or book["office"] != office or book["status"] == "taken":
+                return None
+            new = _copy(book)
+            new.update({"status": "taken", "taken_by": user_id, "taken_date": taken_date})
+            self._put_book(new)
+            self._log_loan_event(qr, user_id, office, "take", datetime.now(timezone.utc))
+            self._leave_waitlist(qr, user_id)
+        db._bump_version(office)
+        return book["title"]
+
+    def _release(self, book, event: str) -> None:
+        self._log_loan_event(
+            book["qr_code"], book["taken_by"], book["office"], event, datetime.now(timezone.utc)
+        )
+        new = _copy(book)
+        new.update({"status": "available", "taken_by": None, "taken_date": None})
+        self._put_book(new)
+
+    def return_book(self, qr: str, user_id: int, office: str):
+        with self._lock:
+            book = self.books.get(qr)
+            if (
+                book is None
+                or book["office"] != office
+                or book["status"] != "taken"
+                or book["taken_by"] != user_id
+            ):
+                return None
+            self._release(book, "return")
+        db._bump_version(office)
+        return book["title"]
+
+    def reserve_book(self, qr: str, user_id: int) -> int:
+        with self._lock:
+            waitlist = self.reservations.get(qr, [])
+            for place, (waiting, _) in enumerate(waitlist, 1):
+                if waiting == user_id:
+                    return place
+            self._set_waitlist(qr, waitlist + [(user_id, datetime.now(timezone.utc))])
+            return len(waitlist) + 1
+
+    def _leave_waitlist(self, qr: str, user_id: int) -> None:
+        waitlist = self.reservations.get(qr, [])
+        if any(waiting == user_id for waiting, _ in waitlist):
+            self._set_waitlist(qr, [entry for entry in waitlist if entry[0] != user_id])
+
+    def hand_over_book(
+        self, qr: str, office: str, taken_date: date, returned_by: Optional[int] = None
+    ) -> Optional[int]:
+        with self._lock:
+            if returned_by is not None:
+                self._leave_waitlist(qr, returned_by)
+            waitlist = self.reservations.get(qr)
+            if not waitlist or self.take_book(qr, waitlist[0][0], office, taken_date) is None:
+                return None
+            return waitlist[0][0]
+
+    def reset_book(self, qr: str, office: str):
+        with self._lock:
+            book = self.books.get(qr)
+            if book is None or book["office"] != office:
+                return None
+            if book["status"] == "taken":
+                self._release(book, "reset")
+            elif book["taken_by"] is not None or book["taken_date"] is not None:
+                new = _copy(book)
+                new.update({"status": "available", "taken_by": None, "taken_date": None})
+                self._put_book(new)
+        db._bump_version(office)
+        return book["title"]
+
+    def get_overdue_books(self, office, older_than: date):
+        with self._lock:
+            books = self._office_books(office) if office is not None else self.books.values()
+            overdue = [
+                b
+                for b in books
+                if b["status"] == "taken" and b["taken_date"] and b["taken_date"] < older_than
+            ]
+            return [_copy(b) for b in sorted(overdue, key=lambda b: b["taken_date"])]
+
+    def count_loans_by_period(self, start: date, end: date, office=None):
+        low, high = db._utc_midnight(start), db._utc_midnight(end)
+        counts: Counter = Counter()
+        with self._lock:
+            for loan in self.loans:
+                if loan["event"] != "take" or not (low <= loan["taken_at"] < high):
+                    continue
+                if office is None or loan["office"] == office:
+                    counts[loan["taken_at"].astimezone(timezone.utc).date()] += 1
+        return dict(sorted(counts.items()))
+
+    def get_most_borrowed_books(self, office=None, limit: int = 10):
+        with self._lock:
+            takes = Counter(
+                loan["qr_code"]
+                for loan in self.loans
+                if loan["event"] == "take" and (office is None or loan["office"] == office)
+            )
+            rows = [
+                (qr, self.books[qr]["title"] if qr in self.books else None, count)
+                for qr, count in takes.items()
+            ]
+        rows.sort(key=lambda r: (-r[2], r[1] or ""))
+        return rows[:limit]
+
+    def get_average_loan_days(self, office=None):
+        with self._lock:
+            days = [
+                (loan["created_at"] - loan["taken_at"]).total_seconds() / 86400
+                for loan in self.loans
+                if loan["event"] != "take"
+                and loan["taken_at"] is not None
+                and (office is None or loan["office"] == office)
+            ]
+        return sum(days) / len(days) if days else None
+
+    def get_user_loan_history(self, user_id: int, limit: int = 20):
+        with self._lock:
+            events = self.loans_by_user.get(user_id, ())
+            closed = {
+                (loan["qr_code"], loan["taken_at"]): loan["created_at"]
+                for loan in events
+                if loan["event"] != "take"
+            }
+            takes = sorted(
+                (loan for loan in events if loan["event"] == "take"),
+                key=lambda loan: loan["taken_at"],
+                reverse=True,
+            )[:limit]
+            return [
+                {
+                    "qr_code": loan["qr_code"],
+                    "title": self.books[loan["qr_code"]]["title"]
+                    if loan["qr_code"] in self.books
+                    else None,
+                    "taken_at": loan["taken_at"],
+                    "returned_at": closed.get((loan["qr_code"], loan["taken_at"])),
+                }
+                for loan in takes
+            ]
+
+    def get_pending_reminders(self, older_than: date, sent_before: datetime):
+        with self._lock:
+            loans = []
+            for b in self.books.values():
+                if b["status"] != "taken" or not b["taken_date"] or b["taken_date"] >= older_than:
+                    continue
+                sent_at = self.reminders.get((b["qr_code"], b["taken_by"], b["taken_date"]))
+                if sent_at is None or sent_at < sent_before:
+                    loans.append(
+                        {
+                            "qr_code": b["qr_code"],
+                            "title": b["title"],
+                            "taken_by": b["taken_by"],
+                            "taken_date": b["taken_date"],
+                            "office": b["office"],
+                        }
+                    )
+        loans.sort(key=lambda loan: (loan["taken_by"], loan["taken_date"]))
+        return loans
+
+    def mark_reminders_sent(self, loans, sent_at: datetime) -> None:
+        with self._lock:
+            for loan in loans:
+                key = (loan["qr_code"], loan["taken_by"], loan["taken_date"])
+                self._record("reminder", key, self.reminders.get(key))
+                self.reminders[key] = sent_at
+
+    # Bot state
+
+    def load_bot_state(self, kind: str):
+        with self._lock:
+            return {key: value for (k, key), value in self.state.items() if k == kind}
+
+    def save_bot_state(self, entries) -> None:
+        with self._lock:
+            for key, value in entries.items():
+                self._record("state", key, self.state.get(key))
+                if value is None:
+                    self.state.pop(key, None)
+                else:
+                    self.state[key] = value
+
+    # Office stats are computed from the office index on demand.
+
+    def reconcile_office_stats(self) -> None:
+        """Does nothing; counters are always computed from the books."""
+
+    def _stats(self, office: str) -> Dict[str, Any]:
+        cutoff = db.overdue_cutoff()
+        stats = {"office": office, "total": 0, "available": 0, "taken": 0, "overdue": 0}
+        for b in self._office_books(office):
+            available, taken = db._stats_key(b["status"])
+            stats["total"] += 1
+            stats["available"] += available
+            stats["taken"] += taken
+            if taken and b["taken_date"] is not None and b["taken_date"] < cutoff:
+                stats["overdue"] += 1
+        return stats
+
+    def get_office_stats(self, office=None):
+        with self._lock:
+            if office is not None:
+                return self._stats(office) if self.books_by_office.get(office) else None
+            return [
+                self._stats(o)
+                for o in sorted(o for o, qrs in self.books_by_office.items() if o is not None and qrs)
+            ]
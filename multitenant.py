@@ -0,0 +1,144 @@
+"""Serve several library bots from one process.
+
+Every tenant listed in ``TENANTS_FILE`` gets its own :class:`Application`
+with its own token, offices and administrators, and its own tables: a
+Postgres schema or a SQLite file. All applications share the event loop,
+one Postgres connection pool (``DB_POOL_SIZE``) and the QR decode threads.
+
+The file is a JSON list of objects::
+
+    [
+        {
+            "name": "osnova",
+            "token": "123:ABC",
+            "database": "osnova",
+            "admin_ids": ["7007125219"],
+            "offices": {"Central": {"name": "Центральный", "admins": []}}
+        }
+    ]
+
+``offices`` may also be the path of a JSON file of the same shape as
+``OFFICES_FILE``. Run with ``python multitenant.py``.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import re
+import signal
+import sys
+import atexit
+from typing import List
+
+from telegram.ext import Application
+
+import config
+import db
+from main import acquire_lock, build_application, release_lock
+
+LOCK_FILE = "/tmp/hrbook_multitenant.lock"
+
+_SCHEMA_RE = re.compile(r"^[a-z_][a-z0-9_]*$")
+
+
+def load_tenants(path: str) -> List[config.Tenant]:
+    """Return the tenants described in the JSON file ``path``."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    tenants = []
+    for entry in entries:
+        offices = entry.get("offices", {})
+        if isinstance(offices, str):
+            with open(offices, "r", encoding="utf-8") as f:
+                offices = json.load(f)
+        database = entry.get("database") or entry["name"]
+        if db.DB_ENGINE == "postgres" and not _SCHEMA_RE.match(database):
+            raise ValueError(f"Tenant {entry['name']}: invalid schema name {database!r}")
+        tenants.append(
+            config.Tenant(
+                entry["name"],
+                entry["token"],
+                database,
+                [str(a) for a in entry.get("admin_ids", [])],
+                {
+                    key: {**info, "admins": [str(a) for a in info.get("admins", [])]}
+                    for key, info in offices.items()
+                },
+            )
+        )
+    names = [t.name for t in tenants]
+    if len(set(names)) != len(names):
+        raise ValueError("Tenant names must be unique")
+    return tenants
+
+
+async def start_tenant(tenant: config.Tenant) -> Application:
+    """Create the tables of ``tenant`` and start polling its bot.
+
+    Run as a separate task: the tenant set here is inherited by every task
+    the application creates, so its handlers and jobs use its settings and
+    tables.
+    """
+    config.current_tenant.set(tenant)
+    try:
+        await asyncio.to_thread(db.init_db)
+    except Exception as exc:
+        logging.error("Tenant %s: database unavailable: %s", tenant.name, exc)
+    application = build_application(tenant.token, reload_config=False)
+    await application.initialize()
+    await application.updater.start_polling()
+    await application.start()
+    logging.info("Tenant %s started", tenant.name)
+    return application
+
+
+async def stop_tenant(tenant: config.Tenant, application: Application) -> None:
+    config.current_tenant.set(tenant)
+    if application.updater.running:
+        await application.updater.stop()
+    if application.running:
+        await application.stop()
+    await application.shutdown()
+
+
+async def run(tenants: List[config.Tenant]) -> None:
+    db.use_shared_pool()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    started = []
+    try:
+        for tenant in tenants:
+            started.append((tenant, await asyncio.create_task(start_tenant(tenant))))
+        await stop.wait()
+    finally:
+        for tenant, application in started:
+            await asyncio.create_task(stop_tenant(tenant, application))
+        db.close_connections()
+
+
+def main() -> None:
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+    )
+    if db.DB_ENGINE == "memory" or (db.DB_ENGINE == "sqlite" and db.SQLITE_PROFILE == "production"):
+        logging.error(
+            "The multi-tenant runner needs DB_ENGINE=postgres or the default SQLite profile"
+        )
+        sys.exit(1)
+    if not os.path.exists(config.TENANTS_FILE):
+        logging.error("Tenants file %s not found", config.TENANTS_FILE)
+        sys.exit(1)
+    tenants = load_tenants(config.TENANTS_FILE)
+    acquire_lock(LOCK_FILE)
+    atexit.register(release_lock, LOCK_FILE)
+    asyncio.run(run(tenants))
+
+
+if __name__ == "__main__":
+    main()
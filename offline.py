@@ -0,0 +1,336 @@
+"""Degraded mode while the database is unavailable.
+
+Users and books returned by successful reads are remembered in a bounded
+in-memory cache. While :mod:`db` raises :exc:`db.DatabaseUnavailable`, the
+cache answers lookups, and takes and returns are checked against it and
+appended to a local SQLite write-ahead journal. :func:`replay` applies the
+journal to the database in order once it is reachable again and keeps the
+operations the database rejects as conflicts. Cache keys and
+journal entries carry the current tenant of the multi-tenant runner.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional
+
+import config
+import db
+
+CACHE_SIZE = 5000
+
+
+class _Cache:
+    """LRU maps of the users and books seen in recent successful reads.
+
+    Keys are ``(tenant, telegram_id)`` and ``(tenant, qr_code)``. Entries are
+    private copies, read and changed under the lock.
+    """
+
+    def __init__(self, size: int = CACHE_SIZE) -> None:
+        self.size = size
+        self.users: "OrderedDict[tuple, dict]" = OrderedDict()
+        self.books: "OrderedDict[tuple, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _put(self, entries: OrderedDict, key, value) -> None:
+        with self._lock:
+            entries[key] = dict(value)
+            entries.move_to_end(key)
+            while len(entries) > self.size:
+                entries.popitem(last=False)
+
+    def remember_user(self, user) -> None:
+        if user:
+            self._put(self.users, (config.tenant_name(), user["telegram_id"]), user)
+
+    def remember_books(self, books) -> None:
+        tenant = config.tenant_name()
+        for book in books:
+            self._put(self.books, (tenant, book["qr_code"]), book)
+
+    def user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            user = self.users.get((config.tenant_name(), user_id))
+            return None if user is None else dict(user)
+
+    def book(self, qr: str) -> Optional[dict]:
+        with self._lock:
+            book = self.books.get((config.tenant_name(), qr))
+            return None if book is None else dict(book)
+
+    def user_books(self, user_id: int) -> List[dict]:
+        """Return copies of the cached books held by the user."""
+        tenant = config.tenant_name()
+        with self._lock:
+            return [
+                dict(b)
+                for (book_tenant, _), b in self.books.items()
+                if book_tenant == tenant and b["status"] == "taken" and b["taken_by"] == user_id
+            ]
+
+    def update_book(self, qr: str, changes: dict) -> None:
+        """Apply ``changes`` to the cached book, if it is cached."""
+        with self._lock:
+            book = self.books.get((config.tenant_name(), qr))
+            if book is not None:
+                book.update(changes)
+
+    def clear(self) -> None:
+        with self._lock:
+            self.users.clear()
+            self.books.clear()
+
+
+class _Journal:
+    """Append-only queue of takes and returns kept in a local SQLite file."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        # Queued operations per tenant, counted on first use.
+        self._pending: Dict[Optional[str], int] = {}
+        self._lock = threading.RLock()
+
+    def _connection(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS ops (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    op TEXT NOT NULL,
+                    qr_code TEXT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    office TEXT,
+                    taken_date TEXT,
+                    created_at TEXT NOT NULL,
+                    tenant TEXT
+                )
+                """
+            )
+            # Operations the database rejected on replay, kept for the office
+            # administrators; ``notified`` is set once the user was told.
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS conflicts (
+                    id INTEGER PRIMARY KEY,
+                    op TEXT NOT NULL,
+                    qr_code TEXT NOT NULL,
+                    user_id BIGINT NOT NULL,
+                    office TEXT,
+                    taken_date TEXT,
+                    created_at TEXT NOT NULL,
+                    tenant TEXT,
+                    rejected_at TEXT NOT NULL,
+                    notified INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(ops)")]
+            if "tenant" not in columns:
+                self._conn.execute("ALTER TABLE ops ADD COLUMN tenant TEXT")
+            self._conn.commit()
+        return self._conn
+
+    def pending(self) -> int:
+        """Return the number of queued operations of the current tenant."""
+        tenant = config.tenant_name()
+        with self._lock:
+            if tenant not in self._pending:
+                if not os.path.exists(self.path):
+                    self._pending[tenant] = 0
+                else:
+                    row = self._connection().execute(
+                        "SELECT COUNT(*) FROM ops WHERE tenant IS ?", (tenant,)
+                    ).fetchone()
+                    self._pending[tenant] = row[0]
+            return self._pending[tenant]
+
+    def append(self, op: str, qr: str, user_id: int, office: str, taken_date: Optional[date]) -> None:
+        with self._lock:
+            count = self.pending()
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO ops (op, qr_code, user_id, office, taken_date, created_at, tenant)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    op,
+                    qr,
+                    user_id,
+                    office,
+                    taken_date.isoformat() if taken_date else None,
+                    datetime.now(timezone.utc).isoformat(),
+                    config.tenant_name(),
+                ),
+            )
+            conn.commit()
+            self._pending[config.tenant_name()] = count + 1
+
+    def entries(self) -> List[tuple]:
+        """Return the queued operations of the current tenant, oldest first."""
+        with self._lock:
+            if not self.pending():
+                return []
+            return self._connection().execute(
+                "SELECT id, op, qr_code, user_id, office, taken_date FROM ops"
+                " WHERE tenant IS ? ORDER BY id",
+                (config.tenant_name(),),
+            ).fetchall()
+
+    def remove(self, op_id: int) -> None:
+        with self._lock:
+            count = self.pending()
+            conn = self._connection()
+            conn.execute("DELETE FROM ops WHERE id = ?", (op_id,))
+            conn.commit()
+            self._pending[config.tenant_name()] = max(0, count - 1)
+
+    def reject(self, op_id: int) -> None:
+        """Move a queued operation the database refused to ``conflicts``."""
+        with self._lock:
+            count = self.pending()
+            conn = self._connection()
+            conn.execute(
+                "INSERT INTO conflicts (id, op, qr_code, user_id, office, taken_date,"
+                " created_at, tenant, rejected_at)"
+                " SELECT id, op, qr_code, user_id, office, taken_date, created_at, tenant, ?"
+                " FROM ops WHERE id = ?",
+                (datetime.now(timezone.utc).isoformat(), op_id),
+            )
+            conn.execute("DELETE FROM ops WHERE id = ?", (op_id,))
+            conn.commit()
+            self._pending[config.tenant_name()] = max(0, count - 1)
+
+    def unnotified_conflicts(self) -> List[tuple]:
+        """Return the rejected operations of the current tenant not yet reported.
+
+        Rows are ``(id, op, qr_code, user_id, office)``, oldest first.
+        """
+        with self._lock:
+            if not os.path.exists(self.path):
+                return []
+            return self._connection().execute(
+                "SELECT id, op, qr_code, user_id, office FROM conflicts"
+                " WHERE tenant IS ? AND notified = 0 ORDER BY id",
+                (config.tenant_name(),),
+            ).fetchall()
+
+    def mark_notified(self, conflict_id: int) -> None:
+        with self._lock:
+            conn = self._connection()
+            conn.execute("UPDATE conflicts SET notified = 1 WHERE id = ?", (conflict_id,))
+            conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+            self._pending.clear()
+
+
+cache = _Cache()
+journal = _Journal(config.OFFLINE_JOURNAL_PATH)
+_replay_lock = threading.Lock()
+
+
+def get_user(user_id: int):
+    """Return the cached user or re-raise :exc:`db.DatabaseUnavailable`."""
+    user = cache.user(user_id)
+    if user is None:
+        raise db.DatabaseUnavailable("user is not cached")
+    return user
+
+
+def get_book(qr: str):
+    """Return the cached book or re-raise :exc:`db.DatabaseUnavailable`."""
+    book = cache.book(qr)
+    if book is None:
+        raise db.DatabaseUnavailable("book is not cached")
+    return book
+
+
+def get_user_books(user_id: int) -> List[Any]:
+    """Return the cached books held by the user."""
+    return cache.user_books(user_id)
+
+
+def taken(user_id: int, taken_date: date) -> dict:
+    return {"status": "taken", "taken_by": user_id, "taken_date": taken_date}
+
+
+RETURNED = {"status": "available", "taken_by": None, "taken_date": None}
+
+
+def take_book(qr: str, user_id: int, office: str, taken_date: date) -> Optional[str]:
+    """Journal a take checked against the cache; see :func:`db.take_book`."""
+    book = get_book(qr)
+    if book["office"] != office or book["status"] == "taken":
+        return None
+    journal.append("take", qr, user_id, office, taken_date)
+    cache.update_book(qr, taken(user_id, taken_date))
+    return book["title"]
+
+
+def return_book(qr: str, user_id: int, office: str) -> Optional[str]:
+    """Journal a return checked against the cache; see :func:`db.return_book`."""
+    book = get_book(qr)
+    if book["office"] != office or book["status"] != "taken" or book["taken_by"] != user_id:
+        return None
+    journal.append("return", qr, user_id, office, None)
+    cache.update_book(qr, RETURNED)
+    return book["title"]
+
+
+def replay(handed_over: Optional[list] = None) -> int:
+    """Apply journaled operations to the database in order.
+
+    Return the number of operations applied. Replay stops at the first
+    operation that fails because the database is still unavailable; the
+    rest stays queued. An operation the database rejects (for example a
+    book taken by someone else meanwhile) is moved to the ``conflicts``
+    table, see :meth:`_Journal.unnotified_conflicts`. A replayed return
+    lends the book to the first user on its waitlist; ``(user_id, title)``
+    of those users are appended to ``handed_over``.
+    """
+    applied = 0
+    with _replay_lock:
+        for op_id, op, qr, user_id, office, taken_date in journal.entries():
+            try:
+                if op == "take":
+                    result = db.take_book(qr, user_id, office, date.fromisoformat(taken_date))
+                else:
+                    result = db.return_book(qr, user_id, office)
+            except db.DatabaseUnavailable:
+                break
+            if result is None:
+                logging.warning(
+                    "Offline %s of %s by %s conflicts with the database, kept as a conflict",
+                    op,
+                    qr,
+                    user_id,
+                )
+                journal.reject(op_id)
+                continue
+            journal.remove(op_id)
+            applied += 1
+            if op == "return":
+                today = datetime.now(timezone.utc).date()
+                try:
+                    holder = db.hand_over_book(qr, office, today, returned_by=user_id)
+                except db.DatabaseUnavailable:
+                    break
+                if holder is not None:
+                    cache.update_book(qr, taken(holder, today))
+                    if handed_over is not None:
+                        handed_over.append((holder, result))
+    if applied:
+        logging.info("Replayed %d offline operations", applied)
+    return applied
@@ -0,0 +1,213 @@
+"""Outbound Telegram traffic: reply coalescing and a rate-limited send queue."""
+
+from __future__ import annotations
+
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from typing import Any, Callable, Coroutine, Dict, List, Optional, Union
+
+from telegram import Update
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+MENU_TEXT = "Главное меню"
+
+# Replies buffered for the handler currently running. ``None`` means replies
+# are sent immediately.
+_pending: contextvars.ContextVar[Optional[List[list]]] = contextvars.ContextVar(
+    "pending_replies", default=None
+)
+
+
+def coalesce_replies(callback: Callable[..., Coroutine]) -> Callable[..., Coroutine]:
+    """Buffer :func:`reply` calls made by ``callback`` and send them merged.
+
+    Consecutive replies to the chat are joined into a single message which
+    carries the last keyboard, so a status line followed by the main menu
+    costs one Bot API call instead of two.
+    """
+
+    @functools.wraps(callback)
+    async def wrapper(update: Update, context: Any) -> Any:
+        pending: List[list] = []
+        token = _pending.set(pending)
+        try:
+            return await callback(update, context)
+        finally:
+            _pending.reset(token)
+            await _flush(update, pending)
+
+    return wrapper
+
+
+async def reply(update: Update, text: str, reply_markup: Any = None) -> None:
+    """Reply to ``update``, buffering the message inside :func:`coalesce_replies`."""
+    pending = _pending.get()
+    if pending is None:
+        await update.effective_message.reply_text(text, reply_markup=reply_markup)
+        return
+    if pending and pending[-1][1] is None:
+        # The previous message has no keyboard yet: append to it.
+        pending[-1][0].append(text)
+        pending[-1][1] = reply_markup
+    else:
+        pending.append([[text], reply_markup])
+
+
+async def reply_menu(update: Update, keyboard: Any) -> None:
+    """Show the main menu ``keyboard``.
+
+    Inside :func:`coalesce_replies` the keyboard is attached to the preceding
+    reply when it has none; otherwise a separate "Главное меню" message is
+    sent.
+    """
+    pending = _pending.get()
+    if pending and pending[-1][1] is None:
+        pending[-1][1] = keyboard
+        return
+    await reply(update, MENU_TEXT, reply_markup=keyboard)
+
+
+async def _flush(update: Update, pending: List[list]) -> None:
+    for texts, markup in pending:
+        await update.effective_message.reply_text("\n".join(texts), reply_markup=markup)
+
+
+class _TokenBucket:
+    """Token bucket where a negative balance represents queued requests."""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Take a token and return how long the caller has to wait for it."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        elapsed = time.monotonic() - self.updated
+        return self.tokens + elapsed * self.rate >= self.capacity
+
+
+class SendQueue(BaseRateLimiter[Dict[str, Any]]):
+    """Rate limiter queueing Bot API requests per chat and globally.
+
+    Requests carrying a ``chat_id`` first wait for a slot in their chat
+    (about one message per second for private chats, 20 per minute for groups)
+    and then for a slot in the global budget of 30 requests per second.
+    Slots are handed out in arrival order. A :exc:`~telegram.error.RetryAfter`
+    from Telegram pauses the whole queue for the requested time before the
+    request is retried.
+
+    ``rate_limit_args`` may be a dict with ``max_retries`` to override the
+    default number of retries for a single call, and ``background=True`` for
+    bulk sends such as reminders. Background requests additionally queue for
+    a separate, smaller budget so they never use up the global one and
+    interactive replies are not stuck behind them.
+    """
+
+    def __init__(
+        self,
+        overall_rate: float = 30,
+        chat_rate: float = 1,
+        chat_burst: float = 3,
+        group_rate: float = 20 / 60,
+        group_burst: float = 3,
+        background_rate: float = 20,
+        max_retries: int = 3,
+    ) -> None:
+        self._overall = _TokenBucket(overall_rate, overall_rate)
+        self._background = _TokenBucket(background_rate, 1)
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._group_burst = group_burst
+        self._max_retries = max_retries
+        self._chats: Dict[Union[int, str], _TokenBucket] = {}
+        self._resume_at = 0.0
+
+    async def initialize(self) -> None:
+        """Does nothing."""
+
+    async def shutdown(self) -> None:
+        """Does nothing."""
+
+    def _chat_bucket(self, chat_id: Union[int, str]) -> _TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:
+                for key, old in list(self._chats.items()):
+                    if old.idle():
+                        del self._chats[key]
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            bucket = _TokenBucket(
+                self._group_rate if is_group else self._chat_rate,
+                self._group_burst if is_group else self._chat_burst,
+            )
+            self._chats[chat_id] = bucket
+        return bucket
+
+    async def _wait_for_slot(
+        self, chat_id: Optional[Union[int, str]], background: bool = False
+    ) -> None:
+        if chat_id is not None:
+            if background:
+                delay = self._background.reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            delay = self._chat_bucket(chat_id).reserve()
+            if delay:
+                await asyncio.sleep(delay)
+            delay = self._overall.reserve()
+            if delay:
+                await asyncio.sleep(delay)
+        while True:
+            pause = self._resume_at - time.monotonic()
+            if pause <= 0:
+                return
+            await asyncio.sleep(pause)
+
+    async def process_request(
+        self,
+        callback: Callable[..., Coroutine[Any, Any, Any]],
+        args: Any,
+        kwargs: Dict[str, Any],
+        endpoint: str,
+        data: Dict[str, Any],
+        rate_limit_args: Optional[Dict[str, Any]],
+    ) -> Any:
+        options = rate_limit_args or {}
+        max_retries = options.get("max_retries", self._max_retries)
+        background = bool(options.get("background"))
+        chat_id = data.get("chat_id")
+        if chat_id is not None:
+            try:
+                chat_id = int(chat_id)
+            except (TypeError, ValueError):
+                pass
+
+        for attempt in range(max_retries + 1):
+            await self._wait_for_slot(chat_id, background)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt == max_retries:
+                    raise
+                delay = float(exc.retry_after) + 0.1
+                logging.warning(
+                    "Flood limit hit on %s, pausing sends for %.1f s", endpoint, delay
+                )
+                self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                await asyncio.sleep(delay)
+        return None
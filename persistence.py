@@ -0,0 +1,128 @@
+"""Database-backed persistence of conversation states and ``user_data``.
+
+The application hands changed entries to :class:`DBPersistence` every
+``PERSISTENCE_INTERVAL`` seconds. The ``update_*`` methods only queue them in
+memory; one background task writes everything queued in a single
+:func:`db.save_bot_state` batch. Handling an update therefore never waits for
+the database, and after a restart users continue their dialog where they
+left off.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+from typing import Dict, Optional, Tuple
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+import config
+import db
+
+USER_DATA = "user_data"
+
+
+def _conversation_kind(name: str) -> str:
+    return f"conversation:{name}"
+
+
+class DBPersistence(BasePersistence):
+    """Store conversation states and ``user_data`` in the ``bot_state`` table.
+
+    Values are stored as JSON, so only JSON-serialisable data survives a
+    restart. Chat data, bot data and callback data are not stored.
+    """
+
+    def __init__(self, update_interval: float = config.PERSISTENCE_INTERVAL) -> None:
+        super().__init__(
+            store_data=PersistenceInput(
+                bot_data=False, chat_data=False, user_data=True, callback_data=False
+            ),
+            update_interval=update_interval,
+        )
+        # (kind, key) -> JSON value, or None to delete; written by _write_pending.
+        self._pending: Dict[Tuple[str, str], Optional[str]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    async def _load(self, kind: str) -> Dict[str, str]:
+        try:
+            return await asyncio.to_thread(db.load_bot_state, kind)
+        except db.DatabaseUnavailable:
+            logging.warning("Database unavailable, %s starts empty", kind)
+            return {}
+
+    def _queue(self, kind: str, key: str, value) -> None:
+        self._pending[(kind, key)] = None if value is None else json.dumps(value)
+        if self._flush_task is None or self._flush_task.done():
+            # The application queues all changes of one run before this
+            # task gets to run, so they go out in one batch.
+            self._flush_task = asyncio.get_running_loop().create_task(self._write_pending())
+
+    async def _write_pending(self) -> None:
+        while self._pending:
+            batch, self._pending = self._pending, {}
+            try:
+                await asyncio.to_thread(db.save_bot_state, batch)
+            except db.DatabaseUnavailable:
+                # Keep the batch for the next run; newer changes win.
+                self._pending = {**batch, **self._pending}
+                logging.warning("Database unavailable, %d state changes deferred", len(batch))
+                return
+            except Exception:
+                self._pending = {**batch, **self._pending}
+                logging.exception("Saving %d state changes failed, kept for retry", len(batch))
+                return
+
+    async def get_user_data(self):
+        rows = await self._load(USER_DATA)
+        return {int(key): json.loads(value) for key, value in rows.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name: str):
+        rows = await self._load(_conversation_kind(name))
+        return {tuple(json.loads(key)): json.loads(value) for key, value in rows.items()}
+
+    async def update_conversation(self, name: str, key, new_state) -> None:
+        self._queue(_conversation_kind(name), json.dumps(list(key)), new_state)
+
+    async def update_user_data(self, user_id: int, data) -> None:
+        self._queue(USER_DATA, str(user_id), data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._queue(USER_DATA, str(user_id), None)
+
+    async def update_chat_data(self, chat_id: int, data) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        pass
+
+    async def update_bot_data(self, data) -> None:
+        pass
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Write everything still queued; called on shutdown."""
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._write_pending()
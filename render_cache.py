@@ -0,0 +1,66 @@
+"""Cache of rendered listing pages, invalidated by database write counters.
+
+Entries are keyed by ``(office, view, page, version)`` where ``version`` is
+taken from :func:`db.office_version` at lookup time. Any write to the books of
+an office changes its version, so stale pages are never served; they are
+replaced by the next render of the same page. Entries also expire after
+``ttl`` seconds to pick up writes made outside the bot process, such as
+command line imports. Under the multi-tenant runner the current tenant is part
+of every key.
+"""
+
+from __future__ import annotations
+
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Tuple
+
+import config
+
+
+class RenderCache:
+    """LRU cache holding the latest rendering of every listing page."""
+
+    def __init__(self, max_entries: int = 512, ttl: float = 300) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # (tenant, office, view, page) -> (version, expires_at, value)
+        self._entries: "OrderedDict[Tuple[Hashable, ...], Tuple[Hashable, float, Any]]" = (
+            OrderedDict()
+        )
+
+    def get_or_render(
+        self,
+        office: Hashable,
+        view: str,
+        page: int,
+        version: Hashable,
+        render: Callable[[], Any],
+    ) -> Any:
+        """Return the cached rendering for the key, calling ``render`` on a miss."""
+        slot = (config.tenant_name(), office, view, page)
+        now = time.monotonic()
+        entry = self._entries.get(slot)
+        if entry is not None and entry[0] == version and entry[1] > now:
+            self._entries.move_to_end(slot)
+            self.hits += 1
+            return entry[2]
+        self.misses += 1
+        value = render()
+        self._entries[slot] = (version, now + self.ttl, value)
+        self._entries.move_to_end(slot)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return value
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+# Shared by the book list and the admin report.
+listings = RenderCache()
@@ -23,6 +23,30 @@ from handlers import admin as admin_module
 import pytest_asyncio
 
 
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    """Return a freshly reloaded :mod:`db` module backed by a temp SQLite file."""
+    monkeypatch.setenv("DB_ENGINE", "sqlite")
+    monkeypatch.setenv("DB_NAME", str(tmp_path / "test.db"))
+    import db
+
+    importlib.reload(db)
+    return db
+
+
+@pytest.fixture
+def memory_db(tmp_path, monkeypatch):
+    """Return :mod:`db` reloaded with the in-memory engine snapshotting to ``tmp_path``."""
+    monkeypatch.setenv("DB_ENGINE", "memory")
+    monkeypatch.setenv("MEMORY_DATA_DIR", str(tmp_path / "data"))
+    monkeypatch.setenv("MEMORY_SNAPSHOT_SECONDS", "0")
+    import db
+
+    importlib.reload(db)
+    yield db
+    db.close_connections()
+
+
 @pytest_asyncio.fixture
 async def app(tmp_path, monkeypatch):
     monkeypatch.setenv("DB_ENGINE", "sqlite")
@@ -31,15 +55,23 @@ async def app(tmp_path, monkeypatch):
     import importlib
     import db
     import utils
+    import render_cache
     import handlers.start as start_module
     import handlers.books as books_module
     import handlers.admin as admin_module
+    import handlers.stats as stats_module
+    import handlers.memory as memory_module
+    import handlers.audit as audit_module
 
     importlib.reload(db)
     importlib.reload(utils)
+    importlib.reload(render_cache)
     importlib.reload(start_module)
     importlib.reload(books_module)
     importlib.reload(admin_module)
+    importlib.reload(stats_module)
+    importlib.reload(memory_module)
+    importlib.reload(audit_module)
 
     db.init_db()
 
@@ -55,7 +87,7 @@ async def app(tmp_path, monkeypatch):
     sent_messages = []
 
     async def fake_do_post(self, endpoint, data, *args, **kwargs):
-        if endpoint == "sendMessage":
+        if endpoint in ("sendMessage", "editMessageText"):
             sent_messages.append(data["text"])
             return {
                 "message_id": len(sent_messages),
@@ -63,6 +95,13 @@ async def app(tmp_path, monkeypatch):
                 "chat": {"id": data["chat_id"], "type": "private"},
                 "text": data["text"],
             }
+        if endpoint == "sendDocument":
+            sent_messages.append(data["document"])
+            return {
+                "message_id": len(sent_messages),
+                "date": 0,
+                "chat": {"id": data["chat_id"], "type": "private"},
+            }
         return {"ok": True, "result": True}
 
     async def dummy_initialize(self):
@@ -74,7 +113,11 @@ async def app(tmp_path, monkeypatch):
     monkeypatch.setattr(telegram.Bot, "_do_post", fake_do_post)
     monkeypatch.setattr(telegram.Bot, "initialize", dummy_initialize)
 
-    application = Application.builder().token("TEST").build()
+    import persistence
+
+    application = (
+        Application.builder().token("TEST").persistence(persistence.DBPersistence()).build()
+    )
     application.add_handler(start_module.get_handler())
     application.add_handler(start_module.get_menu_handler())
     application.add_handler(start_module.get_change_office_handler())
@@ -82,6 +125,13 @@ async def app(tmp_path, monkeypatch):
         application.add_handler(h)
     for h in admin_module.get_handlers():
         application.add_handler(h)
+    for h in stats_module.get_handlers():
+        application.add_handler(h)
+    for h in audit_module.get_handlers():
+        application.add_handler(h)
+    for h in memory_module.get_handlers():
+        application.add_handler(h)
+    application.add_handler(memory_module.get_activity_handler(), group=-1)
 
     await application.initialize()
     yield application, sent_messages, tmp_path
@@ -96,7 +146,8 @@ def make_update(app, text, user_id=1):
     chat = Chat(id=user_id, type="private")
     entities = None
     if text.startswith("/"):
-        entities = [MessageEntity(type="bot_command", offset=0, length=len(text))]
+        command = text.split()[0]
+        entities = [MessageEntity(type="bot_command", offset=0, length=len(command))]
     msg = Message(
         message_id=next(_id_gen),
         date=datetime.now(),
@@ -109,11 +160,11 @@ def make_update(app, text, user_id=1):
     return telegram.Update(update_id=next(_id_gen), message=msg)
 
 
-def make_photo_update(app, user_id=1):
+def make_photo_update(app, user_id=1, file_id="file-id"):
     """Return an Update with a dummy photo message."""
     user = User(id=user_id, is_bot=False, first_name="Test")
     chat = Chat(id=user_id, type="private")
-    photo = telegram.PhotoSize(file_id="file-id", file_unique_id="file-uid", width=1, height=1)
+    photo = telegram.PhotoSize(file_id=file_id, file_unique_id=f"{file_id}-uid", width=1, height=1)
     photo._bot = app.bot
     msg = Message(
         message_id=next(_id_gen),
@@ -124,3 +175,26 @@ def make_photo_update(app, user_id=1):
     )
     msg._bot = app.bot
     return telegram.Update(update_id=next(_id_gen), message=msg)
+
+
+def make_callback_update(app, data, user_id=1):
+    """Return an Update with an inline button press carrying ``data``."""
+    user = User(id=user_id, is_bot=False, first_name="Test")
+    chat = Chat(id=user_id, type="private")
+    msg = Message(
+        message_id=next(_id_gen),
+        date=datetime.now(),
+        chat=chat,
+        from_user=User(id=999, is_bot=True, first_name="TestBot"),
+        text="...",
+    )
+    msg._bot = app.bot
+    query = telegram.CallbackQuery(
+        id=str(next(_id_gen)),
+        from_user=user,
+        chat_instance="chat",
+        message=msg,
+        data=data,
+    )
+    query._bot = app.bot
+    return telegram.Update(update_id=next(_id_gen), callback_query=query)
@@ -5,6 +5,7 @@ import utils
 import sqlite3
 from conftest import make_update
 from conftest import make_photo_update
+from conftest import make_callback_update
 
 
 @pytest.mark.asyncio
@@ -67,8 +68,11 @@ async def test_take_and_return_book(app):
     # take book
     await application.process_update(make_update(application, "🔍 Взять книгу"))
     assert sent[-1] == "Отправьте QR-код книги:"
+    before = len(sent)
     await application.process_update(make_update(application, "qr1"))
-    assert any("успешно" in m for m in sent[-2:])
+    # status and main menu are coalesced into a single message
+    assert len(sent) == before + 1
+    assert "успешно" in sent[-1]
     conn = sqlite3.connect(tmp / "test.db")
     status = conn.execute("SELECT status FROM books WHERE qr_code='qr1'").fetchone()[0]
     assert status == "taken"
@@ -244,3 +248,566 @@ async def test_delete_user(app):
     count = conn.execute("SELECT COUNT(*) FROM users WHERE telegram_id=2").fetchone()[0]
     conn.close()
     assert count == 0
+
+
+@pytest.mark.asyncio
+async def test_return_book_inline_button(app):
+    application, sent, tmp = app
+    await application.process_update(make_update(application, "/start"))
+    await application.process_update(make_update(application, "Last"))
+    await application.process_update(make_update(application, "First"))
+    await application.process_update(make_update(application, "Main"))
+    utils.save_book(
+        {
+            "qr_code": "qr1",
+            "title": "Book",
+            "status": "available",
+            "taken_by": None,
+            "taken_date": None,
+            "office": "Main",
+        }
+    )
+    await application.process_update(make_update(application, "🔍 Взять книгу"))
+    await application.process_update(make_update(application, "qr1"))
+    await application.process_update(make_update(application, "📚 Мои книги"))
+    assert sent[-1].startswith("Book, взята")
+
+    # another user cannot return the book through a forged button
+    await application.process_update(
+        make_callback_update(application, "return:qr1", user_id=2)
+    )
+    assert utils.get_book_by_qr("qr1")["status"] == "taken"
+
+    await application.process_update(make_callback_update(application, "return:qr1"))
+    assert sent[-1] == "У вас нет взятых книг."
+    assert utils.get_book_by_qr("qr1")["status"] == "available"
+
+
+@pytest.mark.asyncio
+async def test_overdue_reminders_sent_once(app):
+    from datetime import date
+    import types
+    from handlers import reminders
+
+    application, sent, tmp = app
+    for qr, user_id in (("qr1", 5), ("qr2", 5), ("qr3", 6)):
+        utils.save_book(
+            {
+                "qr_code": qr,
+                "title": qr.upper(),
+                "status": "taken",
+                "taken_by": user_id,
+                "taken_date": date(2020, 1, 1),
+                "office": "Main",
+            }
+        )
+    context = types.SimpleNamespace(bot=application.bot)
+
+    await reminders.send_overdue_reminders(context)
+    digests = [m for m in sent if m.startswith("⏰")]
+    assert len(digests) == 2
+    assert "QR1" in digests[0] and "QR2" in digests[0]
+
+    # a second run (e.g. after a restart) does not resend
+    await reminders.send_overdue_reminders(context)
+    assert len([m for m in sent if m.startswith("⏰")]) == 2
+
+
+@pytest.mark.asyncio
+async def test_search_books(app):
+    application, sent, tmp = app
+    await application.process_update(make_update(application, "/start"))
+    await application.process_update(make_update(application, "Last"))
+    await application.process_update(make_update(application, "First"))
+    await application.process_update(make_update(application, "Main"))
+    titles = ["Война и мир", "Мир приключений", "Анна Каренина"]
+    for i, title in enumerate(titles + [f"Мир {n}" for n in range(12)]):
+        utils.save_book(
+            {
+                "qr_code": f"qr{i}",
+                "title": title,
+                "status": "available",
+                "taken_by": None,
+                "taken_date": None,
+                "office": "Main",
+            }
+        )
+    utils.save_book(
+        {
+            "qr_code": "other",
+            "title": "Мир другого офиса",
+            "status": "available",
+            "taken_by": None,
+            "taken_date": None,
+            "office": "Alt",
+        }
+    )
+    # index follows title updates
+    utils.save_book(
+        {
+            "qr_code": "qr2",
+            "title": "Анна Каренина. Том 2",
+            "status": "available",
+            "taken_by": None,
+            "taken_date": None,
+            "office": "Main",
+        }
+    )
+
+    await application.process_update(make_update(application, "🔎 Поиск"))
+    await application.process_update(make_update(application, "карен"))
+    # a single page carries the main keyboard itself
+    assert "Анна Каренина. Том 2: свободна" in sent[-1]
+
+    await application.process_update(make_update(application, "🔎 Поиск"))
+    await application.process_update(make_update(application, "мир"))
+    # the pager needs an inline keyboard, so the main menu follows separately
+    assert sent[-1] == "Главное меню"
+    first_page = sent[-2]
+    assert first_page.count("\n") == 10
+    assert "другого офиса" not in first_page
+    await application.process_update(make_callback_update(application, "search:1"))
+    assert sent[-1].startswith("🔎 «мир», стр. 2")
+    assert sent[-1].count("\n") == 4
+
+    # Later pages of a query matched by any of its words keep that mode.
+    await application.process_update(make_update(application, "🔎 Поиск"))
+    await application.process_update(make_update(application, "мир java"))
+    assert sent[-2].count("\n") == 10
+    await application.process_update(make_callback_update(application, "search:1"))
+    assert sent[-1].startswith("🔎 «мир java», стр. 2")
+    assert sent[-1].count("\n") == 4
+    assert len(utils.search_books("Main", "мир java", 6, 5)) == 6
+
+
+@pytest.mark.asyncio
+async def test_export_books(app):
+    import io
+    import openpyxl
+
+    application, sent, tmp = app
+    await application.process_update(make_update(application, "/start", user_id=1))
+    await application.process_update(make_update(application, "Admin"))
+    await application.process_update(make_update(application, "User"))
+    await application.process_update(make_update(application, "Main"))
+    for i in range(3):
+        utils.save_book(
+            {
+                "qr_code": f"qr{i}",
+                "title": f"Book {i}",
+                "status": "available",
+                "taken_by": None,
+                "taken_date": None,
+                "office": "Main",
+            }
+        )
+    utils.take_book("qr1", 1, "Main")
+
+    await application.process_update(make_update(application, "📄 Экспорт"))
+    document = sent[-1]
+    assert document.filename.endswith(".csv")
+    lines = document.input_file_content.decode("utf-8-sig").splitlines()
+    assert len(lines) == 4
+    assert lines[2].startswith("qr1,Book 1,взята,") and lines[2].endswith(",User Admin")
+
+    await application.process_update(make_update(application, "/export xlsx"))
+    workbook = openpyxl.load_workbook(io.BytesIO(sent[-1].input_file_content))
+    assert workbook.active.max_row == 4
+
+
+@pytest.mark.asyncio
+async def test_loan_history_and_stats(app):
+    application, sent, tmp = app
+    await application.process_update(make_update(application, "/start", user_id=1))
+    await application.process_update(make_update(application, "Admin"))
+    await application.process_update(make_update(application, "User"))
+    await application.process_update(make_update(application, "Main"))
+    utils.save_book(
+        {
+            "qr_code": "qr1",
+            "title": "Book",
+            "status": "available",
+            "taken_by": None,
+            "taken_date": None,
+            "office": "Main",
+        }
+    )
+    await application.process_update(make_update(application, "/history"))
+    assert sent[-1] == "Вы ещё не брали книги."
+    utils.take_book("qr1", 1, "Main")
+    utils.return_book("qr1", 1, "Main")
+    utils.take_book("qr1", 1, "Main")
+
+    await application.process_update(make_update(application, "/history"))
+    lines = sent[-1].splitlines()
+    assert lines[0].endswith("на руках")
+    assert lines[1].startswith("Book: ")
+
+    await application.process_update(make_update(application, "/stats"))
+    assert "Book: 2" in sent[-1]
+    assert "Средний срок чтения" in sent[-1]
+
+    await application.process_update(make_update(application, "/dashboard"))
+    assert "Main: всего 1, свободно 0, взято 1, просрочено 0" in sent[-1]
+    await application.process_update(make_update(application, "/dashboard", user_id=2))
+    assert sent[-1] == "Недостаточно прав."
+
+
+@pytest.mark.asyncio
+async def test_book_list_cached_until_write(app):
+    application, sent, tmp = app
+    from render_cache import listings
+
+    await application.process_update(make_update(application, "/start", user_id=1))
+    await application.process_update(make_update(application, "Admin"))
+    await application.process_update(make_update(application, "User"))
+    await application.process_update(make_update(application, "Main"))
+    for i in range(25):
+        utils.save_book(
+            {
+                "qr_code": f"qr{i:02}",
+                "title": f"Book {i:02}",
+                "status": "available",
+                "taken_by": None,
+                "taken_date": None,
+                "office": "Main",
+            }
+        )
+
+    await application.process_update(make_update(application, "📖 Все книги"))
+    first = sent[-1]
+    assert first.splitlines()[0] == "Book 00: свободна"
+    assert len(first.splitlines()) == 20
+    await application.process_update(make_update(application, "📖 Все книги"))
+    assert sent[-1] == first
+    assert listings.hits == 1
+
+    await application.process_update(make_callback_update(application, "books:1"))
+    assert sent[-1].splitlines() == [f"Book {i}: свободна" for i in range(20, 25)]
+
+    utils.take_book("qr00", 1, "Main")
+    await application.process_update(make_update(application, "📖 Все книги"))
+    assert sent[-1].splitlines()[0].endswith("User Admin")
+    assert listings.hits == 1
+
+    await application.process_update(make_update(application, "📊 Отчёт по библиотеке"))
+    assert sent[-1].startswith("Всего 25, свободно 24, взято 1")
+
+
+@pytest.mark.asyncio
+async def test_offline_journal_when_database_down(app, monkeypatch):
+    application, sent, tmp = app
+    import db
+    import offline
+    from handlers import recovery
+
+    application.add_error_handler(recovery.on_error)
+    monkeypatch.setattr(offline, "journal", offline._Journal(str(tmp / "journal.db")))
+    monkeypatch.setattr(offline, "cache", offline._Cache())
+    await application.process_update(make_update(application, "/start", user_id=1))
+    await application.process_update(make_update(application, "Admin"))
+    await application.process_update(make_update(application, "User"))
+    await application.process_update(make_update(application, "Main"))
+    for qr in ("qr1", "qr2"):
+        utils.save_book(
+            {
+                "qr_code": qr,
+                "title": qr.upper(),
+                "status": "available",
+                "taken_by": None,
+                "taken_date": None,
+                "office": "Main",
+            }
+        )
+    await application.process_update(make_update(application, "🔍 Взять книгу"))
+    await application.process_update(make_update(application, "qr1"))
+    utils.get_book_by_qr("qr2")
+
+    def unavailable():
+        raise sqlite3.OperationalError("unable to open database file")
+
+    assert db.reserve_book("qr1", 5) == 1
+    connect = db._connect
+    monkeypatch.setattr(db, "_connect", unavailable)
+    await application.process_update(make_update(application, "📤 Вернуть книгу"))
+    await application.process_update(make_update(application, "qr1"))
+    assert sent[-1].startswith('✅ Книга "QR1" возвращена.')
+    await application.process_update(make_update(application, "🔍 Взять книгу"))
+    await application.process_update(make_update(application, "qr2"))
+    assert sent[-1].startswith('✅ Книга "QR2" успешно закреплена')
+    assert not db.database_available()
+    await application.process_update(make_update(application, "📖 Все книги"))
+    assert sent[-1] == recovery.UNAVAILABLE_TEXT
+    assert offline.journal.pending() == 2
+
+    monkeypatch.setattr(db, "_connect", connect)
+    monkeypatch.setattr(db._breaker, "reset_after", 0)
+    # Someone else got qr2 first: the offline take is kept as a conflict.
+    assert db.take_book("qr2", 9, "Main", utils.today()) == "QR2"
+    await recovery.replay_pending(application.bot)
+    assert offline.journal.pending() == 0
+    assert db.database_available()
+    # The replayed return lends qr1 to the user waiting for it.
+    assert db.get_book_by_qr("qr1")["taken_by"] == 5
+    assert 'Книга "QR1", которую вы ждали' in sent[-1]
+    assert db.get_book_by_qr("qr2")["taken_by"] == 9
+    assert [c[1:4] for c in offline.journal.unnotified_conflicts()] == [("take", "qr2", 1)]
+    await recovery.notify_conflicts(application.bot)
+    assert "вы взяли книгу qr2" in sent[-1]
+    assert offline.journal.unnotified_conflicts() == []
+
+
+@pytest.mark.asyncio
+async def test_failed_state_write_is_kept(app, monkeypatch):
+    import db
+    import persistence
+
+    saved = []
+
+    def save_bot_state(entries):
+        if not saved:
+            saved.append(None)
+            raise sqlite3.IntegrityError("boom")
+        saved.append(entries)
+
+    monkeypatch.setattr(db, "save_bot_state", save_bot_state)
+    store = persistence.DBPersistence()
+    await store.update_user_data(1, {"qr": "a"})
+    await store._flush_task
+    assert store._pending == {("user_data", "1"): '{"qr": "a"}'}
+    await store.flush()
+    assert saved[-1] == {("user_data", "1"): '{"qr": "a"}'} and store._pending == {}
+
+
+@pytest.mark.asyncio
+async def test_registration_resumes_after_restart(app, monkeypatch):
+    application, sent, tmp = app
+    import db
+    import persistence
+    from handlers import start as start_module
+    from telegram.ext import Application
+
+    batches = []
+    save_bot_state = db.save_bot_state
+    monkeypatch.setattr(
+        db, "save_bot_state", lambda entries: (batches.append(entries), save_bot_state(entries))
+    )
+    await application.process_update(make_update(application, "/start", user_id=7))
+    await application.process_update(make_update(application, "Petrov", user_id=7))
+    assert sent[-1] == "Введите ваше имя:"
+    assert batches == []
+    await application.update_persistence()
+    await application.persistence.flush()
+    # The conversation state and user_data go out in one write.
+    assert len(batches) == 1 and len(batches[0]) == 2
+
+    restarted = (
+        Application.builder().token("TEST").persistence(persistence.DBPersistence()).build()
+    )
+    restarted.add_handler(start_module.get_handler())
+    await restarted.initialize()
+    await restarted.process_update(make_update(restarted, "Petr", user_id=7))
+    assert sent[-1] == "Выберите офис:"
+    await restarted.process_update(make_update(restarted, "Main", user_id=7))
+    assert sent[-1] == "✅ Регистрация успешна."
+    await restarted.shutdown()
+    assert utils.get_user(7)["last_name"] == "Petrov"
+
+
+@pytest.mark.asyncio
+async def test_restored_idle_dialog_expires(app):
+    application, sent, tmp = app
+    import db
+    import persistence
+    from handlers import memory as memory_module
+    from handlers import start as start_module
+    from telegram.ext import Application
+
+    for user_id, name in ((7, "Petrov"), (8, "Ivanov")):
+        await application.process_update(make_update(application, "/start", user_id=user_id))
+        await application.process_update(make_update(application, name, user_id=user_id))
+    await application.update_persistence()
+    await application.persistence.flush()
+
+    restarted = (
+        Application.builder().token("TEST").persistence(persistence.DBPersistence()).build()
+    )
+    handler = start_module.get_handler()
+    restarted.add_handler(handler)
+    await restarted.initialize()
+    assert len(handler._conversations) == 2
+    # User 8 answered after the restart, which started a timeout job.
+    handler.timeout_jobs[next(k for k in handler._conversations if k[-1] == 8)] = object()
+    assert memory_module.expire_restored_dialogs(restarted) == 1
+    assert [k[-1] for k in handler._conversations] == [8]
+    assert restarted.user_data[7] == {}
+    handler.timeout_jobs.clear()
+    await restarted.update_persistence()
+    await restarted.persistence.flush()
+    assert list(db.load_bot_state("conversation:registration")) == ["[8, 8]"]
+    await restarted.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_idle_dialog_data_expires(app):
+    application, sent, tmp = app
+    from telegram.ext import CallbackContext
+    from handlers import memory as memory_module
+    from handlers import start as start_module
+
+    await application.process_update(make_update(application, "/start", user_id=5))
+    update = make_update(application, "Sidorov", user_id=5)
+    await application.process_update(update)
+    assert application.user_data[5] == {"last_name": "Sidorov"}
+
+    context = CallbackContext.from_update(update, application)
+    await start_module.timeout_action(update, context)
+    assert sent[-1] == "⌛ Время ожидания истекло, действие отменено."
+    assert application.user_data[5] == {}
+
+    await application.process_update(make_update(application, "/memory", user_id=1))
+    assert sent[-1].startswith("🧠 Активные диалоги: 1")
+    assert "user_data: 2 зап." in sent[-1]
+
+    assert memory_module.sweep(application, 3600) == 0
+    seen = application.bot_data[memory_module.LAST_SEEN]
+    seen["user"][5] -= 7200
+    seen["chat"][5] -= 7200
+    assert memory_module.sweep(application, 3600) == 1
+    assert 5 not in application.user_data
+    assert 1 in application.user_data
+
+
+@pytest.mark.asyncio
+async def test_inventory_audit(app, monkeypatch):
+    application, sent, tmp = app
+    await application.process_update(make_update(application, "/start"))
+    await application.process_update(make_update(application, "Admin"))
+    await application.process_update(make_update(application, "User"))
+    await application.process_update(make_update(application, "Main"))
+    for qr, status, office in [
+        ("shelf", "available", "Main"),
+        ("lost", "available", "Main"),
+        ("loaned", "taken", "Main"),
+        ("marked", "taken", "Main"),
+        ("visitor", "available", "Alt"),
+    ]:
+        utils.save_book(
+            {
+                "qr_code": qr,
+                "title": qr.title(),
+                "status": status,
+                "taken_by": 5 if status == "taken" else None,
+                "taken_date": utils.today() if status == "taken" else None,
+                "office": office,
+            }
+        )
+
+    import io
+    import qrcode
+
+    photos = {}
+    for file_id, code in (("p1", "shelf"), ("p2", "visitor")):
+        buf = io.BytesIO()
+        qrcode.make(code).save(buf, format="PNG")
+        photos[file_id] = buf.getvalue()
+    downloads = []
+
+    class FakeFile:
+        def __init__(self, file_id):
+            self.file_id = file_id
+
+        async def download_as_bytearray(self, *args, **kwargs):
+            downloads.append(self.file_id)
+            return bytearray(photos[self.file_id])
+
+    async def fake_get_file(self, file_id, *args, **kwargs):
+        return FakeFile(file_id)
+
+    monkeypatch.setattr(application.bot.__class__, "get_file", fake_get_file)
+
+    await application.process_update(make_update(application, "/audit"))
+    assert sent[-1].startswith("📋 Инвентаризация")
+    await application.process_update(make_update(application, "shelf\nmarked"))
+    await application.process_update(make_photo_update(application, file_id="p1"))
+    await application.process_update(make_photo_update(application, file_id="p1"))
+    await application.process_update(make_photo_update(application, file_id="p2"))
+    await application.process_update(make_update(application, "unknown"))
+    await application.process_update(make_update(application, "✅ Завершить"))
+
+    assert sorted(downloads) == ["p1", "p2"]
+    report = sent[-1]
+    assert "отсканировано кодов 4" in report
+    assert "На месте: 1, выдано читателям: 1" in report
+    assert "Не найдены на полках: 1\n  Lost (lost)" in report
+    assert "числятся выданными: 1\n  Marked (marked)" in report
+    assert "Из других офисов: 1\n  Visitor (Alt)" in report
+    assert "Нет в каталоге: 1\n  unknown" in report
+
+
+@pytest.mark.asyncio
+async def test_waitlist_gets_returned_book(app):
+    import asyncio
+
+    application, sent, tmp = app
+    for user_id, name in ((2, "Holder"), (3, "Waiter"), (4, "Later")):
+        await application.process_update(make_update(application, "/start", user_id=user_id))
+        await application.process_update(make_update(application, name, user_id=user_id))
+        await application.process_update(make_update(application, "Reader", user_id=user_id))
+        await application.process_update(make_update(application, "Main", user_id=user_id))
+    utils.save_book(
+        {
+            "qr_code": "qr1",
+            "title": "Book",
+            "status": "available",
+            "taken_by": None,
+            "taken_date": None,
+            "office": "Main",
+        }
+    )
+    await application.process_update(make_update(application, "🔍 Взять книгу", user_id=2))
+    await application.process_update(make_update(application, "qr1", user_id=2))
+
+    await application.process_update(make_update(application, "🔍 Взять книгу", user_id=3))
+    await application.process_update(make_update(application, "qr1", user_id=3))
+    assert any("Встаньте в очередь" in m for m in sent[-2:])
+    for user_id in (3, 4, 3):
+        await application.process_update(
+            make_callback_update(application, "reserve:qr1", user_id=user_id)
+        )
+    assert utils.reserve_book("qr1", 4) == 2
+
+    await application.process_update(make_update(application, "📤 Вернуть книгу", user_id=2))
+    await application.process_update(make_update(application, "qr1", user_id=2))
+    await asyncio.sleep(0)
+    assert any("которую вы ждали" in m for m in sent[-3:])
+    book = utils.get_book_by_qr("qr1")
+    assert (book["status"], book["taken_by"]) == ("taken", 3)
+
+    # The next return goes to the next user in line, then nobody waits.
+    assert utils.return_book("qr1", 3, "Main") == "Book"
+    assert utils.hand_over_book("qr1", "Main") == 4
+    assert utils.return_book("qr1", 4, "Main") == "Book"
+    assert utils.hand_over_book("qr1", "Main") is None
+    assert utils.get_book_by_qr("qr1")["status"] == "available"
+
+
+@pytest.mark.asyncio
+async def test_log_commands_are_logged(app):
+    _, sent, _ = app
+    import asyncio
+    import db
+    import main
+
+    application = main.build_application("TEST", reload_config=False)
+    await application.initialize()
+    try:
+        await application.process_update(make_update(application, "/logs", user_id=1))
+        assert sent[-1] == "Сообщения не найдены."
+        for _ in range(100):
+            if db.search_messages(user_id=1):
+                break
+            await asyncio.sleep(0.01)
+        assert [m["text"] for m in db.search_messages(user_id=1)] == ["/logs"]
+    finally:
+        await application.shutdown()
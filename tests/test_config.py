@@ -0,0 +1,58 @@
+import json
+import os
+
+import config
+import utils
+
+
+def test_index_reloads_when_files_change(tmp_path, monkeypatch):
+    env = tmp_path / ".env"
+    env.write_text("ADMIN_IDS=1\nDB_ENGINE=ignored\n")
+    offices = tmp_path / "offices.json"
+    offices.write_text(
+        json.dumps({"Main": {"name": "Главный", "aliases": ["HQ"]}, "Alt": {"admins": [5]}})
+    )
+    monkeypatch.setattr(config, "ENV_PATH", str(env))
+    monkeypatch.setattr(config, "OFFICES_FILE", str(offices))
+    for name in ("ADMIN_IDS", "OFFICES", "_index", "_mtimes", "_env_admin_keys"):
+        monkeypatch.setattr(config, name, getattr(config, name))
+    monkeypatch.setenv("ADMIN_IDS", "")
+    monkeypatch.setenv("OFFICE_MAIN_ADMINS", "")
+    monkeypatch.setenv("DB_ENGINE", "sqlite")
+
+    assert config.reload_if_changed()
+    assert not config.reload_if_changed()
+    assert os.environ["DB_ENGINE"] == "sqlite"
+    assert utils.is_global_admin(1)
+    assert utils.is_admin(5) and utils.is_admin(5, "Alt") and not utils.is_admin(5, "Main")
+    assert utils.resolve_office_name(" главный ") == "Main"
+    assert utils.resolve_office_name("hq") == "Main"
+    assert utils.resolve_office_name("Nowhere") is None
+
+    env.write_text("ADMIN_IDS=2\nOFFICE_MAIN_ADMINS=7\n")
+    os.utime(env, (1, 1))
+    assert config.reload_if_changed()
+    assert not utils.is_global_admin(1) and utils.is_global_admin(2)
+    assert utils.is_admin(7, "Main")
+
+    # Administrators removed from the file lose their rights.
+    env.write_text("ADMIN_IDS=2\n")
+    os.utime(env, (2, 2))
+    assert config.reload_if_changed()
+    assert not utils.is_admin(7, "Main") and "OFFICE_MAIN_ADMINS" not in os.environ
+    env.write_text("")
+    os.utime(env, (3, 3))
+    assert config.reload_if_changed()
+    assert not utils.is_global_admin(2)
+
+    # A broken file keeps the previous settings, including the environment.
+    env.write_text("ADMIN_IDS=9\n")
+    os.utime(env, (4, 4))
+    offices.write_text("{")
+    os.utime(offices, (1, 1))
+    try:
+        config.reload_if_changed()
+    except ValueError:
+        pass
+    assert utils.resolve_office_name("HQ") == "Main"
+    assert "ADMIN_IDS" not in os.environ and not utils.is_global_admin(9)
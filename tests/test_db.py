@@ -0,0 +1,463 @@
+import importlib
+import sqlite3
+import time
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+
+
+def _book(qr, office="Main", taken_by=None, taken_date=None):
+    return {
+        "qr_code": qr,
+        "title": qr.upper(),
+        "status": "taken" if taken_by else "available",
+        "taken_by": taken_by,
+        "taken_date": taken_date,
+        "office": office,
+    }
+
+
+def test_text_taken_date_is_migrated(sqlite_db):
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    conn.execute(
+        "CREATE TABLE books (qr_code TEXT PRIMARY KEY, title TEXT, status TEXT,"
+        " taken_by BIGINT, taken_date TEXT, office TEXT)"
+    )
+    conn.execute(
+        "INSERT INTO books VALUES ('old', 'Old', 'taken', 5, '2024-01-02', 'Main')"
+    )
+    conn.execute("INSERT INTO books VALUES ('free', 'Free', 'available', NULL, '', 'Main')")
+    conn.commit()
+    conn.close()
+
+    sqlite_db.init_db()
+
+    assert sqlite_db.get_book_by_qr("old")["taken_date"] == date(2024, 1, 2)
+    assert sqlite_db.get_book_by_qr("free")["taken_date"] is None
+
+
+def test_message_log_is_partitioned_and_purged(sqlite_db):
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    conn.execute(
+        "CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, user_id BIGINT,"
+        " text TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+    )
+    conn.execute("INSERT INTO messages (user_id, text, created_at) VALUES (1, 'legacy', '2001-01-05 10:00:00')")
+    conn.commit()
+    conn.close()
+
+    sqlite_db.init_db()
+    with sqlite_db.get_conn() as conn:
+        cur = conn.cursor()
+        old = sqlite_db._sqlite_message_table(cur, datetime(2001, 2, 1))
+        cur.execute(f"INSERT INTO {old} (user_id, text, created_at) VALUES (2, 'old', '2001-02-03 00:00:00')")
+        conn.commit()
+    sqlite_db.save_message(3, "new")
+
+    def logged():
+        with sqlite_db.get_conn() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT text FROM messages ORDER BY created_at")
+            return [row[0] for row in cur.fetchall()]
+
+    assert logged() == ["legacy", "old", "new"]
+
+    now = datetime.now(timezone.utc)
+    steps = 0
+    while sqlite_db.purge_messages(now - timedelta(days=1), 1):
+        steps += 1
+    # The legacy row, the emptied legacy table and the old month table.
+    assert steps == 3
+    assert logged() == ["new"]
+    with sqlite_db.get_conn() as conn:
+        cur = conn.cursor()
+        assert sqlite_db._sqlite_message_tables(cur) == [f"messages_{now:%Y%m}"]
+
+    while sqlite_db.purge_messages(now + timedelta(seconds=1), 1):
+        pass
+    assert logged() == []
+    sqlite_db.save_message(3, "again")
+    assert logged() == ["again"]
+
+
+def test_message_log_search(sqlite_db):
+    sqlite_db.init_db()
+    with sqlite_db.get_conn() as conn:
+        cur = conn.cursor()
+        old = sqlite_db._sqlite_message_table(cur, datetime(2001, 2, 1))
+        cur.executemany(
+            f"INSERT INTO {old} (user_id, text, created_at) VALUES (?, ?, ?)",
+            [
+                (1, "Бот не ответил", "2001-02-03 10:00:00"),
+                (2, "100% готово", "2001-02-03 11:00:00"),
+            ],
+        )
+        conn.commit()
+    sqlite_db.save_message(1, "Бот НЕ ОТВЕТИЛ снова")
+    sqlite_db.save_message(2, "ok")
+
+    def texts(**criteria):
+        return [m["text"] for m in sqlite_db.search_messages(**criteria)]
+
+    assert texts(text="не ответил") == ["Бот НЕ ОТВЕТИЛ снова", "Бот не ответил"]
+    assert texts(user_id=2) == ["ok", "100% готово"]
+    assert texts(text="0%") == ["100% готово"]
+    assert texts(text="_") == []
+    feb = datetime(2001, 2, 1, tzinfo=timezone.utc)
+    assert texts(since=feb, until=datetime(2001, 2, 3, 10, 30, tzinfo=timezone.utc)) == [
+        "Бот не ответил"
+    ]
+    assert texts(user_id=1, since=datetime(2001, 3, 1, tzinfo=timezone.utc)) == [
+        "Бот НЕ ОТВЕТИЛ снова"
+    ]
+    assert texts(limit=1, offset=3) == ["Бот не ответил"]
+    row = sqlite_db.search_messages(text="ok")[0]
+    assert row["user_id"] == 2 and row["created_at"].tzinfo is timezone.utc
+
+    # Purged rows leave the text index too.
+    while sqlite_db.purge_messages(datetime(2001, 3, 1, tzinfo=timezone.utc), 1):
+        pass
+    assert texts(text="не ответил") == ["Бот НЕ ОТВЕТИЛ снова"]
+
+
+def test_overdue_and_period_queries(sqlite_db):
+    sqlite_db.init_db()
+    sqlite_db.save_book(_book("a", taken_by=1, taken_date=date(2024, 1, 1)))
+    sqlite_db.save_book(_book("b", taken_by=2, taken_date=date(2024, 3, 1)))
+    sqlite_db.save_book(_book("c", office="Alt", taken_by=3, taken_date=date(2024, 1, 5)))
+    sqlite_db.save_book(_book("d"))
+
+    overdue = sqlite_db.get_overdue_books("Main", date(2024, 2, 1))
+    assert [b["qr_code"] for b in overdue] == ["a"]
+    overdue = sqlite_db.get_overdue_books(None, date(2024, 2, 1))
+    assert [b["qr_code"] for b in overdue] == ["a", "c"]
+
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT qr_code FROM books"
+        " WHERE status = 'taken' AND taken_date < '2024-02-01' AND office = 'Main'"
+    ).fetchall()
+    conn.close()
+    assert "idx_books_office_taken_date" in " ".join(str(r) for r in plan)
+
+
+def test_loan_history_and_analytics(sqlite_db):
+    sqlite_db.init_db()
+    for qr in ("a", "b"):
+        sqlite_db.save_book(_book(qr))
+    today = datetime.now(timezone.utc).date()
+
+    assert sqlite_db.take_book("a", 1, "Main", today) == "A"
+    assert sqlite_db.return_book("a", 1, "Main") == "A"
+    assert sqlite_db.take_book("a", 2, "Main", today) == "A"
+    assert sqlite_db.reset_book("a", "Main") == "A"
+    assert sqlite_db.take_book("b", 1, "Main", today) == "B"
+    assert sqlite_db.take_book("b", 2, "Main", today) is None
+    assert sqlite_db.reset_book("b", "Alt") is None
+
+    assert sqlite_db.get_most_borrowed_books("Main") == [("a", "A", 2), ("b", "B", 1)]
+    assert sqlite_db.get_average_loan_days("Main") < 0.01
+    assert sqlite_db.get_average_loan_days("Alt") is None
+
+    history = sqlite_db.get_user_loan_history(1)
+    assert [h["qr_code"] for h in history] == ["b", "a"]
+    assert history[0]["returned_at"] is None
+    assert history[1]["returned_at"] >= history[1]["taken_at"]
+
+    counts = sqlite_db.count_loans_by_period(today, today + timedelta(days=1))
+    assert counts == {today: 3}
+    assert sqlite_db.count_loans_by_period(today, today + timedelta(days=1), "Alt") == {}
+
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    events = conn.execute("SELECT event FROM loans ORDER BY id").fetchall()
+    conn.close()
+    assert [e[0] for e in events] == ["take", "return", "take", "reset", "take"]
+
+
+def test_office_stats_follow_writes(sqlite_db):
+    sqlite_db.init_db()
+    today = datetime.now(timezone.utc).date()
+    sqlite_db.save_book(_book("a"))
+    sqlite_db.save_book(_book("b"))
+    sqlite_db.save_book(_book("old", taken_by=3, taken_date=date(2000, 1, 1)))
+    sqlite_db.import_books(
+        [
+            {"qr_code": "b", "title": "B", "office": "Alt"},
+            {"qr_code": "c", "title": "C", "office": "Alt"},
+        ]
+    )
+
+    def counters(office):
+        stats = sqlite_db.get_office_stats(office)
+        return stats["total"], stats["available"], stats["taken"], stats["overdue"]
+
+    assert counters("Main") == (2, 1, 1, 1)
+    assert counters("Alt") == (2, 2, 0, 0)
+
+    sqlite_db.take_book("a", 1, "Main", today)
+    assert counters("Main") == (2, 0, 2, 1)
+    sqlite_db.reset_book("old", "Main")
+    assert counters("Main") == (2, 1, 1, 0)
+    sqlite_db.return_book("a", 1, "Main")
+    assert counters("Main") == (2, 2, 0, 0)
+    sqlite_db.save_book(_book("a", office="Alt"))
+    assert counters("Alt") == (3, 3, 0, 0)
+
+    expected = sqlite_db.get_office_stats()
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    conn.execute("UPDATE office_stats SET total = 99")
+    conn.commit()
+    conn.close()
+    sqlite_db.reconcile_office_stats()
+    assert sqlite_db.get_office_stats() == expected
+    assert [s["office"] for s in expected] == ["Alt", "Main"]
+
+
+def test_overdue_counter_follows_last_reconcile(sqlite_db):
+    sqlite_db.init_db()
+    long_ago, recent = date(2000, 1, 1), sqlite_db.overdue_cutoff() - timedelta(days=1)
+    sqlite_db.save_book(_book("x", taken_by=1, taken_date=long_ago))
+    sqlite_db.save_book(_book("y", taken_by=2, taken_date=recent))
+    # As if the last reconcile ran before "y" became overdue.
+    conn = sqlite3.connect(sqlite_db.DB_NAME)
+    conn.execute("UPDATE office_stats SET overdue = 1, overdue_cutoff = ?", (str(recent),))
+    conn.commit()
+    conn.close()
+
+    def overdue(office):
+        return sqlite_db.get_office_stats(office)["overdue"]
+
+    # Returning "y" must not cancel the overdue "x".
+    assert sqlite_db.return_book("y", 2, "Main") == "Y"
+    assert overdue("Main") == 1
+    # Imports move loans with their counters, without a recount.
+    sqlite_db.import_books([{"qr_code": "x", "title": "X", "office": "Alt"}])
+    assert overdue("Main") == 0
+    assert sqlite_db.get_office_stats("Alt") == {
+        "office": "Alt", "total": 1, "available": 0, "taken": 1, "overdue": 1
+    }
+    expected = sqlite_db.get_office_stats()
+    sqlite_db.reconcile_office_stats()
+    assert sqlite_db.get_office_stats() == expected
+
+
+def test_init_db_rejects_old_sqlite(sqlite_db, monkeypatch):
+    monkeypatch.setattr(sqlite3, "sqlite_version_info", (3, 31, 1))
+    with pytest.raises(RuntimeError, match="too old"):
+        sqlite_db.init_db()
+
+
+def test_rows_are_compact_mappings(sqlite_db):
+    sqlite_db.init_db()
+    sqlite_db.save_book(_book("a", taken_by=1, taken_date=date(2024, 1, 1)))
+    sqlite_db.save_user(
+        {"telegram_id": 1, "first_name": "A", "last_name": "B", "office": "Main", "role": "user"}
+    )
+
+    book = sqlite_db.get_book_by_qr("a")
+    assert not hasattr(book, "__dict__")
+    assert book.get("taken_date") == date(2024, 1, 1)
+    assert book.get("missing", "x") == "x"
+    assert dict(book) == _book("a", taken_by=1, taken_date=date(2024, 1, 1))
+
+    [user] = sqlite_db.get_all_users()
+    user.update({"office": "Alt"})
+    assert user["office"] == "Alt"
+    with pytest.raises(KeyError):
+        user["unknown"] = 1
+
+    [listed] = sqlite_db.get_office_books_page("Main", 10)
+    assert (listed["qr_code"], listed["first_name"], listed["last_name"]) == ("a", "A", "B")
+
+
+def test_transaction_uses_one_connection_and_rolls_back(sqlite_db, monkeypatch):
+    sqlite_db.init_db()
+    user = {"telegram_id": 1, "first_name": "A", "last_name": "B", "office": "Main", "role": "user"}
+    connects = []
+    connect = sqlite_db._connect
+    monkeypatch.setattr(sqlite_db, "_connect", lambda: connects.append(1) or connect())
+
+    with sqlite_db.transaction():
+        sqlite_db.save_user(user)
+        assert sqlite_db.get_user(1)["first_name"] == "A"
+        sqlite_db.update_user_office(1, "Alt", "user")
+    assert len(connects) == 1
+    assert sqlite_db.get_user(1)["office"] == "Alt"
+
+    with pytest.raises(RuntimeError):
+        with sqlite_db.transaction():
+            sqlite_db.delete_user(1)
+            raise RuntimeError
+    assert sqlite_db.get_user(1) is not None
+
+
+def test_sqlite_production_profile(sqlite_db, monkeypatch):
+    monkeypatch.setenv("SQLITE_PROFILE", "production")
+    db = importlib.reload(sqlite_db)
+    try:
+        db.init_db()
+        db.save_book(_book("a"))
+        with db.get_conn(readonly=True) as conn:
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+            assert conn.execute("PRAGMA synchronous").fetchone()[0] == 1
+            with pytest.raises(sqlite3.OperationalError):
+                conn.execute("DELETE FROM books")
+        with db.get_conn() as writer, db.get_conn() as again:
+            assert writer is again
+        assert db.take_book("a", 1, "Main", date(2024, 1, 1)) == "A"
+        assert db.get_book_by_qr("a")["taken_by"] == 1
+    finally:
+        db.close_connections()
+
+
+def test_replica_routing_skips_lagging_and_recent_writes(sqlite_db, monkeypatch):
+    db = sqlite_db
+    fresh, lagging, down = db._Replica("fresh"), db._Replica("lagging"), db._Replica("down")
+    measured = {"fresh": 0.5, "lagging": db.DB_REPLICA_MAX_LAG + 1, "down": None}
+
+    def check(self):
+        self.checked_at = time.monotonic()
+        self.lag = measured[self.dsn]
+
+    monkeypatch.setattr(db._Replica, "check", check)
+    monkeypatch.setattr(db, "_replicas", [lagging, down, fresh])
+    monkeypatch.setattr(db, "_user_writes", {})
+    assert {db._pick_replica() for _ in range(6)} == {fresh}
+
+    # A user reading right after taking a book must see it: the primary.
+    db.init_db()
+    db.save_book(
+        {"qr_code": "q", "title": "T", "status": "available",
+         "taken_by": None, "taken_date": None, "office": "Main"}
+    )
+    assert db.take_book("q", 1, "Main", date(2024, 1, 1)) == "T"
+    db.set_reader(1)
+    assert db._pick_replica() is None
+    # Another user, and logging their message, still use the replica.
+    db.set_reader(2)
+    db.save_message(2, "hello")
+    assert db._pick_replica() is fresh
+    db.set_reader(None)
+    assert db._pick_replica() is fresh
+
+    measured["fresh"] = None
+    fresh.checked_at = float("-inf")
+    assert db._pick_replica() is None
+
+
+@pytest.mark.parametrize("backend", ["sqlite_db", "memory_db"])
+def test_waitlist_drops_reservations_of_borrowers(backend, request):
+    db = request.getfixturevalue(backend)
+    db.init_db()
+    today = datetime.now(timezone.utc).date()
+    db.save_book(_book("a", taken_by=1, taken_date=today))
+    assert db.reserve_book("a", 2) == 1
+    assert db.reserve_book("a", 3) == 2
+
+    # After a reset user 2 takes the book directly and leaves the queue.
+    assert db.reset_book("a", "Main") == "A"
+    assert db.take_book("a", 2, "Main", today) == "A"
+    assert db.reserve_book("a", 4) == 2
+    # A user who queued while holding the book does not get it back.
+    assert db.reserve_book("a", 2) == 3
+    assert db.return_book("a", 2, "Main") == "A"
+    assert db.hand_over_book("a", "Main", today, returned_by=2) == 3
+    assert db.return_book("a", 3, "Main") == "A"
+    assert db.hand_over_book("a", "Main", today, returned_by=3) == 4
+    assert db.return_book("a", 4, "Main") == "A"
+    assert db.hand_over_book("a", "Main", today, returned_by=4) is None
+
+
+def test_memory_backend_matches_sql_semantics(memory_db):
+    db = memory_db
+    # Names imported before the engine was chosen dispatch to it as well.
+    from db import get_user
+
+    db.init_db()
+    today = datetime.now(timezone.utc).date()
+    db.save_user(
+        {"telegram_id": 1, "first_name": "Ann", "last_name": "Lee", "office": "Main", "role": "user"}
+    )
+    db.save_book(_book("a"))
+    db.save_book(_book("b"))
+    db.save_book(_book("old", taken_by=3, taken_date=date(2000, 1, 1)))
+    db.import_books([{"qr_code": "c", "title": "Clean Code", "office": "Alt"}])
+
+    assert db.get_user_by_name("Ann", "Lee", "Main")["telegram_id"] == 1
+    assert db.take_book("a", 1, "Main", today) == "A"
+    assert db.take_book("a", 2, "Main", today) is None
+    assert [b["qr_code"] for b in db.get_user_books(1)] == ["a"]
+    page = db.get_office_books_page("Main", 2)
+    assert [(b["qr_code"], b["first_name"]) for b in page] == [("a", "Ann"), ("b", None)]
+    assert db.get_office_stats("Main") == {
+        "office": "Main", "total": 3, "available": 1, "taken": 2, "overdue": 1
+    }
+    assert [b["qr_code"] for b in db.search_books("Alt", "clean cod")] == ["c"]
+    assert [b["qr_code"] for b in db.search_books("Alt", "clean missing")] == ["c"]
+    assert [b["qr_code"] for b in db.search_books("Main", "a b", 1, 1)] == ["b"]
+    audit = db.audit_office("Main", ["a", "b", "c", "x"])
+    assert (audit["found"], audit["on_loan"], audit["missing"], audit["unexpected"]) == (
+        1, 1, [], ["x"]
+    )
+    assert [b["qr_code"] for b in audit["taken"]] == ["a"]
+    assert [b["office"] for b in audit["elsewhere"]] == ["Alt"]
+    assert db.reserve_book("a", 2) == 1
+    assert db.reserve_book("a", 2) == 1
+    assert db.hand_over_book("a", "Main", today) is None
+
+    assert db.return_book("a", 1, "Main") == "A"
+    assert db.reset_book("old", "Main") == "OLD"
+    assert db.get_user_loan_history(1)[0]["returned_at"] is not None
+    assert db.get_most_borrowed_books("Main") == [("a", "A", 1)]
+    assert db.count_loans_by_period(today, today + timedelta(days=1)) == {today: 1}
+    assert db.hand_over_book("a", "Main", today) == 2
+    assert db.return_book("a", 2, "Main") == "A"
+    assert db.hand_over_book("a", "Main", today) is None
+    db.reserve_book("b", 3)
+
+    with pytest.raises(RuntimeError):
+        with db.transaction():
+            db.take_book("b", 1, "Main", today)
+            db.delete_user(1)
+            raise RuntimeError("boom")
+    assert db.get_book_by_qr("b")["status"] == "available"
+    assert db.get_user(1)["first_name"] == "Ann"
+    assert db.get_user_loan_history(1)[0]["qr_code"] == "a"
+
+    # Returned records are copies; callers may modify them freely.
+    db.get_user(1)["office"] = "Alt"
+    assert db.get_user(1)["office"] == "Main"
+
+    assert get_user(1)["first_name"] == "Ann"
+
+    db.save_message(1, "first")
+    db.save_message(1, "second")
+    assert [m["text"] for m in db.search_messages(user_id=1, text="SEC")] == ["second"]
+    assert [m["text"] for m in db.search_messages(limit=1, offset=1)] == ["first"]
+    now = datetime.now(timezone.utc) + timedelta(seconds=1)
+    assert db.purge_messages(now, 1)
+    assert db.purge_messages(now, 1)
+    assert not db.purge_messages(now, 1)
+
+    db.save_bot_state({("user_data", "1"): '{"qr": "a"}', ("user_data", "2"): "{}"})
+    db.save_bot_state({("user_data", "2"): None})
+
+    db.close_connections()
+    restored = importlib.reload(db)
+    restored.init_db()
+    assert restored.get_user(1)["first_name"] == "Ann"
+    assert restored.get_book_by_qr("old")["status"] == "available"
+    assert restored.get_book_by_qr("c")["office"] == "Alt"
+    assert restored.get_user_loan_history(1)[0]["returned_at"] is not None
+    assert restored.load_bot_state("user_data") == {"1": '{"qr": "a"}'}
+    assert restored.reserve_book("b", 4) == 2
+
+
+def test_install_backend_rejects_incomplete_backend(sqlite_db):
+    class Partial:
+        def init_db(self):
+            pass
+
+    with pytest.raises(TypeError, match="does not implement close_connections"):
+        sqlite_db._install_backend(Partial())
+    assert isinstance(sqlite_db._backend, sqlite_db.SQLBackend)
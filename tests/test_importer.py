@@ -0,0 +1,99 @@
+import json
+import time
+
+import config
+import importer
+
+
+def test_import_books_csv(sqlite_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "OFFICES", {"Main": {"name": "Главный"}, "Alt": {}})
+    sqlite_db.init_db()
+    sqlite_db.save_book(
+        {
+            "qr_code": "b1",
+            "title": "Old title",
+            "status": "taken",
+            "taken_by": 7,
+            "taken_date": None,
+            "office": "Main",
+        }
+    )
+    path = tmp_path / "books.csv"
+    rows = ["qr_code,title,office"]
+    rows += [f"b{i},Book {i},Главный" for i in range(1, 5001)]
+    rows += [",No code,Main", "x1,Unknown office,Nowhere", "x2,Default office,"]
+    path.write_text("\n".join(rows), encoding="utf-8")
+
+    # Existing rows are looked up in several IN lists per import chunk.
+    monkeypatch.setattr(sqlite_db, "IN_LIST_CHUNK", 300)
+    progress = []
+    started = time.perf_counter()
+    result = importer.import_file(
+        str(path), default_office="Alt", chunk_size=1000, progress=progress.append
+    )
+    assert time.perf_counter() - started < 10
+
+    assert result.kind == "books"
+    assert result.processed == 5003
+    assert result.imported == 5001
+    assert [line for line, _ in result.errors] == [5002, 5003]
+    assert len(progress) == 6
+    book = sqlite_db.get_book_by_qr("b1")
+    # catalogue import updates the title but keeps the loan
+    assert (book["title"], book["status"], book["taken_by"]) == ("Book 1", "taken", 7)
+    assert sqlite_db.get_book_by_qr("x2")["office"] == "Alt"
+    assert len(sqlite_db.get_books_by_office("Main")) == 5000
+
+
+def test_import_users_jsonl_respects_allowed_offices(sqlite_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "OFFICES", {"Main": {"admins": ["10"]}, "Alt": {}})
+    monkeypatch.setattr(config, "ADMIN_IDS", [])
+    sqlite_db.init_db()
+    path = tmp_path / "users.jsonl"
+    lines = [
+        json.dumps({"telegram_id": 10, "first_name": "A", "last_name": "B", "office": "Main"}),
+        json.dumps({"telegram_id": 11, "first_name": "C", "last_name": "D", "office": "Alt"}),
+        "{broken",
+        json.dumps({"telegram_id": "x", "first_name": "E", "last_name": "F"}),
+    ]
+    path.write_text("\n".join(lines), encoding="utf-8")
+
+    result = importer.import_file(str(path), default_office="Main", allowed_offices={"Main"})
+
+    assert result.kind == "users"
+    assert result.imported == 1
+    assert len(result.errors) == 3
+    assert sqlite_db.get_user(10)["role"] == "admin"
+    assert sqlite_db.get_user(11) is None
+
+
+def test_office_admin_cannot_take_over_other_office_rows(sqlite_db, tmp_path, monkeypatch):
+    monkeypatch.setattr(config, "OFFICES", {"Main": {"admins": ["10"]}, "Alt": {}})
+    monkeypatch.setattr(config, "ADMIN_IDS", [])
+    monkeypatch.setattr(sqlite_db, "IN_LIST_CHUNK", 1)
+    sqlite_db.init_db()
+    sqlite_db.save_book(
+        {"qr_code": "alt1", "title": "Alt book", "status": "available",
+         "taken_by": None, "taken_date": None, "office": "Alt"}
+    )
+    sqlite_db.save_user(
+        {"telegram_id": 20, "first_name": "Alt", "last_name": "User", "office": "Alt", "role": "user"}
+    )
+    books = tmp_path / "books.csv"
+    books.write_text("qr_code,title\nalt1,Stolen\nnew1,New book\n", encoding="utf-8")
+    users = tmp_path / "users.jsonl"
+    users.write_text(
+        json.dumps({"telegram_id": 20, "first_name": "X", "last_name": "Y"}), encoding="utf-8"
+    )
+
+    result = importer.import_file(str(books), default_office="Main", allowed_offices={"Main"})
+    assert result.imported == 1
+    assert result.errors == [(2, "книга относится к другому офису")]
+    book = sqlite_db.get_book_by_qr("alt1")
+    assert (book["title"], book["office"]) == ("Alt book", "Alt")
+    assert sqlite_db.get_book_by_qr("new1")["office"] == "Main"
+    assert sqlite_db.get_office_stats("Alt")["total"] == 1
+
+    result = importer.import_file(str(users), default_office="Main", allowed_offices={"Main"})
+    assert (result.imported, result.errors) == (0, [(1, "сотрудник относится к другому офису")])
+    assert sqlite_db.get_user(20)["office"] == "Alt"
@@ -0,0 +1,80 @@
+import contextvars
+import json
+
+import config
+import multitenant
+import utils
+
+
+def test_tenants_are_isolated(sqlite_db, tmp_path):
+    db = sqlite_db
+    tenants_file = tmp_path / "tenants.json"
+    tenants_file.write_text(
+        json.dumps(
+            [
+                {
+                    "name": "a",
+                    "token": "A",
+                    "database": str(tmp_path / "a.db"),
+                    "admin_ids": [1],
+                    "offices": {"Main": {"name": "Главный"}},
+                },
+                {
+                    "name": "b",
+                    "token": "B",
+                    "database": str(tmp_path / "b.db"),
+                    "offices": {"Main": {"admins": [2]}, "Far": {"aliases": ["Дальний"]}},
+                },
+            ]
+        )
+    )
+    a, b = multitenant.load_tenants(str(tenants_file))
+
+    def as_tenant(tenant, fn, *args):
+        def call():
+            config.current_tenant.set(tenant)
+            return fn(*args)
+
+        return contextvars.copy_context().run(call)
+
+    for tenant in (a, b):
+        as_tenant(tenant, db.init_db)
+    as_tenant(a, db.save_book, {"qr_code": "q", "title": "Only in A", "office": "Main"})
+    version_b = as_tenant(b, db.office_version, "Main")
+
+    assert as_tenant(a, db.get_book_by_qr, "q")["title"] == "Only in A"
+    assert as_tenant(b, db.get_book_by_qr, "q") is None
+    assert as_tenant(b, db.office_version, "Main") == version_b
+    assert as_tenant(a, utils.is_global_admin, 1) and not as_tenant(b, utils.is_global_admin, 1)
+    assert as_tenant(b, utils.is_admin, 2, "Main") and not as_tenant(a, utils.is_admin, 2)
+    assert as_tenant(a, utils.resolve_office_name, "главный") == "Main"
+    assert as_tenant(b, utils.resolve_office_name, "дальний") == "Far"
+    assert as_tenant(a, utils.resolve_office_name, "дальний") is None
+    assert config.current_tenant.get() is None
+
+
+def test_offline_journal_and_cache_per_tenant(tmp_path):
+    import offline
+
+    journal, cache = offline._Journal(str(tmp_path / "journal.db")), offline._Cache()
+    a = config.Tenant("a", "A", "a.db", [], {})
+
+    def as_a(fn, *args):
+        def call():
+            config.current_tenant.set(a)
+            return fn(*args)
+
+        return contextvars.copy_context().run(call)
+
+    as_a(journal.append, "take", "q", 1, "Main", None)
+    assert as_a(journal.pending) == 1
+    assert journal.pending() == 0 and journal.entries() == []
+    journal.close()
+    assert as_a(journal.pending) == 1
+
+    # Cached records are copies: changing a returned book changes nothing.
+    cache.remember_books([{"qr_code": "q", "status": "available", "taken_by": None}])
+    cache.book("q")["status"] = "taken"
+    assert cache.book("q")["status"] == "available"
+    cache.update_book("q", offline.taken(1, None))
+    assert [b["qr_code"] for b in cache.user_books(1)] == ["q"]
@@ -0,0 +1,57 @@
+import asyncio
+import time
+
+import pytest
+from telegram.error import RetryAfter
+
+from outbound import SendQueue
+
+
+@pytest.mark.asyncio
+async def test_send_queue_throttles_per_chat():
+    queue = SendQueue(chat_rate=20, chat_burst=1)
+    calls = []
+
+    async def callback():
+        calls.append(time.monotonic())
+        return True
+
+    await asyncio.gather(
+        *(
+            queue.process_request(callback, (), {}, "sendMessage", {"chat_id": 5}, None)
+            for _ in range(3)
+        )
+    )
+    assert len(calls) == 3
+    assert calls[-1] - calls[0] >= 0.09
+
+
+@pytest.mark.asyncio
+async def test_send_queue_retries_after_flood_limit():
+    queue = SendQueue()
+    attempts = []
+
+    async def callback():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        return True
+
+    assert await queue.process_request(
+        callback, (), {}, "sendMessage", {"chat_id": 5}, None
+    )
+    assert len(attempts) == 2
+
+    with pytest.raises(RetryAfter):
+        await queue.process_request(
+            callback_always_flooded,
+            (),
+            {},
+            "sendMessage",
+            {"chat_id": 6},
+            {"max_retries": 0},
+        )
+
+
+async def callback_always_flooded():
+    raise RetryAfter(0)
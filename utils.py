@@ -1,8 +1,10 @@
 from __future__ import annotations
 
+import asyncio
 import json
 import logging
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
 from pathlib import Path
 from typing import Any, Dict, List, Optional
 
@@ -11,10 +13,17 @@ import numpy as np
 
 import config
 import db
+import offline
 
 DATA_DIR = Path(__file__).parent / "data"
 DATA_DIR.mkdir(exist_ok=True)
 
+# Threads decoding QR photos off the event loop; OpenCV releases the GIL.
+# Shared by every bot of the process, including all tenants of the runner.
+_decode_pool = ThreadPoolExecutor(
+    max_workers=config.QR_DECODE_WORKERS, thread_name_prefix="qr-decode"
+)
+
 
 def load_json(filename: str) -> Any:
     path = DATA_DIR / filename
@@ -30,87 +39,92 @@ def save_json(filename: str, data: Any) -> None:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
 
+def is_global_admin(user_id: int) -> bool:
+    """Return True if the user administers every office."""
+    return str(user_id) in config.index().global_admins
+
+
 def is_admin(user_id: int, office: Optional[str] = None) -> bool:
     """Return True if the user is an admin globally or for the given office."""
-    admin_ids = [str(a) for a in getattr(config, "ADMIN_IDS", [])]
-    if str(user_id) in admin_ids:
+    index = config.index()
+    user_id = str(user_id)
+    if user_id in index.global_admins:
         return True
-    offices = getattr(config, "OFFICES", {})
     if office:
-        office_admins = [str(a) for a in offices.get(office, {}).get("admins", [])]
-        return str(user_id) in office_admins
-    for info in offices.values():
-        if str(user_id) in [str(a) for a in info.get("admins", [])]:
-            return True
-    return False
-
-
-def _normalize(text: str) -> str:
-    """Return a normalized string for office comparison."""
-    return text.strip().lower().replace("ё", "е")
+        return user_id in index.office_admins.get(office, ())
+    return user_id in index.any_admins
 
 
 def resolve_office_name(name: str) -> Optional[str]:
     """Return canonical office key matching the provided text."""
-    offices = getattr(config, "OFFICES", {})
-    name_clean = _normalize(name)
-    for key, info in offices.items():
-        if _normalize(key) == name_clean:
-            return key
-        if _normalize(str(info.get("name", ""))) == name_clean:
-            return key
-        for alias in info.get("aliases", []):
-            if _normalize(str(alias)) == name_clean:
-                return key
-    return None
+    return config.index().aliases.get(config.normalize_office(name))
 
 
 def get_user(user_id: int) -> Optional[Dict[str, Any]]:
     """Return user data for the given Telegram ID."""
-    return db.get_user(user_id)
+    try:
+        user = db.get_user(user_id)
+    except db.DatabaseUnavailable:
+        return offline.get_user(user_id)
+    offline.cache.remember_user(user)
+    return user
 
 
 def register_user(
     user_id: int, first_name: str, last_name: str, office: str
 ) -> Dict[str, Any]:
     """Register a user or update their Telegram ID."""
-    existing = db.get_user_by_name(first_name, last_name, office)
+    with db.transaction():
+        existing = db.get_user_by_name(first_name, last_name, office)
+        if existing:
+            existing["telegram_id"] = user_id
+            db.save_user(existing)
+        else:
+            user = {
+                "telegram_id": user_id,
+                "first_name": first_name,
+                "last_name": last_name,
+                "office": office,
+                "role": "admin" if is_admin(user_id, office) else "user",
+            }
+            db.save_user(user)
     if existing:
-        existing["telegram_id"] = user_id
-        db.save_user(existing)
         log_action("login_user", existing)
         return existing
-
-    user = {
-        "telegram_id": user_id,
-        "first_name": first_name,
-        "last_name": last_name,
-        "office": office,
-        "role": "admin" if is_admin(user_id, office) else "user",
-    }
-    db.save_user(user)
     log_action("register_user", user)
     return user
 
 
 def update_user_office(user_id: int, office: str) -> Optional[Dict[str, Any]]:
     """Update the office for an existing user."""
-    user = db.get_user(user_id)
-    if not user:
-        return None
     role = "admin" if is_admin(user_id, office) else "user"
-    db.update_user_office(user_id, office, role)
+    with db.transaction():
+        user = db.get_user(user_id)
+        if not user:
+            return None
+        db.update_user_office(user_id, office, role)
     user.update({"office": office, "role": role})
     log_action("update_office", {"user_id": user_id, "office": office})
     return user
 
 
 def get_book_by_qr(qr: str) -> Optional[Dict[str, Any]]:
-    return db.get_book_by_qr(qr)
+    try:
+        book = db.get_book_by_qr(qr)
+    except db.DatabaseUnavailable:
+        return offline.get_book(qr)
+    if book:
+        offline.cache.remember_books([book])
+    return book
 
 
 def get_user_books(user_id: int) -> List[Dict[str, Any]]:
-    return db.get_user_books(user_id)
+    try:
+        books = db.get_user_books(user_id)
+    except db.DatabaseUnavailable:
+        return offline.get_user_books(user_id)
+    offline.cache.remember_books(books)
+    return books
 
 
 def get_books_by_office(office: str) -> List[Dict[str, Any]]:
@@ -118,16 +132,108 @@ def get_books_by_office(office: str) -> List[Dict[str, Any]]:
     return db.get_books_by_office(office)
 
 
+def search_books(
+    office: str, text: str, limit: int, offset: int = 0
+) -> List[Dict[str, Any]]:
+    """Return books of the office whose titles match ``text``, ranked."""
+    return db.search_books(office, text, limit, offset)
+
+
 def save_book(book: Dict[str, Any]) -> None:
     db.save_book(book)
 
 
+def take_book(qr: str, user_id: int, office: str) -> Optional[str]:
+    """Mark the book as taken by the user and return its title on success.
+
+    While the database is unavailable the take is queued in the offline
+    journal; handlers replay it first with
+    :func:`handlers.recovery.replay_pending`.
+    """
+    try:
+        title = db.take_book(qr, user_id, office, today())
+    except db.DatabaseUnavailable:
+        return offline.take_book(qr, user_id, office, today())
+    if title:
+        offline.cache.update_book(qr, offline.taken(user_id, today()))
+    return title
+
+
+def return_book(qr: str, user_id: int, office: str) -> Optional[str]:
+    """Return a book held by the user and return its title on success.
+
+    While the database is unavailable the return is queued in the offline
+    journal; handlers replay it first with
+    :func:`handlers.recovery.replay_pending`.
+    """
+    try:
+        title = db.return_book(qr, user_id, office)
+    except db.DatabaseUnavailable:
+        return offline.return_book(qr, user_id, office)
+    if title:
+        offline.cache.update_book(qr, offline.RETURNED)
+    return title
+
+
+def reserve_book(qr: str, user_id: int) -> int:
+    """Put the user on the waitlist of a taken book and return their place."""
+    return db.reserve_book(qr, user_id)
+
+
+def hand_over_book(qr: str, office: str, returned_by: Optional[int] = None) -> Optional[int]:
+    """Lend a returned book to the first user waiting for it and return their ID.
+
+    ``returned_by`` is the previous borrower, who is skipped and leaves the
+    waitlist.
+    """
+    try:
+        user_id = db.hand_over_book(qr, office, today(), returned_by)
+    except db.DatabaseUnavailable:
+        # The return was journaled; replaying it serves the waitlist.
+        return None
+    if user_id is not None:
+        offline.cache.update_book(qr, offline.taken(user_id, today()))
+    return user_id
+
+
+def reset_book(qr: str, office: str) -> Optional[str]:
+    """Make a book of the office available again and return its title."""
+    title = db.reset_book(qr, office)
+    if title:
+        offline.cache.update_book(qr, offline.RETURNED)
+    return title
+
+
+def get_user_loan_history(user_id: int) -> List[Dict[str, Any]]:
+    return db.get_user_loan_history(user_id)
+
+
+def today() -> date:
+    """Return the current UTC date used for loan bookkeeping."""
+    return datetime.now(timezone.utc).date()
+
+
+def overdue_cutoff() -> date:
+    """Return the take date before which a loan counts as overdue."""
+    return db.overdue_cutoff()
+
+
+def get_overdue_books(office: Optional[str]) -> List[Dict[str, Any]]:
+    """Return overdue books for the office, or for all offices if ``None``."""
+    return db.get_overdue_books(office, overdue_cutoff())
+
+
 def get_all_users() -> List[Dict[str, Any]]:
     return db.get_all_users()
 
 
-def delete_user(user_id: int) -> None:
-    db.delete_user(user_id)
+def delete_user(user_id: int) -> bool:
+    """Delete a user and return ``False`` if there was no such user."""
+    with db.transaction():
+        if not db.get_user(user_id):
+            return False
+        db.delete_user(user_id)
+    return True
 
 
 async def extract_qr_from_update(update, bot) -> Optional[str]:
@@ -142,17 +248,51 @@ async def extract_qr_from_update(update, bot) -> Optional[str]:
     if qr:
         return qr
 
-    file = None
+    attachment = qr_attachment(message)
+    if not attachment:
+        return None
+    return await decode_qr_attachment(attachment)
+
+
+def qr_attachment(message):
+    """Return the photo or image document of ``message``, if any."""
     if message.photo:
-        file = await message.photo[-1].get_file()
-    elif message.document and message.document.mime_type and message.document.mime_type.startswith("image/"):
-        file = await message.document.get_file()
+        return message.photo[-1]
+    if message.document and message.document.mime_type and message.document.mime_type.startswith("image/"):
+        return message.document
+    return None
 
-    if not file:
-        return None
 
+async def decode_qr_attachment(attachment) -> Optional[str]:
+    """Download a photo or image document and decode its QR code off the event loop."""
+    file = await attachment.get_file()
     data = await file.download_as_bytearray()
-    img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_decode_pool, decode_qr_image, bytes(data))
+
+
+def decode_qr_image(
+    data: bytes, grayscale: bool = False, max_side: Optional[int] = None
+) -> Optional[str]:
+    """Return QR code text decoded from raw image bytes.
+
+    ``grayscale`` decodes the image with a single channel and ``max_side``
+    downscales large images before detection. Both default to the behaviour
+    used by the bot; ``benchmarks/qr_decode.py`` compares the variants.
+    """
+    flags = cv2.IMREAD_GRAYSCALE if grayscale else cv2.IMREAD_COLOR
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if img is None:
+        return None
+    if max_side:
+        height, width = img.shape[:2]
+        scale = max_side / max(height, width)
+        if scale < 1:
+            img = cv2.resize(
+                img,
+                (int(width * scale), int(height * scale)),
+                interpolation=cv2.INTER_AREA,
+            )
     detector = cv2.QRCodeDetector()
     decoded, _, _ = detector.detectAndDecode(img)
     return decoded.strip() if decoded else None